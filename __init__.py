@@ -4,6 +4,16 @@
 __version__ = "1.0"
 __author__ = "Thomas Thébault"
 
-__all__ = ["download_ftp","extract_psep","lead_filter","main","rsr_package_modification","utils","plot_rsr_results","apply_rsr"]
+__all__ = ["download_ftp","extract_psep","lead_filter","main","rsr_package_modification","utils","plot_rsr_results","apply_rsr","hk_moments","psep_kernels","fit_cache","spatial_index","rsr_tiles","incremental_update","extraction_manifest","waveform_cache","run_stats","psep_store","rsr_pyramid","pipeline","psep_worker","startup_benchmark","cell_buffers","rsr_blocks","autotune","rsr_query"]
 
-from code import download_ftp,extract_psep,lead_filter,main,rsr_package_modification,utils,plot_rsr_results,apply_rsr
\ No newline at end of file
+import importlib
+
+
+def __getattr__(name):
+    """Import the modules at their first use, so that importing the package does not import
+    matplotlib, basemap, netCDF4 or rsr for the modules which are not used."""
+    if name in __all__:
+        module = importlib.import_module("code." + name)
+        globals()[name] = module
+        return module
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
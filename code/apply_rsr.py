@@ -1,70 +1,174 @@
-from utils import arctic_grid,read_psep_from_csv, is_ice, build_KDtree, find_closest_points
+from utils import arctic_grid,read_psep_from_csv, is_ice
+from spatial_index import SpatialIndex, latlon_to_xy, find_neighborhoods
+from hk_moments import fit_hk_moments, bootstrap_hk_moments, MU_MIN, MU_MAX
+from fit_cache import FitCache, compute_psep_fingerprint, fit_key
+from psep_store import load_psep_store
+from run_stats import stage, run_instrumented, collect, reset, write_report, report_filename, add_summary
 from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import numpy as np
 import csv
 import json
-import rsr
 import os
+import re
+import time
 
-def apply_rsr_arctic(path, **kwargs):
+def apply_rsr_arctic(path, use_psep_store=False, run_report=True, max_memory=None, auto_tune=False, **kwargs):
     """
     Apply RSR to the Arctic grid and save the results in CSV files.
 
     Args:
         path (str): Path to the data directory.
+        use_psep_store (bool): Whether to read the PSEP from the consolidated store (float32, spatially sorted,
+            memory-mapped by the workers, cf psep_store.py) instead of the csv files. Defaults to False.
+        run_report (bool): Whether to save the duration and throughput of each stage in path/reports/apply_rsr_arctic_<date>.json. Defaults to True.
+        max_memory (float): Memory budget (GB). If provided, the grid is processed by spatial blocks, reading only the PSEP
+            of each block and its halo from the memory-mapped store (cf rsr_blocks.py). Defaults to None (whole month in memory).
+        auto_tune (bool): Whether to lower nb_cores to the available CPUs and memory (cf autotune.rsr_nb_cores). The decision
+            is saved in path/autotune.json, to be pinned in the next runs with autotune.read_tuned_settings. Defaults to False.
         **kwargs: Additional keyword arguments for apply_rsr and arctic_grid.
     """
     
+    reset('apply_rsr_arctic')
+    remove_rsr_results(path)
+
+    if max_memory is not None:
+        from rsr_blocks import apply_rsr_blocks
+        # nb_cores is tuned once the bursts of the blocks are counted
+        apply_rsr_blocks(path, max_memory, auto_tune=auto_tune, **kwargs)
+        if run_report:
+            write_report(report_filename(path, 'apply_rsr_arctic'))
+        return
+
     print("Generating Arctic grid...")
-    latlon_target_array = arctic_grid(**kwargs)
+    latlon_target_array, xy_target_array = arctic_grid(return_xy=True, **kwargs)
     
-    print("Reading PSEP data from CSV files...")
-    latlon_array, powers_2D_array = read_psep_from_csv(os.path.join(path, "psep"))
+    if use_psep_store:
+        print("Reading PSEP data from the consolidated store...")
+        latlon_array, powers_2D_array, xy_array, kwargs['row_order'] = load_psep_store(os.path.join(path, "psep"))
+    else:
+        print("Reading PSEP data from CSV files...")
+        latlon_array, powers_2D_array, xy_array = read_psep_from_csv(os.path.join(path, "psep"), return_xy=True)
+
+    if auto_tune:
+        # Each worker receives the coordinates (and builds their spatial index) and a copy of the powers unless memory-mapped
+        tune_nb_cores(path, kwargs, 3 * xy_array.nbytes + (0 if isinstance(powers_2D_array, np.memmap) else powers_2D_array.nbytes))
 
     print("Applying RSR to Arctic grid...")
-    apply_rsr(latlon_target_array, latlon_array, powers_2D_array, path, **kwargs)
+    apply_rsr(latlon_target_array, latlon_array, powers_2D_array, path, xy_target_array=xy_target_array, xy_array=xy_array, **kwargs)
+
+    if run_report:
+        write_report(report_filename(path, 'apply_rsr_arctic'))
     
 
-def apply_rsr(latlon_target_array, latlon_array, powers_2D_array, path, nb_cores=8, **kwargs):
+def remove_rsr_results(path):
+    """Remove the results of a previous run of apply_rsr_arctic (rsr_results_core_<i>.csv, rsr_results_block_<b>_core_<i>.csv
+    with max_memory) and of the incremental updates (rsr_results_update_<date>_core_<i>.csv), which cover the same grid,
+    so that plot_rsr_results and update_month do not read their targets twice."""
+    for csv_file in os.listdir(path):
+        if re.fullmatch(r"rsr_results_((block|update)_[^.]+_)?core_\d+\.csv", csv_file):
+            os.remove(os.path.join(path, csv_file))
+
+
+def tune_nb_cores(path, kwargs, bytes_per_worker=0, memory_budget=None):
+    """Lower kwargs['nb_cores'] to the available CPUs and memory (cf autotune.rsr_nb_cores), and save the decision in path/autotune.json."""
+    from autotune import rsr_nb_cores, save_tuned_settings
+    nb_cores = kwargs.get('nb_cores', 8)
+    kwargs['nb_cores'], reason = rsr_nb_cores(nb_cores, bytes_per_worker, memory_budget=memory_budget)
+    decisions = []
+    if reason is not None:
+        print(f"Auto mode: nb_cores {nb_cores} -> {kwargs['nb_cores']} ({reason})")
+        decisions.append({'setting': 'nb_cores', 'from': nb_cores, 'to': kwargs['nb_cores'], 'reason': reason,
+                          'measures': {'bytes_per_worker': bytes_per_worker}})
+    save_tuned_settings(path, 'apply_rsr_arctic', {'nb_cores': kwargs['nb_cores']}, decisions)
+    add_summary('autotune', {'settings': {'nb_cores': kwargs['nb_cores']}, 'decisions': decisions})
+
+
+def apply_rsr(latlon_target_array, latlon_array, powers_2D_array, path, nb_cores=8, use_fit_cache=False, xy_target_array=None, xy_array=None, p0_target_array=None, **kwargs):
     """Apply RSR to each target and save the results in csv files.
 
     Args:
         latlon_target_array (np.ndarray): Array of target latitudes and longitudes.
         latlon_array (np.ndarray): Array of input latitudes and longitudes.
-        powers_2D_array (np.ndarray): 2D array of input psep values.
+        powers_2D_array (np.ndarray): 2D array of input psep values. If memory-mapped, the workers map the same file instead of receiving a copy.
         path (str): Path to the data directory.
         nb_cores (int): Number of CPU cores to use for processing.
+        use_fit_cache (bool): Whether to read and store the HK fits in the fit cache of the data directory. Defaults to False.
+        xy_target_array (np.ndarray): EPSG:3413 coordinates of the targets (m). Projected from latlon_target_array if None.
+        xy_array (np.ndarray): EPSG:3413 coordinates of the psep values (m). Projected from latlon_array if None.
+        p0_target_array (np.ndarray): Initial (a, s, mu) of the lmfit HK-fitting of each target, shape (N, 3), NaN rows
+            for the default initialization (cf fit_hk). Defaults to None.
     """
     
-    print("Building KD-tree for lat/lon coordinates...")
-    KD_tree, _ = build_KDtree(latlon_array)
+    if use_fit_cache:
+        print("Computing PSEP dataset fingerprint for the fit cache...")
+        kwargs['psep_fingerprint'] = compute_psep_fingerprint(latlon_array, powers_2D_array)
+    
+    latlon_target_array = np.asarray(latlon_target_array)
+    if xy_target_array is None:
+        xy_target_array = latlon_to_xy(latlon_target_array)
+    if xy_array is None:
+        xy_array = latlon_to_xy(latlon_array)
 
-    latlon_target_array_filtered = [latlon_target for latlon_target in latlon_target_array if is_ice(latlon_target, KD_tree)]
+    print("Building spatial index of the psep values...")
+    psep_index = SpatialIndex(xy_array)
+
+    mask_ice = is_ice(xy_target_array, psep_index)
+    latlon_target_array_filtered = latlon_target_array[mask_ice]
+    xy_target_array_filtered = xy_target_array[mask_ice]
+    p0_target_array_filtered = np.asarray(p0_target_array)[mask_ice] if p0_target_array is not None else None
     print(f"Number of target points over ice: {len(latlon_target_array_filtered)} / {len(latlon_target_array)}")
-    
-    latlon_target_array_filtered = latlon_target_array_filtered[0:30]
+
+    # Memory-mapped powers are sent to the workers as the path of their .npy file
+    powers_for_workers = powers_2D_array.filename if isinstance(powers_2D_array, np.memmap) else powers_2D_array
 
     # Split the filtered target points among the available cores
     nb_target_per_core = len(latlon_target_array_filtered) // nb_cores
     futures = []
     with ProcessPoolExecutor(max_workers=nb_cores) as executor:
-        futures = [executor.submit(apply_rsr_core, latlon_target_array_filtered[i*nb_target_per_core:((i + 1)*nb_target_per_core if i!=nb_cores-1 else len(latlon_target_array_filtered))], latlon_array, powers_2D_array, path, i, **kwargs) for i in range(nb_cores)]
+        for i in range(nb_cores):
+            core_slice = slice(i*nb_target_per_core, (i + 1)*nb_target_per_core if i!=nb_cores-1 else len(latlon_target_array_filtered))
+            p0_core = p0_target_array_filtered[core_slice] if p0_target_array_filtered is not None else None
+            futures.append(executor.submit(run_instrumented, apply_rsr_core, latlon_target_array_filtered[core_slice], xy_target_array_filtered[core_slice], xy_array, powers_for_workers, path, i, p0_target_array=p0_core, **kwargs))
+    for future in futures:
+        collect(future)
+
+    summary = fit_telemetry_summary([os.path.join(path, kwargs.get('output_name', 'rsr_results') + f'_core_{i}.csv') for i in range(nb_cores)])
+    add_summary('fit_telemetry', summary)
+    if summary['nb_fits'] > 0:
+        print(f"{summary['nb_fits']} lmfit fits : {summary['nb_fallbacks']} with fallbacks, {summary['nb_timed_out']} stopped by the time budget, "
+              f"wall time p50 {summary['time_p50']:.2f} s, p99 {summary['time_p99']:.2f} s, max {summary['time_max']:.2f} s")
 
     print("RSR processing completed and results saved.")
     
 
-def apply_rsr_core(latlon_target_array,  latlon_array, powers_2D_array, path_to_data, core_id, **kwargs):
+def apply_rsr_core(latlon_target_array, xy_target_array, xy_array, powers_2D_array, path_to_data, core_id, psep_fingerprint=None, fit_cache_max_entries=1000000, output_name='rsr_results', bootstrap_resamples=0, p0_target_array=None, **kwargs):
     """Applies RSR to the given target points.
 
     Args:
         latlon_target_array (np.ndarray): Array of target latitudes and longitudes.
-        latlon_array (np.ndarray): Array of input latitudes and longitudes.
-        powers_2D_array (np.ndarray): 2D array of input psep values.
+        xy_target_array (np.ndarray): Array of target EPSG:3413 coordinates (m).
+        xy_array (np.ndarray): Array of input EPSG:3413 coordinates (m).
+        powers_2D_array (np.ndarray or str): 2D array of input psep values, or path of a .npy file to memory-map.
         path_to_data (str): Path to the data directory.
         core_id (int): ID of the core processing the batch.
+        psep_fingerprint (str): Fingerprint of the PSEP dataset. If provided, the fit cache is used. Defaults to None.
+        fit_cache_max_entries (int): Maximum number of fits kept in the fit cache. Defaults to 1000000.
+        output_name (str): Prefix of the output csv file, completed by '_core_<core_id>.csv'. Defaults to 'rsr_results'.
+        bootstrap_resamples (int): Number of bootstrap resamples for the standard errors (cf apply_rsr_batch), saved
+            in an 'uncertainty' column. Defaults to 0 (no bootstrap).
+        p0_target_array (np.ndarray): Initial (a, s, mu) of the lmfit HK-fitting of each target (cf fit_hk). Defaults to None.
     """
 
-    print(f"Core {core_id}: Building KD-tree for lat/lon coordinates...")
-    KD_tree, dictionary = build_KDtree(latlon_array)
+    if isinstance(powers_2D_array, str):
+        powers_2D_array = np.load(powers_2D_array, mmap_mode='r')
+
+    print(f"Core {core_id}: Building spatial index of the psep values...")
+    psep_index = SpatialIndex(xy_array)
+
+    if psep_fingerprint is not None:
+        kwargs['fit_cache'] = FitCache(os.path.join(path_to_data, 'fit_cache.sqlite'), max_entries=fit_cache_max_entries)
+        kwargs['psep_fingerprint'] = psep_fingerprint
     
     # Process apply_rsr_multi_targets with 1000 target points each time
     
@@ -75,55 +179,323 @@ def apply_rsr_core(latlon_target_array,  latlon_array, powers_2D_array, path_to_
     
     for i in range(nb_calls):
         latlon_target_batch = latlon_target_array[i*1000:min((i+1)*1000, len(latlon_target_array))]
-        results.extend(apply_rsr_batch(latlon_target_batch, KD_tree, dictionary, powers_2D_array,core_id,i,len(latlon_target_array), **kwargs))
+        xy_target_batch = xy_target_array[i*1000:min((i+1)*1000, len(latlon_target_array))]
+        p0_target_batch = p0_target_array[i*1000:min((i+1)*1000, len(latlon_target_array))] if p0_target_array is not None else None
+        results.extend(apply_rsr_batch(latlon_target_batch, xy_target_batch, psep_index, powers_2D_array,core_id,i,len(latlon_target_array), bootstrap_resamples=bootstrap_resamples, p0_target_array=p0_target_batch, **kwargs))
 
+    if psep_fingerprint is not None:
+        kwargs['fit_cache'].close()
 
 
     print(f"Core {core_id}: Saving RSR results in csv")
-    with open(os.path.join(path_to_data, 'rsr_results_core_'+str(core_id)+'.csv'), 'w', newline='') as csvfile:
+    write_rsr_results(os.path.join(path_to_data, output_name+'_core_'+str(core_id)+'.csv'), results, bootstrap_resamples)
+
+    print(f"Core {core_id}: RSR processing completed and results saved.")
+
+
+def write_rsr_results(filename, results, bootstrap_resamples=0):
+    """Save the RSR results of targets in a csv file.
+
+    Args:
+        filename (str): Path of the csv file.
+        results (list): Results of the targets (cf apply_rsr_batch).
+        bootstrap_resamples (int): Number of bootstrap resamples, the standard errors being saved in an 'uncertainty'
+            column if it is positive. Defaults to 0.
+    """
+    with stage('write_results', targets=len(results)), open(filename, 'w', newline='') as csvfile:
         writer = csv.writer(csvfile)
-        writer.writerow(['lat', 'lon', 'value', 'power', 'crl', 'flag'])
-        for (latlon_target, f) in results:
+        writer.writerow(['lat', 'lon', 'value', 'power', 'crl', 'flag', 'fit_info'] + (['uncertainty'] if bootstrap_resamples > 0 else []))
+        for (latlon_target, f, uncertainty, fit_info) in results:
             value_str = json.dumps(f.values)
             power_str = json.dumps(f.power())
             crl_str = json.dumps(f.crl())
             flag_str = json.dumps(f.flag())
-            writer.writerow([latlon_target[0], latlon_target[1], value_str, power_str, crl_str, flag_str])
-
-    print(f"Core {core_id}: RSR processing completed and results saved.")
+            uncertainty_str = [json.dumps(uncertainty)] if bootstrap_resamples > 0 else []
+            writer.writerow([latlon_target[0], latlon_target[1], value_str, power_str, crl_str, flag_str, json.dumps(fit_info)] + uncertainty_str)
 
 
-def apply_rsr_batch(latlon_target_array, KD_tree, dictionary, powers_2D_array, core_id, index, nb_targets_core, nb_closest=1000, min_method='least_squares'):
+def apply_rsr_batch(latlon_target_array, xy_target_array, psep_index, powers_2D_array, core_id, index, nb_targets_core, nb_closest=1000, min_method='least_squares', fit_mode='full', crl_min=0.9, fit_cache=None, psep_fingerprint=None, bootstrap_resamples=0, bootstrap_budget=None, bootstrap_seed=0, p0_target_array=None, fit_budget=None, neighborhoods=None, **kwargs):
     """Apply RSR to a batch of target points.
 
     Args:
         latlon_target_array (np.ndarray): Array of target latitudes and longitudes.
-        KD_tree (cKDTree): KD-tree containing psep measures coordinates.
-        dictionary (dict): Dictionary mapping coordinates to indices.
+        xy_target_array (np.ndarray): Array of target EPSG:3413 coordinates (m).
+        psep_index (SpatialIndex): Spatial index of the psep measures.
         powers_2D_array (np.ndarray): 2D array of psep values.
         core_id (int): ID of the core processing the batch.
         index (int): Index of the batch.
         nb_targets_core (int): Total number of targets for the core.
         nb_closest (int): Number of closest points to consider for each target. (e.g. if you indicate 1000, there will be 64000 psep values in input of the rsr, as each burst is composed of 64 echoes)
+            Other keyword arguments of find_neighborhoods select a radius-bounded neighborhood instead.
         min_method (str): Minimization method used in the lmfit HK-fitting. Defaults to 'least_squares'.
+        fit_mode (str): 'full' for the lmfit HK-fitting of every target, 'moments' for the method-of-moments
+            HK estimation only, 'tiered' for the method-of-moments estimation with a full fit of the targets
+            where it is unstable or its correlation is below crl_min. Defaults to 'full'.
+        crl_min (float): Minimum correlation coefficient of the moment estimation in 'tiered' mode. Defaults to 0.9.
+        fit_cache (FitCache): Cache of the fits, read before fitting and updated with the new fits. Defaults to None.
+        psep_fingerprint (str): Fingerprint of the PSEP dataset, required with fit_cache. Defaults to None.
+        bootstrap_resamples (int): Number of bootstrap resamples of the neighborhood of each target, to estimate the
+            standard errors of pc, pn, pc-pn (dB) and mu with the method of moments. Defaults to 0 (no bootstrap).
+        bootstrap_budget (float): Compute budget of the bootstrap per target (s), fewer resamples are drawn when
+            it is spent. Defaults to None (no limit).
+        bootstrap_seed (int): Seed of the bootstrap random generators, one per target seeded with its coordinates
+            (cf target_rng). Defaults to 0.
+        p0_target_array (np.ndarray): Initial (a, s, mu) of the lmfit HK-fitting of each target, e.g. the fit of the
+            parent cell in a grid pyramid (cf fit_hk). Defaults to None.
+        fit_budget (float): Time budget of the lmfit HK-fitting of each target (s). The fits which spend it are
+            stopped and unsuccessful (flag 0), and are not saved in the fit cache. Defaults to None (no limit).
+        neighborhoods (list): Burst row indices of each target, e.g. read from the cell buffers (cf cell_buffers.py),
+            instead of searching them in psep_index. Defaults to None.
 
     Returns:
-        list: List of tuples containing target coordinates and RSR results.
+        list: List of tuples containing target coordinates, RSR results, standard errors (None without bootstrap)
+            and fit telemetry ({'method': 'moments' or 'cache', 'time'} or the telemetry of fit_hk).
     """
     
+    if fit_mode not in ('full', 'moments', 'tiered'):
+        raise ValueError(f"Unknown fit_mode: {fit_mode}. Expected 'full', 'moments' or 'tiered'.")
+
     print(f"Core {core_id}: Processing targets {index*1000+1} to {index*1000+len(latlon_target_array)} / {nb_targets_core}")
-    xyz_closest_array = find_closest_points(KD_tree, latlon_target_array,k=nb_closest)
+    if neighborhoods is not None:
+        indices_closest_array = neighborhoods
+    else:
+        with stage('neighbors', targets=len(xy_target_array)):
+            indices_closest_array = find_neighborhoods(psep_index, xy_target_array, nb_closest=nb_closest, **kwargs)
+
+    # Skip the under-sampled targets (empty neighborhoods)
+    sampled = [len(indices_closest) > 0 for indices_closest in indices_closest_array]
+    if not all(sampled):
+        print(f"Core {core_id}: {len(sampled) - sum(sampled)} under-sampled targets skipped")
+        latlon_target_array = [latlon_target for latlon_target, keep in zip(latlon_target_array, sampled) if keep]
+        indices_closest_array = [indices_closest for indices_closest, keep in zip(indices_closest_array, sampled) if keep]
+        if p0_target_array is not None:
+            p0_target_array = np.asarray(p0_target_array)[sampled]
 
-    f_array = []
+    # Read the fits already in the cache
+    if fit_cache is not None:
+        with stage('fit_cache_read', targets=len(indices_closest_array)) as counters:
+            keys = [fit_key(indices_closest, psep_fingerprint, min_method, fit_mode, crl_min,
+                            p0=p0_target_array[i] if p0_target_array is not None else None)
+                    for i, indices_closest in enumerate(indices_closest_array)]
+            f_array = fit_cache.get_many(keys)
+            counters['hits'] = sum(f is not None for f in f_array)
+    else:
+        f_array = [None] * len(indices_closest_array)
+    targets_to_fit = [i for i, f in enumerate(f_array) if f is None]
+    fit_info = [None if f is None else {'method': 'cache'} for f in f_array]
+    if fit_cache is not None:
+        print(f"Core {core_id}: {len(f_array) - len(targets_to_fit)} fits found in the fit cache")
 
-    for i, xyz_closest in enumerate(xyz_closest_array):
-        if i % 10 == 0:
-            print(f"Core {core_id}: Processing target {index*1000+i+1}/{nb_targets_core}")
-        # Process each set of closest points for the target
-        indices_closest = [dictionary[tuple(point)] for point in xyz_closest]
-        powers_for_rsr = powers_2D_array[indices_closest]
-        powers_for_rsr = powers_for_rsr.flatten()
-        f = rsr.run.processor(powers_for_rsr, fit_model='hk', min_method=min_method)
-        f_array.append(f)
+    # Method-of-moments estimation, by chunks of 100 targets to limit memory usage
+    if fit_mode != 'full':
+        for i in range(0, len(targets_to_fit), 100):
+            chunk = targets_to_fit[i:i+100]
+            with stage('gather_powers', targets=len(chunk)):
+                powers_for_rsr = gather_powers(powers_2D_array, [indices_closest_array[j] for j in chunk])
+            start = time.perf_counter()
+            with stage('hk_moments', fits=len(chunk)):
+                for j, f in zip(chunk, fit_hk_moments(powers_for_rsr)):
+                    f_array[j] = f
+            for j in chunk:
+                fit_info[j] = {'method': 'moments', 'time': (time.perf_counter() - start) / len(chunk)}
+    
+    if fit_mode != 'moments':
+        for i in targets_to_fit:
+            if fit_mode == 'tiered' and f_array[i].success and f_array[i].crl() >= crl_min:
+                continue
+            if i % 10 == 0:
+                print(f"Core {core_id}: Processing target {index*1000+i+1}/{nb_targets_core}")
+            # Process each set of closest points for the target
+            powers_for_rsr = powers_2D_array[indices_closest_array[i]]
+            powers_for_rsr = powers_for_rsr.flatten().astype(np.float64)
+            with stage('hk_fit', fits=1) as counters:
+                f_array[i], fit_info[i] = fit_hk(powers_for_rsr, min_method, p0=p0_target_array[i] if p0_target_array is not None else None,
+                                                 budget_s=fit_budget)
+                counters.update(nfev=fit_info[i]['nfev'], fallbacks=fit_info[i]['fallbacks'], timeouts=int(fit_info[i]['timed_out']))
+            if fit_info[i]['timed_out']:
+                print(f"Core {core_id}: Fit of target {index*1000+i+1} stopped after {fit_info[i]['time']:.1f} s ({fit_info[i]['method']})")
+
+    # The fits stopped by the time budget are fitted again in the next runs
+    targets_to_cache = [i for i in targets_to_fit if not fit_info[i].get('timed_out', False)]
+    if fit_cache is not None and targets_to_cache:
+        with stage('fit_cache_write', fits=len(targets_to_cache)):
+            fit_cache.put_many([keys[i] for i in targets_to_cache], [f_array[i] for i in targets_to_cache])
+
+    # Bootstrap standard errors, by chunks of 100 targets
+    uncertainties = [None] * len(f_array)
+    if bootstrap_resamples > 0:
+        for i in range(0, len(f_array), 100):
+            chunk = range(i, min(i + 100, len(f_array)))
+            powers_for_rsr = gather_powers(powers_2D_array, [indices_closest_array[j] for j in chunk])
+            # Seeded by target, so that the resamples do not depend on the split of the targets among the cores
+            rngs = [target_rng(bootstrap_seed, latlon_target_array[j]) for j in chunk]
+            with stage('bootstrap', targets=len(chunk)) as counters:
+                errors = bootstrap_hk_moments(powers_for_rsr, nb_resamples=bootstrap_resamples, rng=rngs,
+                                              max_time=bootstrap_budget * len(chunk) if bootstrap_budget is not None else None)
+                counters['resamples'] = errors['nb_resamples'] * len(chunk)
+            for k, j in enumerate(chunk):
+                uncertainties[j] = {name: (float(errors[name][k]) if np.isfinite(errors[name][k]) else None)
+                                    for name in ('pc', 'pn', 'pc-pn', 'mu', 'stable_fraction')}
+                uncertainties[j]['nb_resamples'] = errors['nb_resamples']
+
+    return list(zip(latlon_target_array, f_array, uncertainties, fit_info))
+
+
+@contextmanager
+def fit_telemetry(budget_s=None):
+    """Record the minimizations of the lmfit HK-fitting, and stop them once a time budget is spent.
+
+    rsr.fit.lmfit runs min_method, then 'leastsq' if it fails, then 'lbfgs'. Within the context, each
+    minimization is recorded in the yielded list of attempts ({'method', 'nfev', 'time', 'aborted'} or
+    {'method', 'time', 'error'}), and is aborted through the lmfit iteration callback when budget_s
+    seconds have passed since the beginning of the context. An aborted minimization returns its last
+    parameters with success False, so that the fallback chain stops there. The scalar methods (e.g. 'nelder')
+    raise once aborted, and the fallback to 'leastsq' is then aborted at its first iteration.
+    """
+    import rsr
 
-    return list(zip(latlon_target_array, f_array))
\ No newline at end of file
+    attempts = []
+    start = time.perf_counter()
+    minimize = rsr.fit.minimize
+
+    def recorded_minimize(fcn, params, method='leastsq', **kws):
+        attempt = {'method': method}
+        attempts.append(attempt)
+        attempt_start = time.perf_counter()
+        if budget_s is not None:
+            kws['iter_cb'] = lambda *args, **kwargs: time.perf_counter() - start > budget_s
+        try:
+            result = minimize(fcn, params, method=method, **kws)
+        except Exception as e:
+            attempt['error'] = repr(e)
+            raise
+        finally:
+            attempt['time'] = time.perf_counter() - attempt_start
+        if result.aborted and not hasattr(result, 'chisqr'):
+            # lmfit leaves the statistics of an aborted 'leastsq' fit undefined, rsr.fit.lmfit needs them
+            result.residual = np.asarray(fcn(result.params, *kws.get('args', ())))
+            result.chisqr = float(np.sum(result.residual**2))
+            result.redchi = result.chisqr / max(result.residual.size - result.nvarys, 1)
+            result.nfev = max(result.nfev, 0)
+            result.success = False
+        attempt['nfev'] = int(result.nfev)
+        attempt['aborted'] = bool(result.aborted)
+        return result
+
+    rsr.fit.minimize = recorded_minimize
+    try:
+        yield attempts
+    finally:
+        rsr.fit.minimize = minimize
+
+
+def fit_hk(powers_for_rsr, min_method, p0=None, budget_s=None):
+    """lmfit HK-fitting of the psep values of a target, as rsr.run.processor, optionally from given initial parameters
+    and within a time budget.
+
+    Args:
+        powers_for_rsr (np.ndarray): Flattened psep values of the target.
+        min_method (str): Minimization method used in the lmfit HK-fitting.
+        p0 (np.ndarray): Initial (a, s, mu), e.g. the fit of a close target. If None or not finite, the default
+            initialization of the rsr package is used (mean and standard deviation of the sample, mu = 1). Defaults to None.
+        budget_s (float): Time budget of the fit (s), after which the minimization is stopped and the fit is
+            unsuccessful (flag 0). Defaults to None (no limit).
+
+    Returns:
+        Statfit: Result of the fit.
+        dict: Telemetry of the fit : minimization method of the result ('method'), total number of function
+            evaluations ('nfev'), wall time ('time', s), number of fallbacks to another method ('fallbacks'),
+            and whether the budget was spent ('timed_out').
+    """
+    # Imported at the first fit (lmfit, matplotlib...), so that the workers of the 'moments' mode start quickly
+    import rsr
+
+    # Same steps as rsr.run.processor, the initial amplitudes being scaled as the sample
+    start = time.perf_counter()
+    amp = powers_for_rsr[powers_for_rsr > 0]
+    scale_amp = rsr.run.scale(amp)
+    amp = amp*scale_amp
+    if p0 is not None and np.all(np.isfinite(p0)) and p0[0] > 0 and p0[1] > 0:
+        # Bounds of the parameters in rsr.fit.lmfit
+        p0 = {'a': float(np.clip(p0[0]*scale_amp, 1e-6, 1)), 's': float(np.clip(p0[1]*scale_amp, 1e-6, 1)),
+              'mu': float(np.clip(p0[2], MU_MIN, MU_MAX))}
+    else:
+        p0 = None
+    with fit_telemetry(budget_s) as attempts:
+        f = rsr.fit.lmfit(np.abs(amp), bins='stone', fit_model='hk', min_method=min_method, p0=p0)
+    f.sample = amp/scale_amp
+    f.values['a'] = f.values['a']/scale_amp
+    f.values['s'] = f.values['s']/scale_amp
+    f.values['ID'] = -1
+
+    elapsed = time.perf_counter() - start
+    telemetry = {'method': attempts[-1]['method'] if attempts else None, 'nfev': sum(a.get('nfev', 0) for a in attempts),
+                 'time': elapsed, 'fallbacks': max(len(attempts) - 1, 0),
+                 'timed_out': budget_s is not None and elapsed > budget_s and any(a.get('aborted') for a in attempts)}
+    return f, telemetry
+
+
+def fit_telemetry_summary(csv_files, nb_slowest=10):
+    """Summary of the fit telemetry of rsr_results files (cf apply_rsr_batch), to find the slow targets.
+
+    Args:
+        csv_files (list): Paths of the rsr_results csv files.
+        nb_slowest (int, optional): Number of slowest lmfit fits to list. Defaults to 10.
+
+    Returns:
+        dict: Number of results by method ('methods'), number of lmfit fits ('nb_fits'), of fits with
+            fallbacks ('nb_fallbacks') and of fits which spent their budget ('nb_timed_out'), percentiles
+            of the wall time of the lmfit fits ('time_p50', 'time_p90', 'time_p99', 'time_max', s), and the
+            slowest fits ('slowest', with their target and telemetry).
+    """
+    methods, fits = {}, []
+    for csv_file in csv_files:
+        with open(csv_file, 'r', newline='') as f:
+            for row in csv.DictReader(f):
+                info = json.loads(row['fit_info']) if row.get('fit_info') else None
+                method = info['method'] if info else None
+                methods[str(method)] = methods.get(str(method), 0) + 1
+                if info and 'nfev' in info:
+                    fits.append(dict(info, lat=float(row['lat']), lon=float(row['lon'])))
+
+    summary = {'methods': methods, 'nb_fits': len(fits),
+               'nb_fallbacks': sum(fit['fallbacks'] > 0 for fit in fits),
+               'nb_timed_out': sum(fit['timed_out'] for fit in fits)}
+    if fits:
+        times = np.array([fit['time'] for fit in fits])
+        summary.update({'time_p50': float(np.percentile(times, 50)), 'time_p90': float(np.percentile(times, 90)),
+                        'time_p99': float(np.percentile(times, 99)), 'time_max': float(times.max())})
+        summary['slowest'] = sorted(fits, key=lambda fit: fit['time'], reverse=True)[:nb_slowest]
+    return summary
+
+
+def gather_powers(powers_2D_array, indices_list):
+    """Gather the psep values of several neighborhoods in a 2D array, one row per neighborhood.
+
+    Args:
+        powers_2D_array (np.ndarray): 2D array of psep values.
+        indices_list (list): Arrays of burst row indices, one per neighborhood.
+
+    Returns:
+        np.ndarray: Array of shape (len(indices_list), max_nb_bursts*64), padded with NaN.
+    """
+    nb_values = powers_2D_array.shape[1]
+    max_nb_bursts = max(len(indices) for indices in indices_list)
+    powers = np.full((len(indices_list), max_nb_bursts * nb_values), np.nan)
+    for i, indices in enumerate(indices_list):
+        powers[i, :len(indices) * nb_values] = powers_2D_array[indices].ravel()
+    return powers
+
+
+def target_rng(seed, latlon_target):
+    """Random generator of the bootstrap of a target, seeded by the seed and the coordinates of the target (to the microdegree).
+
+    Args:
+        seed (int): Seed of the bootstrap (bootstrap_seed).
+        latlon_target (np.ndarray): Latitude and longitude of the target.
+
+    Returns:
+        np.random.Generator: The random generator.
+    """
+    lat, lon = latlon_target
+    return np.random.default_rng((seed, int(round((lat + 90) * 1e6)), int(round((lon % 360) * 1e6))))
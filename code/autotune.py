@@ -0,0 +1,325 @@
+from run_stats import snapshot, add_summary
+from datetime import datetime, timezone
+import json
+import os
+import shutil
+import time
+
+
+# Settings of the stages, tuned in auto mode, saved in path/autotune.json to be pinned in the next runs
+AUTOTUNE_NAME = "autotune.json"
+
+# Memory of a worker process (bytes) when it cannot be measured : PSEP extraction (numpy, netCDF4, Numba
+# kernels) and RSR (rsr and lmfit imports, neighborhoods being fitted, cf rsr_blocks.WORKER_MEMORY)
+EXTRACTION_WORKER_MEMORY = 150e6
+RSR_WORKER_MEMORY = 250e6
+
+# Fractions of the available memory and of the free disk space that the workers and the batches may use
+MEMORY_HEADROOM = 0.8
+DISK_HEADROOM = 0.5
+
+# Minimum relative gain of throughput to keep a larger setting
+MIN_GAIN = 0.1
+
+# Maximum factor of the number of products per batch from a batch to the next one
+MAX_BATCH_GROWTH = 4
+
+# Stages run by the PSEP extraction workers, whose time is the busy time of the workers
+EXTRACTION_WORKER_STAGES = ('netcdf_read', 'fft', 'psep_window')
+
+
+def available_cpus():
+    """Number of CPUs the process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def memory_info():
+    """Total and available memory (bytes), from /proc/meminfo ((None, None) if it cannot be read)."""
+    try:
+        with open("/proc/meminfo", 'r') as f:
+            info = {line.split(':')[0]: int(line.split()[1]) * 1024 for line in f}
+        return info['MemTotal'], info['MemAvailable']
+    except (OSError, KeyError, ValueError, IndexError):
+        return None, None
+
+
+def cpu_times():
+    """Busy and total CPU time of the system since boot (clock ticks), from /proc/stat (None if it cannot be read)."""
+    try:
+        with open("/proc/stat", 'r') as f:
+            values = [int(value) for value in f.readline().split()[1:]]
+        idle = values[3] + values[4]
+        return sum(values) - idle, sum(values)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def process_rss(pid):
+    """Resident set size of a process (bytes), from /proc/<pid>/status (None if it cannot be read)."""
+    try:
+        with open(f"/proc/{pid}/status", 'r') as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def stage_delta(before, after, name):
+    """Difference of the statistics of a stage between two snapshots of run_stats ({} if it did not run)."""
+    stats_before = before['stages'].get(name, {})
+    return {counter: value - stats_before.get(counter, 0) for counter, value in after['stages'].get(name, {}).items()}
+
+
+def read_tuned_settings(path, stage_name):
+    """Settings of a stage tuned by a previous run in auto mode (path/autotune.json), to be given to the stage
+    to pin them, e.g. extract_psep(path, year, month, **read_tuned_settings(path, 'extract_psep')).
+
+    Returns:
+        dict: Keyword arguments of the stage ({} if the stage was not tuned).
+    """
+    filename = os.path.join(path, AUTOTUNE_NAME)
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, 'r') as f:
+        return json.load(f).get(stage_name, {}).get('settings', {})
+
+
+def save_tuned_settings(path, stage_name, settings, decisions):
+    """Save the settings of a stage and the decisions of the auto mode in path/autotune.json."""
+    filename = os.path.join(path, AUTOTUNE_NAME)
+    tuned = {}
+    if os.path.exists(filename):
+        with open(filename, 'r') as f:
+            tuned = json.load(f)
+    tuned[stage_name] = {'settings': settings, 'decisions': decisions, 'cpus': available_cpus(), 'memory': memory_info()[0],
+                         'time': datetime.now(timezone.utc).isoformat()}
+    with open(filename, 'w') as f:
+        json.dump(tuned, f, indent=1)
+
+
+class Setting:
+    """Integer setting tuned by hill climbing on a throughput : the setting is doubled (within its limits)
+    while the resource it drives is saturated, and set back to its previous value for good if the
+    throughput did not increase by at least MIN_GAIN."""
+
+    def __init__(self, name, value, minimum=1, maximum=None):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.value = self.clip(value)
+        self.frozen = False
+        self._previous = None   # (value, throughput) before the last increase
+
+    def clip(self, value):
+        """Value within the limits of the setting."""
+        value = max(int(value), self.minimum)
+        return min(value, self.maximum) if self.maximum is not None else value
+
+    def update(self, throughput, saturated):
+        """Next value, from the throughput measured with the current value.
+
+        Args:
+            throughput (float): Throughput measured with the current value.
+            saturated (bool): Whether the resource driven by the setting is saturated, so that a larger value may help.
+
+        Returns:
+            str: Reason of the change, or None if the value did not change.
+        """
+        if self.frozen:
+            return None
+        if self._previous is not None:
+            previous_value, previous_throughput = self._previous
+            self._previous = None
+            if throughput < previous_throughput * (1 + MIN_GAIN):
+                self.value, self.frozen = previous_value, True
+                return f"{throughput:.3g}/s, less than {MIN_GAIN:.0%} above {previous_throughput:.3g}/s with {previous_value}"
+        if saturated and (self.maximum is None or self.value < self.maximum):
+            self._previous = (self.value, throughput)
+            self.value = self.clip(self.value * 2)
+            return f"{throughput:.3g}/s with a saturated resource"
+        return None
+
+
+class ExtractionTuner:
+    """Auto mode of extract_psep : tunes the number of worker processes, the number of FTP connections and the
+    number of products per batch from the measures of the first batches.
+
+    After each batch, the tuner reads the statistics of the batch (cf run_stats) and of the system :
+    - nb_workers is doubled while the workers are busy more than 80% of the extraction time and the CPUs are
+      not saturated, as long as the extraction throughput (bursts/s) increases, within the available CPUs and
+      the memory available for the workers (MEMORY_HEADROOM, with the measured memory of the workers);
+    - nb_connections is doubled while the download takes more than 20% of the batch, as long as the download
+      bandwidth increases, up to max_connections;
+    - nb_files_per_batch is set so that a batch lasts about target_batch_s (at most MAX_BATCH_GROWTH times the
+      previous batch), within its limits and DISK_HEADROOM of the free disk space for the downloaded products.
+    Each change is printed and recorded with its measures. After nb_tuning_batches batches, the settings
+    are kept for the rest of the run, and saved in path/autotune.json (cf read_tuned_settings).
+    """
+
+    def __init__(self, path, nb_workers=8, nb_connections=1, nb_files_per_batch=5, max_workers=None, max_connections=8,
+                 min_files_per_batch=1, max_files_per_batch=500, target_batch_s=600., nb_tuning_batches=5):
+        """
+        Args:
+            path (str): The path to the work directory.
+            nb_workers (int, optional): Initial number of worker processes. Defaults to 8.
+            nb_connections (int, optional): Initial number of FTP connections. Defaults to 1.
+            nb_files_per_batch (int, optional): Initial number of products per batch. Defaults to 5.
+            max_workers (int, optional): Maximum number of worker processes. Defaults to None (number of available CPUs).
+            max_connections (int, optional): Maximum number of FTP connections. Defaults to 8.
+            min_files_per_batch (int, optional): Minimum number of products per batch. Defaults to 1.
+            max_files_per_batch (int, optional): Maximum number of products per batch. Defaults to 500.
+            target_batch_s (float, optional): Target duration of a batch (s). Defaults to 600.
+            nb_tuning_batches (int, optional): Number of batches during which the settings are tuned. Defaults to 5.
+        """
+        self.path = path
+        self.max_workers = max_workers or available_cpus()
+        self.workers = Setting('nb_workers', nb_workers, maximum=self.max_workers)
+        self.connections = Setting('nb_connections', nb_connections, maximum=max_connections)
+        self.min_files_per_batch, self.max_files_per_batch = min_files_per_batch, max_files_per_batch
+        self.nb_files_per_batch = min(max(nb_files_per_batch, min_files_per_batch), max_files_per_batch)
+        self.target_batch_s = target_batch_s
+        self.nb_tuning_batches = nb_tuning_batches
+        self.nb_batches = 0
+        self.decisions = []
+        if self.workers.value != nb_workers:
+            self.log('nb_workers', nb_workers, self.workers.value, f"{self.max_workers} CPUs available", {})
+
+    @property
+    def tuning(self):
+        """Whether the settings are still tuned."""
+        return self.nb_batches < self.nb_tuning_batches
+
+    def settings(self):
+        """Current settings, as keyword arguments of extract_psep."""
+        return {'nb_workers': self.workers.value, 'nb_connections': self.connections.value, 'nb_files_per_batch': self.nb_files_per_batch}
+
+    def log(self, name, old_value, new_value, reason, measures):
+        """Print and record a change of setting."""
+        print(f"Auto mode, batch {self.nb_batches}: {name} {old_value} -> {new_value} ({reason})")
+        self.decisions.append({'batch': self.nb_batches, 'setting': name, 'from': old_value, 'to': new_value,
+                               'reason': reason, 'measures': measures})
+
+    def start_batch(self):
+        """Start the measures of a batch."""
+        self._snapshot = snapshot()
+        self._cpu_times = cpu_times()
+        self._start = time.perf_counter()
+
+    def end_batch(self, nb_files, worker_pids=()):
+        """Measure a batch and update the settings.
+
+        Args:
+            nb_files (int): Number of products of the batch.
+            worker_pids (list, optional): Pids of the worker processes, to measure their memory. Defaults to ().
+
+        Returns:
+            dict: Settings for the next batch.
+        """
+        wall_time = time.perf_counter() - self._start
+        after = snapshot()
+        download = stage_delta(self._snapshot, after, 'download')
+        extraction = stage_delta(self._snapshot, after, 'extract_product')
+        worker_time = sum(stage_delta(self._snapshot, after, name).get('time', 0.) for name in EXTRACTION_WORKER_STAGES)
+        cpu_after = cpu_times()
+        cpu_utilization = None
+        if self._cpu_times is not None and cpu_after is not None and cpu_after[1] > self._cpu_times[1]:
+            cpu_utilization = (cpu_after[0] - self._cpu_times[0]) / (cpu_after[1] - self._cpu_times[1])
+        _, available_memory = memory_info()
+        worker_memory = max([rss for rss in map(process_rss, worker_pids) if rss is not None] or [EXTRACTION_WORKER_MEMORY])
+
+        extraction_time = extraction.get('time', 0.)
+        # Wall time of the downloads, the time of the 'download' stage being summed over the connections
+        download_time = stage_delta(self._snapshot, after, 'download_batch').get('time', 0.)
+        measures = {'wall_time': wall_time, 'nb_files': nb_files,
+                    'download_time': download_time, 'download_bytes_per_s': download.get('bytes', 0) / download_time if download_time > 0 else None,
+                    'extraction_time': extraction_time, 'bursts_per_s': extraction.get('bursts', 0) / extraction_time if extraction_time > 0 else None,
+                    'worker_utilization': worker_time / (self.workers.value * extraction_time) if extraction_time > 0 else None,
+                    'cpu_utilization': cpu_utilization, 'available_memory': available_memory, 'worker_memory': worker_memory}
+        self.nb_batches += 1
+        if self.nb_batches > self.nb_tuning_batches:
+            return self.settings()
+
+        # Worker processes, within the CPUs and the memory available for them (the current workers included)
+        old_value = self.workers.value
+        if available_memory is not None:
+            self.workers.maximum = max(1, min(self.max_workers, int(MEMORY_HEADROOM * (available_memory + old_value * worker_memory) / worker_memory)))
+        if measures['bursts_per_s'] is not None:
+            saturated = measures['worker_utilization'] > 0.8 and (cpu_utilization is None or cpu_utilization < 0.9)
+            reason = self.workers.update(measures['bursts_per_s'], saturated)
+            if reason is not None:
+                self.log('nb_workers', old_value, self.workers.value, f"extraction {reason.replace('/s', ' bursts/s')}", measures)
+        if self.workers.value > self.workers.maximum:
+            self.workers.value = self.workers.maximum
+            self.log('nb_workers', old_value, self.workers.value, f"memory available for {self.workers.maximum} workers of {worker_memory/1e6:.0f} MB", measures)
+
+        # FTP connections
+        old_value = self.connections.value
+        if measures['download_bytes_per_s'] is not None:
+            reason = self.connections.update(measures['download_bytes_per_s'] / 1e6, download_time > 0.2 * wall_time)
+            if reason is not None:
+                self.log('nb_connections', old_value, self.connections.value, f"download {reason.replace('/s', ' MB/s')}", measures)
+
+        # Products per batch, for the target duration and within the free disk space
+        old_value = self.nb_files_per_batch
+        nb_files_per_batch = round(self.target_batch_s * nb_files / wall_time) if wall_time > 0 else old_value
+        nb_files_per_batch = min(nb_files_per_batch, MAX_BATCH_GROWTH * old_value)
+        reason = f"{wall_time / max(nb_files, 1):.1f} s per product for batches of {self.target_batch_s:.0f} s"
+        if download.get('bytes', 0) > 0:
+            file_size = download['bytes'] / download.get('files', nb_files)
+            max_files_disk = int(DISK_HEADROOM * shutil.disk_usage(self.path).free / file_size)
+            if max_files_disk < nb_files_per_batch:
+                nb_files_per_batch = max_files_disk
+                reason = f"free disk space for {max_files_disk} products of {file_size/1e6:.0f} MB"
+        self.nb_files_per_batch = min(max(nb_files_per_batch, self.min_files_per_batch), self.max_files_per_batch)
+        if self.nb_files_per_batch != old_value:
+            self.log('nb_files_per_batch', old_value, self.nb_files_per_batch, reason, measures)
+
+        if not self.tuning:
+            print(f"Auto mode: settings kept for the next batches {self.settings()}")
+        self.save()
+        return self.settings()
+
+    def save(self):
+        """Save the current settings and the decisions in path/autotune.json and in the run report."""
+        save_tuned_settings(self.path, 'extract_psep', self.settings(), self.decisions)
+        add_summary('autotune', {'settings': self.settings(), 'decisions': self.decisions})
+
+
+def rsr_nb_cores(nb_cores, bytes_per_worker=0, max_cores=None, memory_budget=None):
+    """Number of RSR worker processes for the available CPUs and memory (auto mode of apply_rsr_arctic).
+
+    The requested number is only lowered, to the available CPUs and to the workers fitting within MEMORY_HEADROOM
+    of the available memory (and within memory_budget).
+
+    Args:
+        nb_cores (int): Requested number of worker processes.
+        bytes_per_worker (float, optional): Memory of the data of each worker (bytes), e.g. the PSEP sent to them. Defaults to 0.
+        max_cores (int, optional): Maximum number of worker processes. Defaults to None (number of available CPUs).
+        memory_budget (float, optional): Memory available for the workers (bytes), e.g. the part of max_memory left by the
+            main process in block mode. Defaults to None (MEMORY_HEADROOM of the available memory only).
+
+    Returns:
+        tuple: Number of worker processes, and the reason of the change (None if unchanged).
+    """
+    max_cores = max_cores or available_cpus()
+    _, available_memory = memory_info()
+    nb_cores_tuned, reason = nb_cores, None
+    if max_cores < nb_cores_tuned:
+        nb_cores_tuned, reason = max_cores, f"{max_cores} CPUs available"
+    worker_memory = RSR_WORKER_MEMORY + bytes_per_worker
+    if available_memory is not None:
+        max_cores_memory = max(1, int(MEMORY_HEADROOM * available_memory / worker_memory))
+        if max_cores_memory < nb_cores_tuned:
+            nb_cores_tuned = max_cores_memory
+            reason = f"{available_memory/1e9:.1f} GB available for workers of {worker_memory/1e6:.0f} MB"
+    if memory_budget is not None:
+        max_cores_budget = max(1, int(memory_budget / worker_memory))
+        if max_cores_budget < nb_cores_tuned:
+            nb_cores_tuned = max_cores_budget
+            reason = f"{memory_budget/1e9:.2f} GB of the memory budget for workers of {worker_memory/1e6:.0f} MB"
+    return nb_cores_tuned, reason
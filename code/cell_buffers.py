@@ -0,0 +1,398 @@
+from utils import arctic_grid
+from extraction_manifest import ExtractionManifest
+from spatial_index import xy_to_latlon
+from run_stats import stage, run_instrumented, collect, reset, write_report, report_filename, add_summary
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import math
+import os
+import numpy as np
+import pandas as pd
+
+
+# Corner of the EPSG:3413 zone of the Arctic grid (in meters), cf arctic_grid
+X_MIN, Y_MIN = -2500000, -2500000
+X_MAX = 2500000
+
+# Directory of the cell buffers, in the psep directory
+CELL_BUFFERS_DIR = "cell_buffers"
+
+# Records of the tile files : the bursts (product index in products.txt, burst index in the product,
+# EPSG:3413 coordinates and PSEP), and the assignments of the bursts to the grid cells (index of the
+# cell in the square grid of the EPSG:3413 zone, row of the burst in the bursts file of the tile)
+BURST_DTYPE = np.dtype([('product', '<i4'), ('burst', '<i4'), ('x', '<f8'), ('y', '<f8'), ('psep', '<f4', (64,))])
+ASSIGNMENT_DTYPE = np.dtype([('cell', '<i8'), ('row', '<i8')])
+
+
+class CellBuffers:
+    """On-disk buffers of the PSEP bursts of each cell of the Arctic grid, filled during the extraction.
+
+    Each burst is assigned to the grid cells within radius_km, and appended to the files of the tiles
+    (squares of tile_km, cf rsr_tiles.tile_ids) of these cells, once per tile :
+    psep/cell_buffers/<tile_id>.bursts (BURST_DTYPE records) and psep/cell_buffers/<tile_id>.cells
+    (ASSIGNMENT_DTYPE records). The neighborhood of a cell is then read from the files of its tile
+    only, without loading the other bursts of the month nor building a spatial index (cf fit_cell_buffers).
+    The files are only appended to : the bursts of the products which are extracted again (failed or
+    interrupted extraction) are left out when the buffers are read. The products extracted before the
+    buffers were enabled are added from the PSEP csv files (cf backfill).
+    """
+
+    def __init__(self, psep_dir, step_km=10, lat_min=72, radius_km=50., tile_km=500):
+        """
+        Args:
+            psep_dir (str): Path to the directory of the PSEP csv files.
+            step_km (int, optional): The distance between grid points in kilometers. Defaults to 10.
+            lat_min (float, optional): The minimum latitude for the grid (deg). Defaults to 72.
+            radius_km (float, optional): Distance up to which a burst is assigned to a cell (km). Defaults to 50.
+            tile_km (float, optional): Size of the tiles (km). Defaults to 500.
+
+        Raises:
+            ValueError: If the buffers of the directory were filled with other parameters.
+        """
+        self.directory = os.path.join(psep_dir, CELL_BUFFERS_DIR)
+        self.parameters = {'step_km': step_km, 'lat_min': lat_min, 'radius_km': radius_km, 'tile_km': tile_km}
+        os.makedirs(self.directory, exist_ok=True)
+        parameters_filename = os.path.join(self.directory, "cell_buffers.json")
+        if os.path.exists(parameters_filename):
+            with open(parameters_filename, 'r') as f:
+                parameters = json.load(f)
+            if parameters != self.parameters:
+                raise ValueError(f"The cell buffers of {self.directory} were filled with other parameters ({parameters}), remove them first")
+        else:
+            with open(parameters_filename, 'w') as f:
+                json.dump(self.parameters, f, indent=1)
+
+        self.step = step_km * 1000
+        self.tile_size = tile_km * 1000
+        self.radius = radius_km * 1000
+        self.nb_columns = int(round((X_MAX - X_MIN) / self.step)) + 1
+        # Cells of the Arctic grid (north of lat_min), by row (y) and column (x)
+        _, xy_grid = arctic_grid(step_km=step_km, lat_min=lat_min, return_xy=True)
+        ij_grid = np.rint((xy_grid - (X_MIN, Y_MIN)) / self.step).astype(np.int64)
+        self.in_grid = np.zeros((self.nb_columns, self.nb_columns), dtype=bool)
+        self.in_grid[ij_grid[:, 1], ij_grid[:, 0]] = True
+        # Offsets of the candidate cells around the cell below and left of a burst
+        nb_offsets = math.ceil(self.radius / self.step)
+        offsets = np.arange(-nb_offsets, nb_offsets + 2)
+        self.offsets = np.stack(np.meshgrid(offsets, offsets), axis=-1).reshape(-1, 2)
+
+        self.products_filename = os.path.join(self.directory, "products.txt")
+        self.products = read_products(self.directory)
+
+    def product_index(self, product):
+        """Index of a product in products.txt, where it is added at its first extraction."""
+        if product not in self.products:
+            with open(self.products_filename, 'a') as f:
+                f.write(product + '\n')
+            self.products[product] = len(self.products)
+        return self.products[product]
+
+    def backfill(self):
+        """Add the products recorded as extracted in the manifest but missing from the buffers (e.g. extracted before
+        the buffers were enabled), from their rows in the PSEP csv files.
+
+        The csv files only keep the bursts with a PSEP, so the bursts are numbered by their row in the product. The
+        PSEP files without product column (not in the manifest) are not added.
+
+        Returns:
+            int: Number of products added.
+        """
+        psep_dir = os.path.dirname(self.directory)
+        manifest = ExtractionManifest(psep_dir)
+        missing = sorted(product for product, record in manifest.records.items()
+                         if record['status'] == 'done' and product not in self.products)
+        for i, product in enumerate(missing):
+            print(f"Adding {product} to the cell buffers, product {i+1}/{len(missing)}")
+            record = manifest.records[product]
+            with open(os.path.join(psep_dir, record['output']), 'rb') as f:
+                f.seek(record['offset'])
+                rows = f.read(record['length']).decode().splitlines()
+            # Rows of format_psep_rows : lat,lon,x,y,product,[psep]
+            fields = [row.split(',', 5) for row in rows]
+            xy_data = np.array([(float(x), float(y)) for _, _, x, y, _, _ in fields]).reshape(-1, 2)
+            power_max_2D_vector = np.array([np.fromstring(psep.strip().strip('[]'), sep=' ') for *_, psep in fields]).reshape(len(fields), -1)
+            self.add(product, xy_data, power_max_2D_vector)
+        return len(missing)
+
+    def assign(self, xy_array):
+        """Grid cells within radius_km of each burst.
+
+        Args:
+            xy_array (np.ndarray): EPSG:3413 coordinates of the bursts (m), shape (N, 2).
+
+        Returns:
+            tuple: The burst (row of xy_array) and the cell index of each assignment.
+        """
+        base = np.floor((np.asarray(xy_array) - (X_MIN, Y_MIN)) / self.step).astype(np.int64)
+        ij = base[:, None, :] + self.offsets[None, :, :]
+        inside = np.all((ij >= 0) & (ij < self.nb_columns), axis=2)
+        distance2 = np.sum((X_MIN + ij * self.step - np.asarray(xy_array)[:, None, :])**2, axis=2)
+        valid = inside & (distance2 <= self.radius**2)
+        valid[valid] = self.in_grid[ij[valid][:, 1], ij[valid][:, 0]]
+        bursts, candidates = np.nonzero(valid)
+        cells = ij[bursts, candidates, 1] * self.nb_columns + ij[bursts, candidates, 0]
+        return bursts, cells
+
+    def tile_of_cells(self, cells):
+        """Column and row of the tile (cf rsr_tiles.tile_ids) of each cell."""
+        return (cells % self.nb_columns) * self.step // self.tile_size, (cells // self.nb_columns) * self.step // self.tile_size
+
+    def add(self, product, xy_data, power_max_2D_vector):
+        """Append the bursts of a product with a PSEP (all zeros for the bursts filtered out) to the buffers of their cells.
+
+        The product is recorded in products.txt even without burst in the grid, so that it is not added again by backfill.
+
+        Args:
+            product (str): Name of the product.
+            xy_data (np.ndarray): EPSG:3413 coordinates of the bursts of the product (m), shape (N, 2).
+            power_max_2D_vector (np.ndarray): PSEP of the bursts of the product, shape (N, 64).
+
+        Returns:
+            int: Number of assignments of bursts to cells.
+        """
+        product_index = self.product_index(product)
+        bursts = np.flatnonzero(power_max_2D_vector[:, 0] != 0)
+        burst_rows, cells = self.assign(np.asarray(xy_data)[bursts])
+        if len(cells) == 0:
+            return 0
+        tile_x, tile_y = self.tile_of_cells(cells)
+        tiles = tile_x * 2**32 + tile_y
+        order = np.argsort(tiles, kind='stable')
+        boundaries = np.flatnonzero(np.diff(tiles[order])) + 1
+        for assignments in np.split(order, boundaries):
+            tile_id = f"{tile_x[assignments[0]]}_{tile_y[assignments[0]]}"
+            tile_bursts, rows = np.unique(burst_rows[assignments], return_inverse=True)
+            records = np.zeros(len(tile_bursts), dtype=BURST_DTYPE)
+            records['product'] = product_index
+            records['burst'] = bursts[tile_bursts]
+            records['x'], records['y'] = np.asarray(xy_data)[bursts[tile_bursts]].T
+            records['psep'] = power_max_2D_vector[bursts[tile_bursts]]
+            first_row = append_records(os.path.join(self.directory, tile_id + ".bursts"), records)
+
+            tile_assignments = np.zeros(len(assignments), dtype=ASSIGNMENT_DTYPE)
+            tile_assignments['cell'] = cells[assignments]
+            tile_assignments['row'] = first_row + rows.ravel()
+            append_records(os.path.join(self.directory, tile_id + ".cells"), tile_assignments)
+        return len(cells)
+
+
+def append_records(filename, records):
+    """Append records to a binary file, after its last complete record.
+
+    Returns:
+        int: Index of the first appended record in the file.
+    """
+    with open(filename, 'ab') as f:
+        size = f.tell()
+        if size % records.dtype.itemsize != 0:
+            # Record truncated by a crash
+            size -= size % records.dtype.itemsize
+            f.truncate(size)
+        records.tofile(f)
+    return size // records.dtype.itemsize
+
+
+def read_products(directory):
+    """Index of each product of the cell buffers (products.txt)."""
+    products_filename = os.path.join(directory, "products.txt")
+    if not os.path.exists(products_filename):
+        return {}
+    with open(products_filename, 'r') as f:
+        return {product.strip(): i for i, product in enumerate(f) if product.strip()}
+
+
+def buffer_tiles(directory):
+    """Ids of the tiles of the cell buffers, and the number of burst records of each one."""
+    return {f[:-len(".bursts")]: os.path.getsize(os.path.join(directory, f)) // BURST_DTYPE.itemsize
+            for f in sorted(os.listdir(directory)) if f.endswith(".bursts")}
+
+
+def cell_xy(cells, step_km=10):
+    """EPSG:3413 coordinates of grid cells (m), from their index in the square grid of the EPSG:3413 zone."""
+    nb_columns = int(round((X_MAX - X_MIN) / (step_km * 1000))) + 1
+    return np.column_stack((X_MIN + (cells % nb_columns) * step_km * 1000,
+                            Y_MIN + (cells // nb_columns) * step_km * 1000)).astype(np.float64)
+
+
+def read_tile(directory, tile_id, step_km=10, products=None, min_bursts=200, max_bursts=1000, max_distance_km=10):
+    """Read the neighborhoods of the cells of a tile from the cell buffers.
+
+    The bursts of the products which are not given (e.g. not recorded as extracted in the manifest), and the bursts
+    appended again to a cell (product extracted again), are left out. As in apply_rsr, the cells without burst within
+    max_distance_km (cf utils.is_ice) are left out. As in the 'radius' mode of find_neighborhoods, the cells with less
+    than min_bursts bursts are left out too, and the neighborhoods with more than max_bursts bursts are subsampled
+    evenly in the order of the extraction (i.e. along the tracks) down to max_bursts.
+
+    Args:
+        directory (str): Directory of the cell buffers.
+        tile_id (str): Id of the tile.
+        step_km (int, optional): Step of the Arctic grid of the cell buffers (km). Defaults to 10.
+        products (set, optional): Indices of the products to read (cf read_products). Defaults to None (all of them).
+        min_bursts (int, optional): Minimum number of bursts of a cell. Defaults to 200.
+        max_bursts (int, optional): Maximum number of bursts of a cell. Defaults to 1000.
+        max_distance_km (float, optional): Maximum distance of the closest burst of a cell (km). Defaults to 10.
+
+    Returns:
+        tuple: The cell indices, the burst rows of their neighborhoods (list of arrays), and the bursts of the tile (BURST_DTYPE records).
+    """
+    bursts = np.fromfile(os.path.join(directory, tile_id + ".bursts"), dtype=BURST_DTYPE,
+                         count=os.path.getsize(os.path.join(directory, tile_id + ".bursts")) // BURST_DTYPE.itemsize)
+    assignments = np.fromfile(os.path.join(directory, tile_id + ".cells"), dtype=ASSIGNMENT_DTYPE,
+                              count=os.path.getsize(os.path.join(directory, tile_id + ".cells")) // ASSIGNMENT_DTYPE.itemsize)
+    # Assignments of bursts whose record was not written (interrupted extraction)
+    assignments = assignments[assignments['row'] < len(bursts)]
+
+    if products is not None:
+        keep = np.isin(bursts['product'], np.fromiter(products, dtype=np.int64, count=len(products)))
+        assignments = assignments[keep[assignments['row']]]
+
+    # First assignment of each burst to each cell (the bursts appended again have other rows)
+    burst_keys = bursts['product'].astype(np.int64)[assignments['row']] * 2**32 + bursts['burst'][assignments['row']]
+    order = np.lexsort((assignments['row'], burst_keys, assignments['cell']))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (np.diff(assignments['cell'][order]) != 0) | (np.diff(burst_keys[order]) != 0)
+    assignments = assignments[order[first]]
+
+    order = np.lexsort((assignments['row'], assignments['cell']))
+    cells, starts = np.unique(assignments['cell'][order], return_index=True)
+    neighborhoods = np.split(assignments['row'][order], starts[1:])
+    xy_cells = cell_xy(cells, step_km)
+    selected_cells, selected_neighborhoods = [], []
+    for cell, xy_cell, rows in zip(cells, xy_cells, neighborhoods):
+        if len(rows) < min_bursts:
+            continue
+        if np.min((bursts['x'][rows] - xy_cell[0])**2 + (bursts['y'][rows] - xy_cell[1])**2) > (max_distance_km * 1000)**2:
+            continue
+        if len(rows) > max_bursts:
+            rows = rows[np.linspace(0, len(rows) - 1, max_bursts).round().astype(np.int64)]
+        selected_cells.append(cell)
+        selected_neighborhoods.append(rows)
+    return np.array(selected_cells, dtype=np.int64), selected_neighborhoods, bursts
+
+
+def fit_tile(directory, tile_id, tile_index, products, output_filename, step_km=10, min_bursts=200, max_bursts=1000, max_distance_km=10, bootstrap_resamples=0, **kwargs):
+    """Apply RSR to the cells of a tile of the cell buffers, and save the results in a csv file (cf apply_rsr_core).
+
+    Returns:
+        tuple: The number of cells fitted and of bursts read.
+    """
+    # Imported by the workers only (rsr, lmfit), so that the extraction does not import them with CellBuffers
+    from apply_rsr import apply_rsr_batch, write_rsr_results
+
+    with stage('read_cell_buffers', tiles=1) as counters:
+        cells, neighborhoods, bursts = read_tile(directory, tile_id, step_km, products, min_bursts=min_bursts, max_bursts=max_bursts,
+                                                 max_distance_km=max_distance_km)
+        counters['bursts'] = len(bursts)
+    xy_cells = cell_xy(cells, step_km)
+    latlon_cells = xy_to_latlon(xy_cells) if len(cells) > 0 else np.empty((0, 2))
+    print(f"Tile {tile_id}: {len(cells)} cells with at least {min_bursts} bursts")
+
+    results = []
+    powers_2D_array = bursts['psep']
+    for i in range(0, len(cells), 1000):
+        results.extend(apply_rsr_batch(latlon_cells[i:i+1000], xy_cells[i:i+1000], None, powers_2D_array, tile_index, i // 1000, len(cells),
+                                       neighborhoods=neighborhoods[i:i+1000], bootstrap_resamples=bootstrap_resamples, **kwargs))
+    write_rsr_results(output_filename, results, bootstrap_resamples)
+    return len(cells), len(bursts)
+
+
+def fit_cell_buffers(path, nb_cores=8, tiles=None, refit=False, run_report=True, **kwargs):
+    """Apply RSR to the Arctic grid from the cell buffers filled during the extraction (cf CellBuffers).
+
+    The tiles are fitted in parallel, each worker reading the bursts of its tile only. Only the products recorded
+    as extracted in the manifest are read, so the tiles can be fitted while the extraction is still running : the
+    tiles whose buffers did not grow since their last fit are skipped at the next run (unless refit).
+
+    The results of a tile are saved in path/cells/rsr_results_tile_<id>.csv (columns of the rsr_results files),
+    and the results of all the tiles are merged in path/rsr_results_cells.csv. The parameters of the fits, and the
+    number of burst records, products and cells of each tile fitted are recorded in path/cells/cells.json.
+
+    Args:
+        path (str): Path to the data directory.
+        nb_cores (int, optional): Number of CPU cores to use for processing. Defaults to 8.
+        tiles (list, optional): Ids of the tiles to fit. Defaults to None (all the tiles of the buffers).
+        refit (bool, optional): Whether to fit the tiles again even if their buffers did not grow. Defaults to False.
+        run_report (bool, optional): Whether to save the duration and throughput of each stage in path/cells/reports/fit_cell_buffers_<date>.json. Defaults to True.
+        **kwargs: Additional keyword arguments for read_tile and apply_rsr_batch (min_bursts, max_bursts, fit_mode...).
+    """
+    from apply_rsr import fit_telemetry_summary
+
+    reset('fit_cell_buffers')
+    psep_dir = os.path.join(path, "psep")
+    directory = os.path.join(psep_dir, CELL_BUFFERS_DIR)
+    with open(os.path.join(directory, "cell_buffers.json"), 'r') as f:
+        parameters = json.load(f)
+    cells_dir = os.path.join(path, "cells")
+    os.makedirs(cells_dir, exist_ok=True)
+    state_filename = os.path.join(cells_dir, "cells.json")
+    state = {'tiles': {}}
+    if os.path.exists(state_filename):
+        with open(state_filename, 'r') as f:
+            state = json.load(f)
+
+    # Products recorded as extracted, the others being extracted again or still being extracted
+    product_indices = read_products(directory)
+    done_products = ExtractionManifest(psep_dir).done_products()
+    products = {product_indices[product] for product in done_products if product in product_indices}
+    fit_parameters = json.loads(json.dumps(kwargs, sort_keys=True, default=str))
+
+    available_tiles = buffer_tiles(directory)
+    if tiles is not None:
+        unknown = [tile_id for tile_id in tiles if tile_id not in available_tiles]
+        if unknown:
+            raise ValueError(f"No cell buffers for the tiles {unknown} in {directory}. Available tiles: {list(available_tiles)}")
+    if state.get('parameters') != fit_parameters:
+        state = {'parameters': fit_parameters, 'tiles': {}}
+    tiles_to_fit = [tile_id for tile_id in (tiles if tiles is not None else available_tiles)
+                    if refit or tile_id not in state['tiles'] or state['tiles'][tile_id]['nb_records'] != available_tiles.get(tile_id)
+                    or state['tiles'][tile_id]['nb_products'] != len(products)]
+    print(f"Tiles to fit: {len(tiles_to_fit)} / {len(available_tiles)} ({len(products)} products extracted)")
+
+    # Largest tiles first, so that the workers finish at the same time
+    tiles_to_fit.sort(key=lambda tile_id: -available_tiles.get(tile_id, 0))
+    with ProcessPoolExecutor(max_workers=nb_cores) as executor:
+        # The index of a tile among the tiles of the buffers identifies it in the worker (e.g. seed of the bootstrap)
+        futures = {tile_id: executor.submit(run_instrumented, fit_tile, directory, tile_id, list(available_tiles).index(tile_id), products,
+                                            os.path.join(cells_dir, f"rsr_results_tile_{tile_id}.csv"),
+                                            step_km=parameters['step_km'], **kwargs)
+                   for tile_id in tiles_to_fit}
+        for tile_id, future in futures.items():
+            nb_cells, nb_bursts = collect(future)
+            state['tiles'][tile_id] = {'nb_records': available_tiles[tile_id], 'nb_products': len(products),
+                                       'nb_cells': nb_cells, 'nb_bursts': nb_bursts}
+            with open(state_filename, 'w') as f:
+                json.dump(state, f, indent=1, default=str)
+
+    csv_files = [os.path.join(cells_dir, f"rsr_results_tile_{tile_id}.csv") for tile_id in state['tiles']]
+    summary = fit_telemetry_summary(csv_files)
+    add_summary('fit_telemetry', summary)
+    with stage('merge_results', tiles=len(csv_files)):
+        results = [pd.read_csv(csv_file) for csv_file in csv_files]
+        results = pd.concat(results, ignore_index=True) if results else pd.DataFrame(columns=['lat', 'lon', 'value', 'power', 'crl', 'flag', 'fit_info'])
+        results.to_csv(os.path.join(path, "rsr_results_cells.csv"), index=False)
+    print(f"{len(results)} results from {len(csv_files)} tiles merged in {os.path.join(path, 'rsr_results_cells.csv')}")
+
+    if run_report:
+        write_report(report_filename(cells_dir, 'fit_cell_buffers'))
+
+
+if __name__ == "__main__":
+    """
+    RSR of the Arctic grid from the cell buffers filled by extract_psep(..., cell_buffers=True) :
+        python cell_buffers.py PATH [--nb-cores 8] [--tiles 3_4 3_5 ...] [--fit-mode moments] [--refit]
+    Can be run while the extraction is running, to fit the cells of the products already extracted.
+    """
+
+    parser = argparse.ArgumentParser(description="RSR of the Arctic grid from the cell buffers")
+    parser.add_argument("path", help="Path to the data directory")
+    parser.add_argument("--nb-cores", type=int, default=8)
+    parser.add_argument("--tiles", nargs="+", help="Ids of the tiles to fit (default: all)")
+    parser.add_argument("--fit-mode", default='full', choices=['full', 'moments', 'tiered'])
+    parser.add_argument("--min-bursts", type=int, default=200)
+    parser.add_argument("--max-bursts", type=int, default=1000)
+    parser.add_argument("--refit", action="store_true", help="Fit the tiles again even if their buffers did not grow")
+    args = parser.parse_args()
+
+    fit_cell_buffers(args.path, nb_cores=args.nb_cores, tiles=args.tiles, refit=args.refit, fit_mode=args.fit_mode,
+                     min_bursts=args.min_bursts, max_bursts=args.max_bursts)
@@ -1,9 +1,11 @@
 from ftplib import FTP
+from concurrent.futures import ThreadPoolExecutor
 import os
 import xml.etree.ElementTree as ET
+from run_stats import stage
 
 
-def find_nc_files_to_read(path,year,month,lat_min=72, username='anonymous', password='anonymous@anonymous.com', port=21, ftp_server='science-pds.cryosat.esa.int'):
+def find_nc_files_to_read(path,year,month,lat_min=72, username='anonymous', password='anonymous@anonymous.com', port=21, ftp_server='science-pds.cryosat.esa.int', **kwargs):
     """
     Downloads the header files from the SAR FBR Cryosat-2 products, 
     and write in a txt file the name of the NetCDF files to read.
@@ -38,8 +40,9 @@ def find_nc_files_to_read(path,year,month,lat_min=72, username='anonymous', pass
     for i, filename in enumerate(available_files):
         if i % 20 == 0:
             print(f"Processing header {i}/{len(available_files)}...")
-        with open(os.path.join(path, filename), 'wb') as local_file:
+        with stage('download_headers', files=1) as counters, open(os.path.join(path, filename), 'wb') as local_file:
             ftp.retrbinary(f'RETR {filename}', local_file.write)
+            counters['bytes'] = local_file.tell()
         try:
             tree = ET.parse(os.path.join(path, filename))
             root = tree.getroot()
@@ -63,7 +66,7 @@ def find_nc_files_to_read(path,year,month,lat_min=72, username='anonymous', pass
     ftp.quit()
 
 
-def download_nc_files(path, year, month, filenames, username='anonymous', password='anonymous@anonymous.com', port=21, ftp_server='science-pds.cryosat.esa.int'):
+def download_nc_files(path, year, month, filenames, username='anonymous', password='anonymous@anonymous.com', port=21, ftp_server='science-pds.cryosat.esa.int', nb_connections=1, **kwargs):
     """
     Downloads the NetCDF files for the specified year and month in the given range,
     in a new repository.
@@ -77,10 +80,28 @@ def download_nc_files(path, year, month, filenames, username='anonymous', passwo
         password (str): The password for FTP authentication.
         port (int): The port number for the FTP server.
         ftp_server (str): The address of the FTP server.
+        nb_connections (int): Number of FTP connections downloading files in parallel. Defaults to 1.
     """
 
     print(f"Starting FTP download for {year}-{month} in {path}...")
 
+    filenames = [filename.strip() for filename in filenames]
+    nb_connections = max(1, min(nb_connections, len(filenames)))
+    if nb_connections == 1:
+        _download_files(path, year, month, filenames, username, password, port, ftp_server)
+    else:
+        # Each connection downloads every nb_connections-th file
+        with ThreadPoolExecutor(max_workers=nb_connections) as executor:
+            futures = [executor.submit(_download_files, path, year, month, filenames[i::nb_connections], username, password, port, ftp_server)
+                       for i in range(nb_connections)]
+            for future in futures:
+                future.result()
+
+    print(f"All files downloaded to {path}.")
+
+
+def _download_files(path, year, month, filenames, username, password, port, ftp_server):
+    """Download files with a new FTP connection."""
     ftp = FTP()
     ftp.connect(ftp_server, port=port)
     ftp.login(username, password)
@@ -91,16 +112,14 @@ def download_nc_files(path, year, month, filenames, username='anonymous', passwo
     for i, filename in enumerate(filenames):
         if i%10 == 0:
             print(f"{i}/{len(filenames)} files downloaded")
-        filename = filename.strip()
         if filename in available_files:
             if not os.path.exists(os.path.join(path, filename)):
-                with open(os.path.join(path, filename), 'wb') as local_file:
+                with stage('download', files=1) as counters, open(os.path.join(path, filename), 'wb') as local_file:
                     ftp.retrbinary(f'RETR {filename}', local_file.write)
+                    counters['bytes'] = local_file.tell()
         else:
             print(f"file {filename} not found on FTP server.")
 
-    print(f"All files downloaded to {path}.")
-
     # Close the FTP connection
     ftp.quit()
     
@@ -1,46 +1,61 @@
 import numpy as np
 from netCDF4 import Dataset
 from lead_filter import create_lead_KDtree, lead_SeaIce_mask
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import os
-from utils import clean_csv
-from download_ftp import find_nc_files_to_read, download_nc_files, delete_nc_files
-
-
-def extract_psep(path, year, month, nb_files_per_batch=50, **kwargs):
+from extraction_manifest import ExtractionManifest, checksum, extracted_products
+from psep_kernels import psep_echoes, leading_edges
+from psep_worker import WorkerPool, extract_psep_burst
+from waveform_cache import waveform_cache_path, save_waveforms
+from utils import format_psep_rows
+from run_stats import stage, collect, reset, write_report, report_filename
+from spatial_index import latlon_to_xy
+from cell_buffers import CellBuffers
+from autotune import ExtractionTuner
+
+
+def extract_psep(path, year, month, nb_files_per_batch=50, run_report=True, cell_buffers=False, cell_step_km=10, cell_radius_km=50., cell_tile_km=500,
+                 auto_tune=False, **kwargs):
     """
     Extracts the PSEP (Peak Surface Echo Power) from each echo available in the ftp
     server for the specified year and month, in the SAR FBR product.
     
     Stores the computed PSEP in several output csv files
-    (latitude, longitude, powers[64])
+    (latitude, longitude, EPSG:3413 x, EPSG:3413 y, product, powers[64])
 
     Requirement : The uit_cryosat2_L2_alongtrack_year_month.csv file must be in the repository.
 
     For some reason, the PSEP extraction happened to fail some times (computation stopping without any error message).
-    If it happens, just relaunch the extraction : this function will not compute again or delete the PSEP already extracted.
+    If it happens, just relaunch the extraction : the extracted products are recorded in psep/manifest.jsonl, and only
+    the products which are not recorded as extracted (failed or interrupted) are extracted again.
 
     Args:
         path (str): The path to the work directory.
         year (str): The year of the products to process. (e.g. "2018")
         month (str): The month of the products to process. (e.g. "01")
         nb_files_per_batch (int): Number of files to process per batch. All the results from a batch will be stored in a single csv file. Defaults to 50.
+        run_report (bool): Whether to save the duration and throughput of each stage in path/reports/extract_psep_<date>.json. Defaults to True.
+        cell_buffers (bool): Whether to also append the bursts to the buffers of the Arctic grid cells within cell_radius_km
+            (cf cell_buffers.py), to apply RSR to the cells with fit_cell_buffers. Defaults to False.
+        cell_step_km (int): Step of the Arctic grid of the cell buffers (km). Defaults to 10.
+        cell_radius_km (float): Distance up to which a burst is assigned to a cell (km). Defaults to 50.
+        cell_tile_km (float): Size of the tiles of the cell buffers (km). Defaults to 500.
+        auto_tune (bool): Whether to tune nb_workers, nb_connections and nb_files_per_batch from the measures of the first
+            batches (cf autotune.ExtractionTuner), starting from the given values (nb_workers may be raised up to the
+            available CPUs). The decisions and the tuned settings are
+            saved in path/autotune.json, to be pinned in the next runs with autotune.read_tuned_settings. Defaults to False.
     """
+
+    reset('extract_psep')
     
     # Build KDTree for lead filter
-    csv_file_path = os.path.join(path, f"uit_cryosat2_L2_alongtrack_{year}_{month}.csv")
-    if not os.path.exists(csv_file_path):
-        txt_file_path = os.path.join(path, f"uit_cryosat2_L2_alongtrack_{year}_{month}.txt")
-        if not os.path.exists(txt_file_path):
-            raise FileNotFoundError(f"Required TXT file not found: {txt_file_path}\n You can download it from this link : https://uitno.app.box.com/s/37uuevawit4a6r8arkvmvty7o76tiqx1/folder/228797883958")
-        else :
-            os.rename(txt_file_path, csv_file_path)
-    lead_SeaIce_KDtree, lead_SeaIce_dictionary = create_lead_KDtree(csv_file_path)
+    lead_SeaIce_KDtree, lead_SeaIce_dictionary = load_lead_filter(path, year, month)
     
     
     # Create nc_files_to_read.txt if not already in the repository
     nc_files_to_read_path = os.path.join(path, "nc_files_to_read.txt")
     if not os.path.exists(nc_files_to_read_path):
+        from download_ftp import find_nc_files_to_read
         find_nc_files_to_read(path, year, month, **kwargs)
 
 
@@ -51,65 +66,158 @@ def extract_psep(path, year, month, nb_files_per_batch=50, **kwargs):
     nb_files = len(nc_files)   
 
 
-    # Extract PSEP from batches if not already done
+    # Extract PSEP from batches of the products not already extracted
     psep_dir = os.path.join(path, "psep")
     os.makedirs(psep_dir, exist_ok=True)
+    already_extracted = extracted_products(path, year, month)
+    nc_files_indices = [i for i, filename in enumerate(nc_files) if filename not in already_extracted]
+    print(f"Number of products to extract: {len(nc_files_indices)} / {nb_files}")
+    if cell_buffers:
+        kwargs['cell_buffers'] = CellBuffers(psep_dir, step_km=cell_step_km, lat_min=kwargs.get('lat_min', 72),
+                                             radius_km=cell_radius_km, tile_km=cell_tile_km)
+        # Products extracted before the buffers were enabled
+        kwargs['cell_buffers'].backfill()
+
+    tuner = None
+    if auto_tune:
+        tuner = ExtractionTuner(path, nb_workers=kwargs.get('nb_workers', 8), nb_connections=kwargs.get('nb_connections', 1),
+                                nb_files_per_batch=nb_files_per_batch)
+        kwargs.update(tuner.settings())
+        nb_files_per_batch = kwargs.pop('nb_files_per_batch')
+
+    # The same worker processes extract the bursts of all the products
+    with WorkerPool(kwargs.get('nb_workers', 8), kwargs.get('use_numba', True)) as worker_pool:
+        k = 0
+        while k < len(nc_files_indices):
+            batch_indices = nc_files_indices[k:k + nb_files_per_batch]
+            batch_files = [nc_files[i] for i in batch_indices]
+            if tuner is not None:
+                tuner.start_batch()
+            extract_psep_batch(year, month, path, batch_files, lead_SeaIce_KDtree, lead_SeaIce_dictionary, batch_indices[0],
+                               batch_name=f"{batch_indices[0]}_{batch_indices[-1] + 1}", worker_pool=worker_pool, **kwargs)
+            k += len(batch_indices)
+            if tuner is not None and tuner.tuning:
+                kwargs.update(tuner.end_batch(len(batch_files), worker_pool.worker_pids()))
+                nb_files_per_batch = kwargs.pop('nb_files_per_batch')
+                worker_pool.resize(kwargs['nb_workers'])
+
+    if run_report:
+        write_report(report_filename(path, 'extract_psep'))
     
-    for i in range(0, nb_files, nb_files_per_batch):
-        batch_files = nc_files[i:min(i + nb_files_per_batch, nb_files)]
-        output_filename = os.path.join(psep_dir, f"psep_{year}_{month}_{i}_{i + len(batch_files)}.csv")
-        if (not os.path.exists(output_filename)) or os.path.getsize(output_filename) < 10000 :
-            extract_psep_batch(year, month, path, batch_files, lead_SeaIce_KDtree, lead_SeaIce_dictionary, i, **kwargs)
-    
 
-def extract_psep_batch(year, month, path, filenames, lead_SeaIce_KDtree, lead_SeaIce_dictionary, index_first_file, **kwargs):
+def load_lead_filter(path, year, month):
+    """Build the spatial index for the lead filter from the uit_cryosat2_L2_alongtrack_year_month file.
+
+    Args:
+        path (str): The path to the work directory.
+        year (str): The year of the products to process. (e.g. "2018")
+        month (str): The month of the products to process. (e.g. "01")
+
+    Returns:
+        tuple: The spatial index and the lead/sea ice classes of its points (cf create_lead_KDtree).
+    """
+    csv_file_path = os.path.join(path, f"uit_cryosat2_L2_alongtrack_{year}_{month}.csv")
+    if not os.path.exists(csv_file_path):
+        txt_file_path = os.path.join(path, f"uit_cryosat2_L2_alongtrack_{year}_{month}.txt")
+        if not os.path.exists(txt_file_path):
+            raise FileNotFoundError(f"Required TXT file not found: {txt_file_path}\n You can download it from this link : https://uitno.app.box.com/s/37uuevawit4a6r8arkvmvty7o76tiqx1/folder/228797883958")
+        else :
+            os.rename(txt_file_path, csv_file_path)
+    return create_lead_KDtree(csv_file_path)
+
+
+def extract_psep_batch(year, month, path, filenames, lead_SeaIce_KDtree, lead_SeaIce_dictionary, index_first_file, batch_name=None, waveform_cache=False, cell_buffers=None, **kwargs):
     """
     Extracts the PSEP from a batch of NetCDF files.
 
+    The product each burst comes from is stored with it. Each product is recorded in the manifest
+    (psep/manifest.jsonl) once its rows are written, or as failed if its extraction raised an error.
+    If the output file already contains products of the manifest, the rows are appended to it.
+    If waveform_cache, the power waveforms of the filtered bursts are also kept in the waveform cache
+    (cf waveform_cache.py), to compute the PSEP again with other parameters without downloading the products.
+    If cell_buffers is given, the bursts of each product are also appended to the buffers of their grid cells.
+
     Args:
         year (str): The year of the products to process. (e.g. "2018")
         month (str): The month of the products to process. (e.g. "01")
         path (str): The path to the directory we work in.
         filenames (list): List of NetCDF filenames to process.
-        lead_SeaIce_KDtree (cKDTree): KDTree for lead/sea ice detection.
-        lead_SeaIce_dictionary (dict): Dictionary for lead/sea ice information.
+        lead_SeaIce_KDtree (SpatialIndex): Spatial index for lead/sea ice detection.
+        lead_SeaIce_dictionary (np.ndarray): Lead/sea ice classes of the points of the spatial index.
         index_first_file (int): The index of the first file in the batch.
+        batch_name (str, optional): Name of the batch, used for the output file. Defaults to "<index_first_file>_<index_last_file>".
+        waveform_cache (bool, optional): Whether to keep the power waveforms in the waveform cache. Defaults to False.
+        cell_buffers (CellBuffers, optional): Buffers of the grid cells to fill with the bursts. Defaults to None.
     """
     
+    if batch_name is None:
+        batch_name = f"{index_first_file}_{index_first_file + len(filenames)}"
+
+    from download_ftp import download_nc_files, delete_nc_files
+
     # Create a directory for the NetCDF files
-    nc_dir = os.path.join(path, f"{index_first_file}_{index_first_file + len(filenames)}")
+    nc_dir = os.path.join(path, batch_name)
     os.makedirs(nc_dir, exist_ok=True)
 
-    download_nc_files(nc_dir, year, month, filenames, **kwargs)
+    with stage('download_batch', files=len(filenames)):
+        download_nc_files(nc_dir, year, month, filenames, **kwargs)
 
-    output_filename = os.path.join(path, f"psep/psep_{year}_{month}_{index_first_file}_{index_first_file + len(filenames)}.csv")
+    output_name = f"psep_{year}_{month}_{batch_name}.csv"
+    output_filename = os.path.join(path, "psep", output_name)
+    manifest = ExtractionManifest(os.path.join(path, "psep"))
+    # Rows of an interrupted extraction, before any product was recorded
+    mode = 'ab' if output_name in manifest.output_files() else 'wb'
+    if mode == 'ab':
+        manifest.validate(outputs=[output_name])
 
-    with open(output_filename, 'w') as csvfile:
-        csvfile.write('lat,lon,psep\n')
+    with open(output_filename, mode) as csvfile:
+        if csvfile.tell() == 0:
+            csvfile.write(b'lat,lon,x,y,product,psep\n')
         for i,filename in enumerate(filenames):
             print(f'Processing file {i+1}/{len(filenames)} : {filename}')
-            with Dataset(os.path.join(nc_dir, filename), 'r') as nc:
-                lat_data = nc.variables['lat_85_ku'][:]
-                lon_data = nc.variables['lon_85_ku'][:]
-            power_max_2D_vector = extract_psep_file(os.path.join(nc_dir, filename), lead_SeaIce_KDtree, lead_SeaIce_dictionary, **kwargs)
-            for burst in range(power_max_2D_vector.shape[0]):
-                if power_max_2D_vector[burst, 0] != 0:
-                    csvfile.write(f'{lat_data[burst]},{lon_data[burst]},{power_max_2D_vector[burst, :]}\n')            
-            
+            offset = csvfile.tell()
+            try:
+                with stage('extract_product', products=1) as counters:
+                    with Dataset(os.path.join(nc_dir, filename), 'r') as nc:
+                        lat_data = nc.variables['lat_85_ku'][:]
+                        lon_data = nc.variables['lon_85_ku'][:]
+                    xy_data = latlon_to_xy(np.column_stack((lat_data, lon_data)))
+                    power_max_2D_vector = extract_psep_file(os.path.join(nc_dir, filename), lead_SeaIce_KDtree, lead_SeaIce_dictionary,
+                                                            waveform_cache_path=waveform_cache_path(path, year, month, filename) if waveform_cache else None,
+                                                            **kwargs)
+                    content, nb_rows = format_psep_rows(lat_data, lon_data, xy_data, filename, power_max_2D_vector)
+                    counters['bursts'] = nb_rows
+                with stage('write_psep', bytes=len(content)):
+                    csvfile.write(content)
+                    csvfile.flush()
+                    os.fsync(csvfile.fileno())
+                if cell_buffers is not None:
+                    with stage('cell_buffers', bursts=nb_rows) as counters:
+                        counters['assignments'] = cell_buffers.add(filename, xy_data, power_max_2D_vector)
+            except Exception as e:
+                print(f'Extraction of {filename} failed : {e!r}')
+                csvfile.truncate(offset)
+                csvfile.seek(offset)
+                manifest.record(filename, 'failed', error=repr(e))
+                continue
+            manifest.record(filename, 'done', nb_bursts=nb_rows, output=output_name,
+                            offset=offset, length=len(content), checksum=checksum(content))
+
     delete_nc_files(nc_dir, year, month, filenames)
-    
-    # Clean the csv file
-    clean_csv(output_filename)
 
 
-def extract_psep_file(filename, lead_SeaIce_KDtree, lead_SeaIce_dictionary, nb_workers=8, **kwargs):
+def extract_psep_file(filename, lead_SeaIce_KDtree, lead_SeaIce_dictionary, nb_workers=8, waveform_cache_path=None, waveform_cache_dtype='float32', worker_pool=None, **kwargs):
     """Extract PSEP from a single NetCDF file.
 
     Args:
         filename (str): Path to the NetCDF file.
-        lead_SeaIce_KDtree (KDTree): KDTree for lead/sea ice detection.
-        lead_SeaIce_dictionary (dict): Dictionary for lead/sea ice information.
-        nb_workers (int, optional): Number of worker processes. Defaults to 8.
+        lead_SeaIce_KDtree (SpatialIndex): Spatial index for lead/sea ice detection.
+        lead_SeaIce_dictionary (np.ndarray): Lead/sea ice classes of the points of the spatial index.
+        nb_workers (int, optional): Number of worker processes, if worker_pool is not provided. Defaults to 8.
+        waveform_cache_path (str, optional): If provided, the power waveforms of the filtered bursts are saved in this file. Defaults to None.
+        waveform_cache_dtype (str, optional): 'float32' or 'float16' (cf encode_waveforms). Defaults to 'float32'.
+        worker_pool (WorkerPool, optional): Worker processes shared with other products. Defaults to None (worker
+            processes started for this product only).
 
     Returns:
         np.ndarray: Array of extracted PSEP values.
@@ -130,12 +238,45 @@ def extract_psep_file(filename, lead_SeaIce_KDtree, lead_SeaIce_dictionary, nb_w
 
     # Process remaining bursts
     power_max_2D_vector = np.zeros((nb_bursts, 64))
-
-    with ProcessPoolExecutor(max_workers=nb_workers) as executor:
-        futures = [executor.submit(extract_psep_burst, burst, nb_bursts_filtered, filename, **kwargs) for burst in bursts_filtered]
-    for future in futures:
-        burst, local_power = future.result()
-        power_max_2D_vector[burst, :] = local_power
+    return_waveforms = waveform_cache_path is not None
+
+    own_pool = worker_pool is None
+    if own_pool:
+        worker_pool = WorkerPool(nb_workers, kwargs.get('use_numba', True))
+    # The waveforms are stored as the results arrive, in the cache dtype (cf encode_waveforms)
+    waveforms, scales, gains = None, None, np.zeros(nb_bursts_filtered)
+    try:
+        futures = [worker_pool.submit(extract_psep_burst, burst, nb_bursts_filtered, filename, return_waveforms=return_waveforms,
+                                      waveform_cache_dtype=waveform_cache_dtype, **kwargs) for burst in bursts_filtered]
+        for i in range(len(futures)):
+            burst, local_power, *cached = collect(futures[i])
+            futures[i] = None   # The future holds the result
+            power_max_2D_vector[burst, :] = local_power
+            if return_waveforms:
+                encoded, encoded_scales, gains[i] = cached
+                if waveforms is None:
+                    waveforms = np.empty((nb_bursts_filtered,) + encoded.shape, dtype=encoded.dtype)
+                    if encoded_scales is not None:
+                        scales = np.empty((nb_bursts_filtered,) + encoded_scales.shape, dtype=np.float32)
+                waveforms[i] = encoded
+                if scales is not None:
+                    scales[i] = encoded_scales
+    except BrokenProcessPool:
+        # A worker died : the next products are extracted by new workers
+        worker_pool.restart()
+        raise
+    finally:
+        if own_pool:
+            worker_pool.shutdown()
+
+    if return_waveforms:
+        bursts_filtered = np.asarray(bursts_filtered, dtype=np.int64)
+        if waveforms is None:
+            waveforms = np.empty((0, 64, 0), dtype=np.float16 if waveform_cache_dtype == 'float16' else np.float32)
+            scales = np.empty((0, 64), dtype=np.float32) if waveform_cache_dtype == 'float16' else None
+        with stage('save_waveforms', bursts=len(bursts_filtered)):
+            save_waveforms(waveform_cache_path, np.asarray(lat_data)[bursts_filtered], np.asarray(lon_data)[bursts_filtered], bursts_filtered,
+                           waveforms, gains, dtype=waveform_cache_dtype, scales=scales)
 
     return power_max_2D_vector
     
@@ -145,10 +286,9 @@ def filter_bursts(latlon_burst_list, lead_SeaIce_KDtree, lead_SeaIce_dictionary,
 
     Args:
         latlon_burst_list (list): List containing (latitude, longitude, burst index)
-        lead_SeaIce_KDtree (KDTree): KDTree containing all the points for which we know if it is a lead and/or sea ice
-            The points are in cartesian xyz coordinates.
-        lead_SeaIce_dictionary (dict): Dictionary mapping cartesian coordinates to lead/Sea ice information for each
-            point in the KDtree
+        lead_SeaIce_KDtree (SpatialIndex): Spatial index containing all the points for which we know if it is a lead and/or sea ice
+            The points are in EPSG:3413 coordinates.
+        lead_SeaIce_dictionary (np.ndarray): Lead/Sea ice classes of each point in the spatial index
         lat_min (float): Minimum latitude for filtering
 
     Returns:
@@ -173,80 +313,22 @@ def filter_bursts(latlon_burst_list, lead_SeaIce_KDtree, lead_SeaIce_dictionary,
     return bursts_filtered_step2
 
 
-def extract_psep_burst(burst, nb_bursts, filename, **kwargs):
-    """Extracts the PSEP (Peak Surface Echo Power) for a specific burst of 64 echoes.
-
-    Args:
-        burst (int): The index of the burst to process.
-        nb_bursts (int): The total number of bursts to process.
-        filename (str): The path to the NetCDF file containing the burst data.
-
-    Returns:
-        tuple: A tuple containing the burst index and the array of the extracted PSEP values.
-    """
-
-    if burst%1000 == 0:
-        print(f"Processing burst {burst}/{nb_bursts}")
-
-    with Dataset(filename, 'r') as nc:
-        i_data = nc.variables['cplx_waveform_ch1_i_85_ku'][burst]
-        q_data = nc.variables['cplx_waveform_ch1_q_85_ku'][burst]
-        tot_gain_ch1_85_ku = nc.variables['tot_gain_ch1_85_ku'][burst]
-        agc_1_85_ku = nc.variables['agc_1_85_ku'][burst]
-        agc_2_85_ku = nc.variables['agc_2_85_ku'][burst]
-        instr_cor_gain_tx_rx_85_ku = nc.variables['instr_cor_gain_tx_rx_85_ku'][burst]
-
-    # Compute the total Gain
-    static_gain = tot_gain_ch1_85_ku
-    dynamic_gain = agc_1_85_ku + agc_2_85_ku + instr_cor_gain_tx_rx_85_ku
-    total_gain = static_gain + dynamic_gain
-
-    # Compute and store the PSEP for each one of the 64 echoes
-    psep_burst = np.zeros(64)    
-    for pulse in range(64):
-        cplx_signal = i_data[pulse, :] + 1j * q_data[pulse, :]
-        psep_echo = extract_psep_echo(cplx_signal, total_gain, **kwargs)
-        if np.isfinite(psep_echo):
-            psep_burst[pulse] = psep_echo
-        else :
-            return np.zeros(64)  # Return an array of zeros if the PSEP extraction fails
-
-    return burst, psep_burst
-
-
-def extract_psep_echo(complex_echo, gain, window_frac_psep=0.05, **kwargs):
+def extract_psep_echo(complex_echo, gain, **kwargs):
     """Extracts the PSEP (Peak Surface Echo Power) from the complex echo signal.
 
     Args:
         complex_echo (np.ndarray): The input complex echo signal.
         gain (float): The gain to apply for calibration.
         window_frac_psep (float, optional): The fraction of the window size to use for max power extraction. Defaults to 0.05.
+        use_numba (bool, optional): Whether to use the Numba kernels if Numba is installed. Defaults to True.
 
     Returns:
         float: The calibrated PSEP value.
     """
-
-    # Perform FFT for range compression
-    waveform = np.fft.fft(complex_echo)
-    waveform = np.fft.fftshift(waveform)
-    waveform = (np.abs(waveform)**2)/len(complex_echo)
-
-    # Compute the leading edge index
-    leading_edge_index = leading_edge(waveform, **kwargs)
-    
-    # Compute the max amplitude in the following window
-    window_size = int(window_frac_psep * len(waveform))
-    psep_index = np.argmax(waveform[leading_edge_index:leading_edge_index+window_size]) + leading_edge_index
-    psep_count = waveform[psep_index]
-
-    # Convert to dB and apply calibration
-    psep_db = 10 * np.log10(psep_count)
-    psep_db_calibrated = psep_db + gain
-    
-    return psep_db_calibrated
+    return psep_echoes(np.reshape(complex_echo, (1, -1)), gain, **kwargs)[0]
 
 
-def leading_edge(waveform, window_frac_leading_edge=[0.03,0.06,0.09], **kwargs):
+def leading_edge(waveform, window_frac_leading_edge=[0.03,0.06,0.09], use_numba=True, **kwargs):
     """Compute the leading edge of a waveform signal.
     
     The leading edge is defined as the position of the maximum integrated echo amplitude gradient 
@@ -254,21 +336,11 @@ def leading_edge(waveform, window_frac_leading_edge=[0.03,0.06,0.09], **kwargs):
     Args:
         waveform (np.ndarray): The input waveform signal.
         window_frac (list, optional): The fractions of the window sizes used to compute the slopes. Defaults to [0.03,0.06,0.09].
+        use_numba (bool, optional): Whether to use the Numba kernel if Numba is installed. Defaults to True.
 
     Returns:
         int: The index of the leading edge.
     """
 
     window_sizes = [int(wf * len(waveform)) for wf in window_frac_leading_edge]
-
-    slopes = []
-    for i in range(len(waveform) - max(window_sizes)):
-        slope=[]
-        for window_size in window_sizes:
-            segment = waveform[i:i+window_size]
-            slope.append(np.mean(np.gradient(segment)))
-        slopes.append(slope)
-
-    mean_slopes = np.mean(slopes, axis=1)
-    leading_edge_index = np.argmax(mean_slopes)
-    return leading_edge_index
\ No newline at end of file
+    return int(leading_edges(np.reshape(waveform, (1, -1)), window_sizes, use_numba=use_numba)[0])
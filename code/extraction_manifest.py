@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+import re
+import time
+
+
+MANIFEST_NAME = "manifest.jsonl"
+
+# Products of the PSEP files without product column, inferred once from nc_files_to_read.txt
+LEGACY_PRODUCTS_NAME = "legacy_products.json"
+
+
+def checksum(data):
+    """Hexadecimal blake2b checksum of bytes."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class ExtractionManifest:
+    """Per-product record of the PSEP extraction, stored in psep/manifest.jsonl.
+
+    One JSON line is appended each time a product is extracted or fails, the last line of a
+    product being its current state :
+    {"product", "status" ('done' or 'failed'), "nb_bursts", "output", "offset", "length", "checksum", "time"}
+    for a product whose nb_bursts rows are the bytes [offset, offset + length) of the output file,
+    {"product", "status", "error", "time"} for a product that failed.
+    """
+
+    def __init__(self, psep_dir):
+        """
+        Args:
+            psep_dir (str): Path to the directory of the PSEP csv files.
+        """
+        self.psep_dir = psep_dir
+        self.filename = os.path.join(psep_dir, MANIFEST_NAME)
+        self.records = {}
+        if os.path.exists(self.filename):
+            with open(self.filename, 'r') as f:
+                lines = f.readlines()
+            for line in lines:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue    # Line truncated by a crash
+                self.records[record['product']] = record
+            if lines and not lines[-1].endswith('\n'):
+                with open(self.filename, 'a') as f:
+                    f.write('\n')
+
+    def record(self, product, status, **fields):
+        """Append the new state of a product to the manifest."""
+        record = {'product': product, 'status': status, **fields, 'time': time.time()}
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.records[product] = record
+
+    def done_products(self):
+        """Set of the products recorded as extracted."""
+        return {product for product, record in self.records.items() if record['status'] == 'done'}
+
+    def output_files(self):
+        """Set of the csv files containing products recorded in the manifest."""
+        return {record['output'] for record in self.records.values() if 'output' in record}
+
+    def validate(self, outputs=None):
+        """Check the extracted products against their checksums, and truncate the output files after the last valid product.
+
+        The rows of a product are only recorded once they are written, so the bytes after the last
+        recorded product of a file come from an interrupted extraction. The products of a file following
+        a product whose rows do not match the checksum are marked as failed, to be extracted again.
+        Only the rows of the recorded products are read.
+
+        Args:
+            outputs (list, optional): Output files to check (e.g. the file a batch appends to). Defaults to None (all of them).
+
+        Returns:
+            set: The products whose rows are valid.
+        """
+        records_by_output = {}
+        for record in self.records.values():
+            if record['status'] == 'done':
+                records_by_output.setdefault(record['output'], []).append(record)
+
+        for output in (self.output_files() if outputs is None else set(outputs) & self.output_files()):
+            output_path = os.path.join(self.psep_dir, output)
+            records = sorted(records_by_output.get(output, []), key=lambda r: r['offset'])
+            if not os.path.exists(output_path):
+                for record in records:
+                    self.record(record['product'], 'failed', error=f"{output} not found")
+                continue
+
+            with open(output_path, 'rb') as f:
+                valid_end = len(f.readline())     # Header
+                for i, record in enumerate(records):
+                    f.seek(record['offset'])
+                    if record['offset'] != valid_end or checksum(f.read(record['length'])) != record['checksum']:
+                        for invalid in records[i:]:
+                            self.record(invalid['product'], 'failed', error=f"Invalid rows in {output}")
+                        break
+                    valid_end = record['offset'] + record['length']
+
+            size = os.path.getsize(output_path)
+            if size > valid_end:
+                print(f"Truncating {output} after the last valid product ({size - valid_end} bytes removed)")
+                with open(output_path, 'r+b') as f:
+                    f.truncate(valid_end)
+
+        return self.done_products()
+
+
+def extracted_products(path, year, month):
+    """List the products already extracted in the PSEP store.
+
+    The products are read from the manifest. PSEP files extracted before the product column and the manifest
+    existed are considered complete : their products are inferred from the indices of the batch in
+    nc_files_to_read.txt, and saved in psep/legacy_products.json the first time (the list may be refreshed later).
+    A file with a product column which is not in the manifest was interrupted before its first product was
+    recorded : it is truncated to its header, and its products are extracted again.
+
+    Args:
+        path (str): The path to the work directory.
+        year (str): The year of the products. (e.g. "2018")
+        month (str): The month of the products. (e.g. "01")
+
+    Returns:
+        set: Filenames of the extracted products.
+    """
+    psep_dir = os.path.join(path, "psep")
+    if not os.path.isdir(psep_dir):
+        return set()
+
+    manifest = ExtractionManifest(psep_dir)
+    products = manifest.validate()
+
+    # The products of the files without product column are inferred from the batch indices in nc_files_to_read.txt,
+    # and kept in psep/legacy_products.json, so that they do not change when the list is refreshed (cf update_month)
+    legacy_path = os.path.join(psep_dir, LEGACY_PRODUCTS_NAME)
+    legacy_products = {}
+    if os.path.exists(legacy_path):
+        with open(legacy_path, 'r') as f:
+            legacy_products = json.load(f)
+    nc_files = []
+    nc_files_to_read_path = os.path.join(path, "nc_files_to_read.txt")
+    if os.path.exists(nc_files_to_read_path):
+        with open(nc_files_to_read_path, 'r') as f:
+            nc_files = [line.strip() for line in f if line.strip()]
+
+    manifest_files = manifest.output_files()
+    nb_legacy_files = len(legacy_products)
+    for csv_file in os.listdir(psep_dir):
+        if csv_file in manifest_files or not (csv_file.startswith(f"psep_{year}_{month}_") and csv_file.endswith('.csv')):
+            continue
+        csv_path = os.path.join(psep_dir, csv_file)
+        with open(csv_path, 'rb') as f:
+            header = f.readline()
+        if 'product' in header.decode().strip().split(','):
+            if os.path.getsize(csv_path) > len(header):
+                print(f"Truncating {csv_file} to its header (rows of a product interrupted before it was recorded)")
+                with open(csv_path, 'r+b') as f:
+                    f.truncate(len(header))
+        elif csv_file in legacy_products:
+            products.update(legacy_products[csv_file])
+        else:
+            match = re.fullmatch(rf"psep_{year}_{month}_(\d+)_(\d+)\.csv", csv_file)
+            if match and nc_files:
+                legacy_products[csv_file] = nc_files[int(match.group(1)):int(match.group(2))]
+                products.update(legacy_products[csv_file])
+    if len(legacy_products) > nb_legacy_files:
+        with open(legacy_path, 'w') as f:
+            json.dump(legacy_products, f, indent=1)
+
+    return products
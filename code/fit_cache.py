@@ -0,0 +1,135 @@
+import hashlib
+import json
+import sqlite3
+import time
+import numpy as np
+
+
+class CachedFit:
+    """HK fit result read from the fit cache.
+
+    Mimics the interface of the rsr Statfit class (values, power(), crl(), flag())
+    so that it can be saved or plotted in the same way as a new fit.
+    """
+
+    def __init__(self, values, power, crl, flag):
+        self.values = values
+        self._power = power
+        self._crl = crl
+        self._flag = flag
+
+    def power(self):
+        return self._power
+
+    def crl(self):
+        return self._crl
+
+    def flag(self):
+        return self._flag
+
+
+def compute_psep_fingerprint(latlon_array, powers_2D_array):
+    """Compute a fingerprint of a PSEP dataset, which also depends on the order of the bursts.
+
+    Args:
+        latlon_array (np.ndarray): Array of latitudes and longitudes.
+        powers_2D_array (np.ndarray): 2D array of power values.
+
+    Returns:
+        str: The hexadecimal fingerprint.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for array in (latlon_array, powers_2D_array):
+        array = np.ascontiguousarray(array)
+        h.update(str((array.shape, array.dtype.str)).encode())
+        h.update(array.data)
+    return h.hexdigest()
+
+
+def fit_key(indices_closest, fingerprint, min_method, fit_mode='full', crl_min=None, p0=None):
+    """Compute the cache key of a fit.
+
+    Args:
+        indices_closest (list): Row indices of the PSEP bursts used for the fit.
+        fingerprint (str): Fingerprint of the PSEP dataset.
+        min_method (str): Minimization method used in the lmfit HK-fitting.
+        fit_mode (str, optional): HK fitting mode ('full', 'moments' or 'tiered'). Defaults to 'full'.
+        crl_min (float, optional): Minimum correlation coefficient in 'tiered' mode. Defaults to None.
+        p0 (np.ndarray, optional): Initial (a, s, mu) of a warm-started lmfit HK-fitting, ignored if not usable by
+            fit_hk. Defaults to None (cold fit).
+
+    Returns:
+        str: The hexadecimal key.
+    """
+    if fit_mode != 'tiered':
+        crl_min = None
+    fit_settings = {'min_method': min_method, 'fit_mode': fit_mode, 'crl_min': crl_min}
+    if p0 is not None and fit_mode != 'moments' and np.all(np.isfinite(p0)) and p0[0] > 0 and p0[1] > 0:
+        # A warm-started fit may converge to another optimum than the cold fit, keep them apart
+        fit_settings['p0'] = [float(v) for v in p0]
+    h = hashlib.blake2b(digest_size=20)
+    h.update(fingerprint.encode())
+    h.update(json.dumps(fit_settings, sort_keys=True).encode())
+    h.update(np.sort(np.asarray(indices_closest, dtype=np.int64)).data)
+    return h.hexdigest()
+
+
+class FitCache:
+    """Persistent cache of HK fit results, stored in a SQLite file, with LRU eviction.
+
+    The cache can be shared by several worker processes, each one opening its own FitCache.
+    """
+
+    def __init__(self, filename, max_entries=1000000):
+        """
+        Args:
+            filename (str): Path to the SQLite file.
+            max_entries (int, optional): Maximum number of fits kept in the cache. Defaults to 1000000.
+        """
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(filename, timeout=600)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS fits (key TEXT PRIMARY KEY, result TEXT, last_access REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS fits_last_access ON fits (last_access)")
+        self.connection.commit()
+
+    def get_many(self, keys):
+        """Read fits from the cache.
+
+        Args:
+            keys (list): Keys of the fits.
+
+        Returns:
+            list: CachedFit for each key found in the cache, None otherwise.
+        """
+        found = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i+500]
+            rows = self.connection.execute(f"SELECT key, result FROM fits WHERE key IN ({','.join('?'*len(chunk))})", chunk)
+            found.update(rows.fetchall())
+        if found:
+            now = time.time()
+            with self.connection:
+                self.connection.executemany("UPDATE fits SET last_access = ? WHERE key = ?", [(now, key) for key in found])
+
+        return [CachedFit(**json.loads(found[key])) if key in found else None for key in keys]
+
+    def put_many(self, keys, fits):
+        """Write fits in the cache, and evict the least recently used ones above max_entries.
+
+        Args:
+            keys (list): Keys of the fits.
+            fits (list): Fit results (rsr Statfit or similar objects).
+        """
+        now = time.time()
+        rows = [(key, json.dumps({'values': f.values, 'power': f.power(), 'crl': f.crl(), 'flag': f.flag()}), now)
+                for key, f in zip(keys, fits)]
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO fits VALUES (?, ?, ?)", rows)
+            nb_entries = self.connection.execute("SELECT COUNT(*) FROM fits").fetchone()[0]
+            if nb_entries > self.max_entries:
+                self.connection.execute("DELETE FROM fits WHERE key IN (SELECT key FROM fits ORDER BY last_access LIMIT ?)",
+                                        (nb_entries - self.max_entries,))
+
+    def close(self):
+        self.connection.close()
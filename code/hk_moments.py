@@ -0,0 +1,292 @@
+import time
+import warnings
+import numpy as np
+from scipy.special import gammaincinv, i0e
+
+
+# Bounds of the mu parameter in the lmfit HK-fitting of the rsr package
+MU_MIN = 0.5
+MU_MAX = 10.
+
+
+class MomentFit:
+    """Result of a method-of-moments HK estimation for a single target.
+
+    Mimics the interface of the rsr Statfit class (values, power(), crl(), flag())
+    so that it can be saved in the same way as a full lmfit HK fit.
+    """
+
+    def __init__(self, sample_mean, a, s, mu, correlation, success):
+        a, s, mu = float(a), float(s), float(mu)
+        self.sample_mean = float(sample_mean)
+        self.values = {'a': a, 's': s, 'mu': mu, 'pt': a**2 + 2*s**2*mu, 'ID': -1}
+        self.correlation = correlation
+        self.success = success
+
+    def power(self, db=True):
+        """Total (pt), coherent (pc), and incoherent (pn) components in power"""
+        pt, pc, pn = self.sample_mean**2, self.values['a']**2, 2*self.values['s']**2*self.values['mu']
+        mu = self.values['mu']
+        if db:
+            pt, pc, pn = 10*np.log10(pt), 10*np.log10(pc), 10*np.log10(pn)
+        if not self.success:
+            pt, pc, pn, mu = 0, 0, 0, 0
+        return {'pt': pt, 'pc': pc, 'pn': pn, 'pc-pn': pc-pn, 'mu': mu}
+
+    def crl(self):
+        """Correlation coefficient between distribution and HK model"""
+        if (not np.isfinite(self.correlation)) or (not self.success):
+            return 0.
+        return float(self.correlation)
+
+    def flag(self):
+        """0 is bad data, 1 is good data"""
+        return int(self.success and self.crl() > 0)
+
+
+def positive_samples(samples_2D):
+    """Copy of the samples with the non-positive amplitudes replaced by NaN, as they are removed
+    before the lmfit HK-fitting (cf rsr.run.processor)."""
+    samples_2D = np.array(samples_2D, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        samples_2D[~(samples_2D > 0)] = np.nan
+    return samples_2D
+
+
+def hk_moments(samples_2D):
+    """Estimate the HK parameters of each row of samples with the method of moments.
+
+    The mean, variance and third central moment of the intensity (amplitude**2) of an
+    HK distribution only depend on pc = a**2, pn = 2*s**2*mu and mu. Eliminating pc and
+    mu leaves a quartic equation in pn, solved for all the rows at once through the
+    eigenvalues of its companion matrix.
+
+    Args:
+        samples_2D (np.ndarray): Array of shape (T, M), one row of M amplitudes per target.
+            Rows with less than M amplitudes are padded with NaN.
+
+    Returns:
+        a (np.ndarray): Coherent amplitudes, shape (T,).
+        s (np.ndarray): Diffuse amplitudes, shape (T,).
+        mu (np.ndarray): Shape parameters, shape (T,).
+        stable (np.ndarray): True where a physical solution with mu in [0.5, 10] was found.
+    """
+    samples_2D = np.asarray(samples_2D, dtype=np.float64)
+
+    # Normalized intensity moments (mean intensity = 1)
+    intensity = samples_2D**2
+    m1 = np.nanmean(intensity, axis=1)
+    deviation = intensity / m1[:, None] - 1
+    c2 = np.nanmean(deviation**2, axis=1)
+    c3 = np.nanmean(deviation**3, axis=1)
+    return hk_from_moments(m1, c2, c3)
+
+
+def hk_from_moments(m1, c2, c3):
+    """Solve the method-of-moments HK equations (cf hk_moments) for each set of intensity moments.
+
+    Args:
+        m1 (np.ndarray): Mean intensities, shape (T,).
+        c2 (np.ndarray): Second central moments of the normalized intensities, shape (T,).
+        c3 (np.ndarray): Third central moments of the normalized intensities, shape (T,).
+
+    Returns:
+        a, s, mu, stable (np.ndarray): cf hk_moments.
+    """
+    nb_targets = len(m1)
+
+    # pn**4 - 6*c2*pn**2 + (c3 + 6*c2)*pn - 3*c2**2 = 0
+    companion = np.zeros((nb_targets, 4, 4))
+    companion[:, 0, 1] = 6*c2
+    companion[:, 0, 2] = -(c3 + 6*c2)
+    companion[:, 0, 3] = 3*c2**2
+    companion[:, 1, 0] = companion[:, 2, 1] = companion[:, 3, 2] = 1
+    valid_input = np.isfinite(companion).all(axis=(1, 2)) & (c2 > 0)
+    companion[~valid_input] = 0
+    roots = np.linalg.eigvals(companion)
+
+    pn = roots.real
+    with np.errstate(divide='ignore', invalid='ignore'):
+        u = (c3[:, None] + pn**3) / (3*c2[:, None]*pn)      # u = 1 + 2/mu
+        mu_roots = 2 / (u - 1)
+    pc = 1 - pn
+    admissible = (np.abs(roots.imag) <= 1e-9*np.maximum(np.abs(roots.real), 1e-12)) \
+        & (pn > 0) & (pc > 0) & (mu_roots >= MU_MIN) & (mu_roots <= MU_MAX) & valid_input[:, None]
+
+    # Keep the admissible root with the lowest incoherent power
+    pn_admissible = np.where(admissible, pn, np.inf)
+    best = np.argmin(pn_admissible, axis=1)
+    rows = np.arange(nb_targets)
+    stable = admissible[rows, best]
+    pn = np.where(stable, pn[rows, best], np.nan) * m1
+    pc = np.where(stable, pc[rows, best], np.nan) * m1
+    mu = np.where(stable, mu_roots[rows, best], np.nan)
+
+    a = np.sqrt(pc)
+    s = np.sqrt(pn / (2*mu))
+    return a, s, mu, stable
+
+
+def histogram_rows(samples_2D, nb_bins=100):
+    """Compute a density histogram for each row of samples.
+
+    Args:
+        samples_2D (np.ndarray): Array of shape (T, M), padded with NaN.
+        nb_bins (int, optional): Number of bins per row. Defaults to 100.
+
+    Returns:
+        x (np.ndarray): Bin centers, shape (T, nb_bins).
+        n (np.ndarray): Probability densities, shape (T, nb_bins).
+    """
+    nb_targets = samples_2D.shape[0]
+    valid = np.isfinite(samples_2D)
+    nb_samples = valid.sum(axis=1)
+    low = np.nanmin(samples_2D, axis=1)
+    width = (np.nanmax(samples_2D, axis=1) - low) / nb_bins
+    width[width == 0] = 1.
+
+    with np.errstate(invalid='ignore'):
+        bin_index = ((np.where(valid, samples_2D, low[:, None]) - low[:, None]) / width[:, None]).astype(np.int64)
+    bin_index = np.clip(bin_index, 0, nb_bins - 1) + nb_bins * np.arange(nb_targets)[:, None]
+    counts = np.bincount(bin_index[valid], minlength=nb_targets*nb_bins).reshape(nb_targets, nb_bins)
+
+    x = low[:, None] + (np.arange(nb_bins) + 0.5) * width[:, None]
+    n = counts / (nb_samples[:, None] * width[:, None])
+    return x, n
+
+
+def hk_pdf(a, s, mu, x, nb_nodes=64):
+    """Evaluate HK probability densities from the compound representation.
+
+    The HK distribution is a Rice distribution whose diffuse power is Gamma
+    distributed. The Gamma integral is approximated with nb_nodes equiprobable
+    nodes, which is vectorized over all the targets.
+
+    Args:
+        a (np.ndarray): Coherent amplitudes, shape (T,).
+        s (np.ndarray): Diffuse amplitudes, shape (T,).
+        mu (np.ndarray): Shape parameters, shape (T,).
+        x (np.ndarray): Amplitudes at which to evaluate the densities, shape (T, B).
+        nb_nodes (int, optional): Number of nodes for the Gamma integral. Defaults to 64.
+
+    Returns:
+        np.ndarray: Probability densities, shape (T, B).
+    """
+    quantiles = (np.arange(nb_nodes) + 0.5) / nb_nodes
+    w = gammaincinv(mu[:, None], quantiles[None, :])               # (T, J)
+    sigma2 = (s[:, None]**2 * w)[:, None, :]                        # (T, 1, J)
+    a = a[:, None, None]
+    x = x[:, :, None]
+
+    # Rice density, computed in log space to avoid overflows of I0 for small sigma
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        log_rice = np.log(x) - np.log(sigma2) - (x - a)**2 / (2*sigma2) + np.log(i0e(a*x/sigma2))
+        rice = np.exp(log_rice)
+    rice = np.nan_to_num(rice, nan=0., posinf=0.)
+    return rice.mean(axis=2)
+
+
+def row_correlation(n, model):
+    """Pearson correlation coefficient between each row of n and model."""
+    n = n - n.mean(axis=1, keepdims=True)
+    model = model - model.mean(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sum(n*model, axis=1) / np.sqrt(np.sum(n**2, axis=1) * np.sum(model**2, axis=1))
+
+
+def fit_hk_moments(samples_2D, nb_bins=100):
+    """Fit the HK model to each row of samples with the method of moments.
+
+    Args:
+        samples_2D (np.ndarray): Array of shape (T, M), one row of M amplitudes per target.
+            Rows with less than M amplitudes are padded with NaN. The non-positive amplitudes are left out.
+        nb_bins (int, optional): Number of histogram bins used for the correlation coefficient. Defaults to 100.
+
+    Returns:
+        list: List of T MomentFit objects.
+    """
+    samples_2D = positive_samples(samples_2D)
+    a, s, mu, stable = hk_moments(samples_2D)
+
+    correlation = np.zeros(len(a))
+    if stable.any():
+        x, n = histogram_rows(samples_2D[stable], nb_bins=nb_bins)
+        model = hk_pdf(a[stable], s[stable], mu[stable], x)
+        correlation[stable] = row_correlation(n, model)
+
+    sample_mean = np.nanmean(samples_2D, axis=1)
+    return [MomentFit(sample_mean[i], a[i], s[i], mu[i], correlation[i], bool(stable[i])) for i in range(len(a))]
+
+
+def bootstrap_hk_moments(samples_2D, nb_resamples=100, nb_bins=512, max_time=None, resamples_per_round=25, rng=None):
+    """Bootstrap standard errors of the method-of-moments HK estimation of each row of samples.
+
+    The intensities of each row are binned, and each bootstrap resample is drawn as multinomial
+    counts over the bins (the sum of intensity**p of a bin being its count times the mean of
+    intensity**p in the bin). All the resamples of all the rows are solved at once.
+
+    Args:
+        samples_2D (np.ndarray): Array of shape (T, M), one row of M amplitudes per target, padded with NaN.
+            The non-positive amplitudes are left out.
+        nb_resamples (int, optional): Number of bootstrap resamples per row. Defaults to 100.
+        nb_bins (int, optional): Number of intensity bins per row. Defaults to 512.
+        max_time (float, optional): Compute budget (s). The resamples are drawn by rounds of resamples_per_round,
+            and no round is started once the budget is spent (at least one round is done). Defaults to None (no limit).
+        resamples_per_round (int, optional): Number of resamples per round. Defaults to 25.
+        rng (np.random.Generator or list, optional): Random generator, or one random generator per row, so that the
+            resamples of a row do not depend on the other rows. Defaults to None (new generator).
+
+    Returns:
+        dict: Standard errors of 'pc', 'pn', 'pc-pn' (dB) and 'mu' (arrays of shape (T,), NaN when less than
+            2 resamples were stable), 'nb_resamples' (int), and 'stable_fraction' (shape (T,)).
+    """
+    start = time.perf_counter()
+    rng = np.random.default_rng() if rng is None else rng
+    intensity = positive_samples(samples_2D)**2
+    nb_targets = intensity.shape[0]
+    valid = np.isfinite(intensity)
+    nb_samples = valid.sum(axis=1)
+
+    # Histogram of the intensities, with the mean of intensity**p in each bin
+    low = np.nanmin(intensity, axis=1)
+    width = (np.nanmax(intensity, axis=1) - low) / nb_bins
+    width[~(width > 0)] = 1.
+    with np.errstate(invalid='ignore'):
+        bin_index = ((np.where(valid, intensity, low[:, None]) - low[:, None]) / width[:, None]).astype(np.int64)
+    bin_index = (np.clip(bin_index, 0, nb_bins - 1) + nb_bins * np.arange(nb_targets)[:, None])[valid]
+    counts = np.bincount(bin_index, minlength=nb_targets*nb_bins).reshape(nb_targets, nb_bins)
+    bin_moments = np.stack([np.bincount(bin_index, weights=intensity[valid]**p, minlength=nb_targets*nb_bins) for p in (1, 2, 3)])
+    bin_moments = bin_moments.reshape(3, nb_targets, nb_bins) / np.maximum(counts, 1)
+    pvals = counts / np.maximum(nb_samples, 1)[:, None]
+    pvals[nb_samples == 0, 0] = 1.
+
+    estimates = {'pc': [], 'pn': [], 'mu': []}
+    nb_done = 0
+    while nb_done < nb_resamples and (nb_done == 0 or max_time is None or time.perf_counter() - start < max_time):
+        nb_round = min(resamples_per_round, nb_resamples - nb_done)
+        if isinstance(rng, np.random.Generator):
+            resampled_counts = rng.multinomial(nb_samples, pvals, size=(nb_round, nb_targets))        # (R, T, B)
+        else:
+            resampled_counts = np.stack([row_rng.multinomial(nb_samples[t], pvals[t], size=nb_round) for t, row_rng in enumerate(rng)], axis=1)
+        raw = np.einsum('rtb,ptb->prt', resampled_counts, bin_moments) / np.maximum(nb_samples, 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            m1 = raw[0]
+            c2 = raw[1] / m1**2 - 1
+            c3 = raw[2] / m1**3 - 3*raw[1] / m1**2 + 2
+            a, s, mu, stable = hk_from_moments(m1.ravel(), c2.ravel(), c3.ravel())
+            estimates['pc'].append(np.where(stable, 10*np.log10(a**2), np.nan).reshape(nb_round, nb_targets))
+            estimates['pn'].append(np.where(stable, 10*np.log10(2*s**2*mu), np.nan).reshape(nb_round, nb_targets))
+            estimates['mu'].append(np.where(stable, mu, np.nan).reshape(nb_round, nb_targets))
+        nb_done += nb_round
+
+    estimates = {name: np.concatenate(values) for name, values in estimates.items()}
+    estimates['pc-pn'] = estimates['pc'] - estimates['pn']
+    nb_stable = np.isfinite(estimates['pc']).sum(axis=0)
+    errors = {}
+    for name, values in estimates.items():
+        with np.errstate(invalid='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            errors[name] = np.where(nb_stable >= 2, np.nanstd(values, axis=0, ddof=1), np.nan)
+    errors['nb_resamples'] = nb_done
+    errors['stable_fraction'] = nb_stable / nb_done
+    return errors
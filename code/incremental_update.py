@@ -0,0 +1,195 @@
+from extract_psep import load_lead_filter, extract_psep_batch
+from extraction_manifest import extracted_products
+from download_ftp import find_nc_files_to_read
+from apply_rsr import apply_rsr
+from utils import arctic_grid, is_ice
+from psep_store import STORE_NAME, store_up_to_date, consolidate_psep
+from spatial_index import SpatialIndex, find_neighborhoods
+from run_stats import stage, reset, write_report, report_filename
+from datetime import datetime, timezone
+import os
+import numpy as np
+import pandas as pd
+
+
+def extract_new_products(path, year, month, **kwargs):
+    """Extract the PSEP of the products listed on the FTP server but not yet in the PSEP store.
+
+    The list of products (nc_files_to_read.txt) is refreshed, and the new products are
+    extracted on their own, in psep/psep_<year>_<month>_update_<date>.csv.
+
+    Args:
+        path (str): The path to the work directory.
+        year (str): The year of the products to process. (e.g. "2018")
+        month (str): The month of the products to process. (e.g. "01")
+
+    Returns:
+        list: Filenames of the newly extracted products.
+    """
+    # Also saves the products of the PSEP files without product column, inferred from the current list
+    already_extracted = extracted_products(path, year, month)
+
+    print("Refreshing the list of products...")
+    find_nc_files_to_read(path, year, month, **kwargs)
+    with open(os.path.join(path, "nc_files_to_read.txt"), 'r') as f:
+        nc_files = [line.strip() for line in f if line.strip()]
+
+    new_products = [filename for filename in nc_files if filename not in already_extracted]
+    print(f"Number of new products: {len(new_products)} / {len(nc_files)}")
+    if not new_products:
+        return []
+
+    lead_SeaIce_KDtree, lead_SeaIce_dictionary = load_lead_filter(path, year, month)
+    os.makedirs(os.path.join(path, "psep"), exist_ok=True)
+    batch_name = "update_" + datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+    extract_psep_batch(year, month, path, new_products, lead_SeaIce_KDtree, lead_SeaIce_dictionary, 0, batch_name=batch_name, **kwargs)
+
+    return new_products
+
+
+def find_affected_targets(psep_index, xy_target_array, new_bursts_mask, neighborhood_mode='knn', max_radius_km=50., **kwargs):
+    """Find the targets whose neighborhood is changed by new bursts.
+
+    In 'knn' mode, a target is affected if one of its nb_closest closest bursts is new.
+    In 'radius' mode, a target is affected if a new burst is within max_radius_km
+    (the subsampling of the neighborhood may change even if the new burst is not selected).
+
+    Args:
+        psep_index (SpatialIndex): Spatial index of all the psep bursts, new ones included.
+        xy_target_array (np.ndarray): EPSG:3413 coordinates of the targets (m).
+        new_bursts_mask (np.ndarray): True for the new bursts, for each row of the spatial index.
+        neighborhood_mode (str, optional): 'knn' or 'radius' (cf find_neighborhoods). Defaults to 'knn'.
+        max_radius_km (float, optional): Search radius in 'radius' mode (km). Defaults to 50.
+
+    Returns:
+        np.ndarray: Boolean array, True for the affected targets.
+    """
+    if not new_bursts_mask.any():
+        return np.zeros(len(xy_target_array), dtype=bool)
+
+    if neighborhood_mode == 'radius':
+        new_bursts_index = SpatialIndex(psep_index.tree.data[new_bursts_mask[psep_index.row_indices]])
+        return new_bursts_index.distance_to_nearest(xy_target_array) <= max_radius_km * 1000
+
+    affected = np.zeros(len(xy_target_array), dtype=bool)
+    for i in range(0, len(xy_target_array), 1000):
+        neighborhoods = find_neighborhoods(psep_index, xy_target_array[i:i+1000], neighborhood_mode=neighborhood_mode, **kwargs)
+        affected[i:i+1000] = [new_bursts_mask[indices].any() for indices in neighborhoods]
+    return affected
+
+
+def neighbor_rows(psep_index, xy_targets, nb_closest=1000, neighborhood_mode='knn', max_radius_km=50., **kwargs):
+    """Rows of the bursts within the neighbor search radius of the targets (cf find_neighborhoods).
+
+    In 'knn' mode, these are the nb_closest closest bursts of each target, in 'radius' mode all the bursts within
+    max_radius_km (before the subsampling), so that the neighborhoods found among these rows are the same as
+    among all the bursts.
+
+    Args:
+        psep_index (SpatialIndex): Spatial index of all the psep bursts.
+        xy_targets (np.ndarray): EPSG:3413 coordinates of the targets (m).
+        nb_closest (int, optional): Number of closest bursts in 'knn' mode. Defaults to 1000.
+        neighborhood_mode (str, optional): 'knn' or 'radius'. Defaults to 'knn'.
+        max_radius_km (float, optional): Search radius in 'radius' mode (km). Defaults to 50.
+
+    Returns:
+        np.ndarray: Sorted row indices.
+    """
+    rows = [np.empty(0, dtype=np.int64)]
+    for i in range(0, len(xy_targets), 1000):
+        if neighborhood_mode == 'radius':
+            rows.extend(psep_index.query_radius(xy_targets[i:i+1000], max_radius_km * 1000))
+        else:
+            _, indices = psep_index.query(xy_targets[i:i+1000], k=nb_closest)
+            rows.append(indices[indices >= 0])
+    return np.unique(np.concatenate(rows))
+
+
+def apply_rsr_update(path, new_products, **kwargs):
+    """Apply RSR again only to the grid cells whose neighborhoods are affected by the bursts of new products.
+
+    The PSEP is read from the consolidated store (consolidated first if the csv files changed, cf consolidate_psep):
+    only the coordinates of all the bursts are read, to find the affected targets, then the powers of the bursts
+    within the neighbor search radius of these targets (cf neighbor_rows), in the Morton order of the store, so that
+    they are read from a few contiguous parts of the memory-mapped powers.
+
+    The new results are saved in rsr_results_update_<date>_core_<i>.csv, then the previous
+    results of the affected cells are removed from the other rsr_results_*.csv files.
+
+    Args:
+        path (str): Path to the data directory.
+        new_products (list): Filenames of the new products.
+        **kwargs: Additional keyword arguments for apply_rsr and arctic_grid.
+    """
+    print("Generating Arctic grid...")
+    latlon_target_array, xy_target_array = arctic_grid(return_xy=True, **kwargs)
+
+    psep_dir = os.path.join(path, "psep")
+    store_dir = os.path.join(psep_dir, STORE_NAME)
+    if not store_up_to_date(psep_dir):
+        print("Consolidating the PSEP csv files...")
+        consolidate_psep(psep_dir)
+
+    print("Reading the PSEP coordinates from the consolidated store...")
+    with stage('load_psep_store'):
+        xy_array = np.load(os.path.join(store_dir, "xy.npy"))
+        products = np.load(os.path.join(store_dir, "products.npy"), mmap_mode='r')
+        new_bursts_mask = np.zeros(len(xy_array), dtype=bool)
+        for start in range(0, len(products), 1000000):
+            new_bursts_mask[start:start + 1000000] = np.isin(products[start:start + 1000000], list(new_products))
+        del products
+    print(f"Number of new bursts: {new_bursts_mask.sum()} / {len(new_bursts_mask)}")
+
+    psep_index = SpatialIndex(xy_array)
+    mask_ice = is_ice(xy_target_array, psep_index)
+    affected = np.zeros(len(latlon_target_array), dtype=bool)
+    affected[mask_ice] = find_affected_targets(psep_index, xy_target_array[mask_ice], new_bursts_mask, **kwargs)
+    print(f"Number of affected targets: {affected.sum()} / {mask_ice.sum()}")
+    if not affected.any():
+        return
+
+    with stage('read_neighbors') as counters:
+        rows = neighbor_rows(psep_index, xy_target_array[affected], **kwargs)
+        counters['bursts'] = len(rows)
+        del psep_index
+        latlon_array = np.load(os.path.join(store_dir, "latlon.npy"), mmap_mode='r')[rows]
+        xy_array = xy_array[rows]
+        powers_2D_array = np.load(os.path.join(store_dir, "powers.npy"), mmap_mode='r')[rows]
+        # Original order of the rows, for the subsampling of the 'radius' mode
+        row_order = np.load(os.path.join(store_dir, "order.npy"), mmap_mode='r')[rows]
+    print(f"Number of bursts within the neighbor search radius of the affected targets: {len(rows)} / {len(new_bursts_mask)}")
+
+    previous_results = [f for f in os.listdir(path) if f.startswith('rsr_results_') and f.endswith('.csv')]
+
+    output_name = "rsr_results_update_" + datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+    apply_rsr(latlon_target_array[affected], latlon_array, powers_2D_array, path,
+              xy_target_array=xy_target_array[affected], xy_array=xy_array, output_name=output_name, row_order=row_order, **kwargs)
+
+    # Remove the previous results of the affected targets
+    affected_targets = set(map(tuple, np.round(latlon_target_array[affected], 9)))
+    for csv_file in previous_results:
+        data = pd.read_csv(os.path.join(path, csv_file))
+        keep = [(round(lat, 9), round(lon, 9)) not in affected_targets for lat, lon in zip(data['lat'], data['lon'])]
+        if not all(keep):
+            data[keep].to_csv(os.path.join(path, csv_file), index=False)
+
+    print("RSR update completed and results saved.")
+
+
+def update_month(path, year, month, run_report=True, **kwargs):
+    """Update the PSEP store and the RSR results of a month with the newly arrived products.
+
+    Args:
+        path (str): The path to the work directory.
+        year (str): The year of the products to process. (e.g. "2018")
+        month (str): The month of the products to process. (e.g. "01")
+        run_report (bool, optional): Whether to save the duration and throughput of each stage in path/reports/update_month_<date>.json. Defaults to True.
+        **kwargs: Additional keyword arguments for extract_psep and apply_rsr_arctic.
+    """
+    reset('update_month')
+    new_products = extract_new_products(path, year, month, **kwargs)
+    if new_products:
+        apply_rsr_update(path, new_products, **kwargs)
+
+    if run_report:
+        write_report(report_filename(path, 'update_month'))
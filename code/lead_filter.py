@@ -1,35 +1,26 @@
-from scipy.spatial import cKDTree
-from utils import latlon_to_cartesian
+from spatial_index import SpatialIndex, latlon_to_xy
+from run_stats import stage
 import pandas as pd
 
 
 def create_lead_KDtree(filename):
-    """Create a KD-tree from lead coordinates in a CSV file.
+    """Create a spatial index from lead coordinates in a CSV file.
 
     Args:
         filename (str): The path to the CSV file containing lead coordinates.
 
     Returns:
-        tuple: A tuple containing the KD-tree and a dictionary mapping coordinates to lead and sea ice classes.
+        tuple: A tuple containing the spatial index (EPSG:3413) and an array of shape (N, 2) with the lead and sea ice classes of each indexed point.
     """
     
     print("Creating KD-tree for lead coordinates...")
     
-    data = pd.read_csv(filename)
+    with stage('lead_file_read'):
+        data = pd.read_csv(filename)
     coords_and_leadclass = data[[' Latitude', ' Longitude',' Lead_Class', ' Sea_Ice_Class']].values
-    
-    lead_coords = []
-    lead_class_list = []
-    sea_ice_class_list = []
-    for (lat, lon, lead_class, sea_ice_class) in coords_and_leadclass:
-        if(lat>=72.0):
-            lead_coords.append(latlon_to_cartesian(lat, lon))
-            lead_class_list.append(lead_class)
-            sea_ice_class_list.append(sea_ice_class)
-
-    dictionary = { tuple(coord) : (lead_class, sea_ice_class) for coord, lead_class, sea_ice_class in zip(lead_coords, lead_class_list, sea_ice_class_list) }
+    coords_and_leadclass = coords_and_leadclass[coords_and_leadclass[:, 0] >= 72.0]
 
-    return cKDTree(lead_coords), dictionary
+    return SpatialIndex.from_latlon(coords_and_leadclass[:, 0:2]), coords_and_leadclass[:, 2:4]
 
 
 def lead_SeaIce_mask(points_latlon, lead_SeaIce_KDtree, lead_SeaIce_dictionary):
@@ -37,14 +28,15 @@ def lead_SeaIce_mask(points_latlon, lead_SeaIce_KDtree, lead_SeaIce_dictionary):
     Compute the mask for lead and sea ice points.
 
     Args:
-        points_latlon (list): A list of tuples containing (latitude, longitude) coordinates.
-        lead_SeaIce_KDtree (cKDTree): The KD-tree containing lead coordinates.
-        lead_SeaIce_dictionary (dict): A dictionary mapping coordinates to lead and sea ice classes.
+        points_latlon (np.ndarray): An array of (latitude, longitude) coordinates.
+        lead_SeaIce_KDtree (SpatialIndex): The spatial index containing lead coordinates.
+        lead_SeaIce_dictionary (np.ndarray): The lead and sea ice classes of each point of the spatial index.
 
     Returns:
-        list: A list of bool masking the (not(lead) and Sea Ice) 
+        np.ndarray: An array of bool masking the (not(lead) and Sea Ice) 
             (True if not a lead and is sea ice).
     """
-    points_xyz = [latlon_to_cartesian(lat, lon) for lat, lon in points_latlon]
-    _, indices = lead_SeaIce_KDtree.query(points_xyz, k=1)
-    return [lead_SeaIce_dictionary[tuple(lead_SeaIce_KDtree.data[idx])] == (0,1) for idx in indices]
+    with stage('lead_filter', bursts=len(points_latlon)):
+        _, indices = lead_SeaIce_KDtree.query(latlon_to_xy(points_latlon), k=1)
+        classes = lead_SeaIce_dictionary[indices[:, 0]]
+        return (classes[:, 0] == 0) & (classes[:, 1] == 1)
@@ -1,7 +1,3 @@
-from extract_psep import extract_psep
-from apply_rsr import apply_rsr_arctic
-from plot_rsr_results import plot_rsr_results
-
 if __name__ == "__main__":
     """
     Main entry point for the script.
@@ -10,8 +6,16 @@ if __name__ == "__main__":
     1. First, run it to extract the PSEP (Peak Surface Echo Power)
     2. Then, run it to apply rsr
     3. Plot the results
+
+    To run these steps for several months, running again only the steps whose parameters or inputs changed,
+    use pipeline.py (cf README).
     """
     
+    # Imported here, so that the worker processes started with 'spawn' do not import them again
+    from extract_psep import extract_psep
+    from apply_rsr import apply_rsr_arctic
+    from plot_rsr_results import plot_rsr_results
+
     year = "2017"
     month = "11"
     
@@ -0,0 +1,289 @@
+from extraction_manifest import ExtractionManifest, MANIFEST_NAME
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from multiprocessing import Manager
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import traceback
+
+
+# Stages of the pipeline, in the order they are run
+STAGES = ["extract_psep", "apply_rsr_arctic", "plot_rsr_results"]
+
+# Parameters which do not change the output of a stage, left out of its fingerprint
+NON_OUTPUT_PARAMETERS = {'nb_cores', 'nb_workers', 'password', 'run_report', 'use_numba', 'fit_cache_max_entries', 'nb_files_per_batch',
+                         'auto_tune', 'nb_connections'}
+
+# Number of cores used by each stage, from its parameters (default of the stage if not given)
+STAGE_CORES = {"extract_psep": lambda parameters: parameters.get('nb_workers', 8),
+               "apply_rsr_arctic": lambda parameters: parameters.get('nb_cores', 8),
+               "plot_rsr_results": lambda parameters: 1}
+
+
+def fingerprint(*items):
+    """Hexadecimal blake2b hash of JSON-serializable items."""
+    return hashlib.blake2b(json.dumps(items, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+
+def psep_fingerprint(path):
+    """Fingerprint of the extracted PSEP of a month: the extracted products and their checksums (cf ExtractionManifest),
+    and the names and sizes of the PSEP csv files."""
+    psep_dir = os.path.join(path, "psep")
+    if not os.path.isdir(psep_dir):
+        return None
+    manifest = ExtractionManifest(psep_dir)
+    products = sorted((product, record.get('checksum')) for product, record in manifest.records.items() if record['status'] == 'done')
+    csv_files = sorted((f, os.path.getsize(os.path.join(psep_dir, f))) for f in os.listdir(psep_dir) if f.startswith('psep') and f.endswith('.csv'))
+    return fingerprint(products, csv_files)
+
+
+def failed_products(path):
+    """Products of nc_files_to_read.txt whose last extraction failed (cf ExtractionManifest)."""
+    psep_dir = os.path.join(path, "psep")
+    nc_files_to_read_path = os.path.join(path, "nc_files_to_read.txt")
+    if not os.path.isdir(psep_dir) or not os.path.exists(nc_files_to_read_path):
+        return []
+    manifest = ExtractionManifest(psep_dir)
+    with open(nc_files_to_read_path, 'r') as f:
+        nc_files = [line.strip() for line in f if line.strip()]
+    return [product for product in nc_files if product in manifest.records and manifest.records[product]['status'] != 'done']
+
+
+def stage_fingerprint(stage, parameters, path, upstream):
+    """Fingerprint of the output of a stage, from its parameters and inputs.
+
+    Args:
+        stage (str): Name of the stage.
+        parameters (dict): Keyword arguments of the stage.
+        path (str): Path to the work directory of the month.
+        upstream (str): Fingerprint of the previous stage (None for the first stage).
+
+    Returns:
+        str: Fingerprint of the stage.
+    """
+    parameters = {name: value for name, value in parameters.items() if name not in NON_OUTPUT_PARAMETERS}
+    # RSR reads the PSEP csv files, which can also be updated outside of the pipeline (e.g. update_month)
+    inputs = psep_fingerprint(path) if stage == "apply_rsr_arctic" else upstream
+    return fingerprint(stage, parameters, inputs)
+
+
+def stage_record_path(path, stage):
+    """Path of the record of the last completed run of a stage : path/pipeline/<stage>.json"""
+    return os.path.join(path, "pipeline", stage + ".json")
+
+
+def read_stage_record(path, stage):
+    """Record of the last completed run of a stage, or None."""
+    record_path = stage_record_path(path, stage)
+    if not os.path.exists(record_path):
+        return None
+    with open(record_path, 'r') as f:
+        return json.load(f)
+
+
+def clear_psep(path):
+    """Remove the PSEP extracted with other parameters (csv files, manifest, consolidated store and cell buffers)."""
+    psep_dir = os.path.join(path, "psep")
+    if not os.path.isdir(psep_dir):
+        return
+    for f in os.listdir(psep_dir):
+        if (f.startswith('psep') and f.endswith('.csv')) or f == MANIFEST_NAME:
+            os.remove(os.path.join(psep_dir, f))
+    shutil.rmtree(os.path.join(psep_dir, "psep_store"), ignore_errors=True)
+    shutil.rmtree(os.path.join(psep_dir, "cell_buffers"), ignore_errors=True)
+
+
+def run_stage(stage, path, year, month, parameters):
+    """Run a stage of the pipeline for a month.
+
+    The stages are imported when they are run, so that their dependencies (e.g. basemap for the plots)
+    are only required by the configurations using them.
+    """
+    if stage == "extract_psep":
+        from extract_psep import extract_psep
+        extract_psep(path, year, month, **parameters)
+    elif stage == "apply_rsr_arctic":
+        from apply_rsr import apply_rsr_arctic
+        apply_rsr_arctic(path, **parameters)
+    elif stage == "plot_rsr_results":
+        from plot_rsr_results import plot_rsr_results
+        plot_rsr_results(path, year, month, **parameters)
+    else:
+        raise ValueError(f"Unknown stage: {stage}. Expected one of {STAGES}.")
+
+
+def run_month(path, year, month, stages, force=(), dry_run=False, cores=None, lock=None, max_workers=None, log_filename=None):
+    """Run the stale stages of the pipeline for a month.
+
+    A stage is stale if it never completed, if its fingerprint (cf stage_fingerprint) changed since
+    its last completed run, or if a previous stage was run again. The extraction also stays stale while
+    products of the month failed (cf failed_products), only these products being extracted again. When
+    the extraction parameters changed, the PSEP extracted with the previous parameters is removed first.
+
+    Args:
+        path (str): Path to the work directory of the month.
+        year (str): Year of the month. (e.g. "2017")
+        month (str): Month. (e.g. "11")
+        stages (dict): Parameters of the stages to run, by stage name.
+        force (list, optional): Stages to run even if they are not stale. Defaults to ().
+        dry_run (bool, optional): Whether to only list the stale stages. Defaults to False.
+        cores (Semaphore, optional): Global worker budget shared by the months, each stage acquiring its number of cores. Defaults to None.
+        lock (Lock, optional): Lock taken to acquire several cores at once. Defaults to None.
+        max_workers (int, optional): Size of the worker budget. Defaults to None.
+        log_filename (str, optional): File receiving the output of the stages. Defaults to None (standard output).
+
+    Returns:
+        list: (stage, status) of each stage, the status being 'fresh', 'stale' (dry run), 'done' or 'failed: <error>'.
+    """
+    if log_filename is not None:
+        os.makedirs(os.path.dirname(log_filename), exist_ok=True)
+        log = os.open(log_filename, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+        # Redirection of the file descriptors, inherited by the worker processes of the stages
+        os.dup2(log, 1)
+        os.dup2(log, 2)
+
+    statuses = []
+    upstream = None
+    rerun = False
+    for stage in STAGES:
+        if stage not in stages:
+            continue
+        parameters = stages[stage] or {}
+        current = stage_fingerprint(stage, parameters, path, upstream)
+        record = read_stage_record(path, stage)
+        stale = rerun or stage in force or record is None or record['fingerprint'] != current
+        retry = False
+        if stage == "extract_psep" and not stale:
+            failed = failed_products(path)
+            if failed:
+                print(f"{year}-{month}: {len(failed)} products failed in the previous extraction", flush=True)
+                stale = retry = True
+        if not stale:
+            statuses.append((stage, 'fresh'))
+            upstream = current
+            continue
+        if dry_run:
+            statuses.append((stage, 'stale'))
+            rerun = not retry
+            continue
+
+        print(f"{year}-{month}: running {stage}", flush=True)
+        if stage == "extract_psep" and record is not None and record['fingerprint'] != current:
+            print(f"{year}-{month}: extraction parameters changed, removing the previous PSEP", flush=True)
+            clear_psep(path)
+
+        nb_cores = min(STAGE_CORES[stage](parameters), max_workers) if max_workers else 0
+        if cores is not None:
+            with lock:
+                for _ in range(nb_cores):
+                    cores.acquire()
+        start = datetime.now(timezone.utc).isoformat()
+        try:
+            run_stage(stage, path, year, month, parameters)
+        except Exception as e:
+            traceback.print_exc()
+            statuses.append((stage, f'failed: {e!r}'))
+            break
+        finally:
+            if cores is not None:
+                for _ in range(nb_cores):
+                    cores.release()
+
+        # The fingerprint of the RSR inputs is only known once the PSEP is extracted
+        current = stage_fingerprint(stage, parameters, path, upstream)
+        os.makedirs(os.path.join(path, "pipeline"), exist_ok=True)
+        with open(stage_record_path(path, stage), 'w') as f:
+            json.dump({'fingerprint': current, 'parameters': parameters, 'upstream': upstream, 'start': start,
+                       'end': datetime.now(timezone.utc).isoformat()}, f, indent=1, default=str)
+        statuses.append((stage, 'done'))
+        upstream = current
+        # After a retry of the failed products, RSR is stale only if new PSEP was extracted (cf psep_fingerprint)
+        rerun = not retry
+    return statuses
+
+
+def config_months(config):
+    """(year, month) of the months of a pipeline configuration, given as "YYYY-MM" or "YYYY" (whole year)."""
+    months = []
+    for entry in config['months']:
+        entry = str(entry)
+        if '-' in entry:
+            year, month = entry.split('-')
+            months.append((year, month.zfill(2)))
+        else:
+            months.extend((entry, f"{month:02d}") for month in range(1, 13))
+    return months
+
+
+def run_pipeline(config, force=(), dry_run=False, max_workers=None):
+    """Run the stale stages of the pipeline for the months of a configuration.
+
+    The configuration is a dictionary (cf README), e.g.
+    {"path": "./Cryosat_RSR_SAR_FBR_{year}_{month}", "months": ["2017-11", "2018"], "max_workers": 16,
+     "stages": {"extract_psep": {"password": "..."}, "apply_rsr_arctic": {"nb_cores": 8, "step_km": 10}, "plot_rsr_results": {}}}
+
+    The months are independent and run concurrently, in separate processes, as long as the number of
+    cores used by their running stages stays within max_workers. Their output is then written in
+    <path>/pipeline/log_<date>.txt.
+
+    Args:
+        config (dict): Pipeline configuration.
+        force (list, optional): Stages to run even if they are not stale. Defaults to ().
+        dry_run (bool, optional): Whether to only list the stale stages. Defaults to False.
+        max_workers (int, optional): Global worker budget, overriding the one of the configuration. Defaults to None.
+
+    Returns:
+        dict: (stage, status) of the stages of each month (cf run_month), by "YYYY-MM".
+    """
+    months = config_months(config)
+    stages = {stage: config['stages'][stage] for stage in STAGES if stage in config['stages']}
+    unknown_stages = set(config['stages']) - set(STAGES)
+    if unknown_stages:
+        raise ValueError(f"Unknown stages: {sorted(unknown_stages)}. Expected some of {STAGES}.")
+    max_workers = max_workers or config.get('max_workers', os.cpu_count())
+    # Months running at the same time, each one using at least one core
+    max_months = 1 if dry_run else min(len(months), max_workers)
+    date = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')
+
+    statuses = {}
+    if max_months <= 1:
+        for year, month in months:
+            path = config['path'].format(year=year, month=month)
+            statuses[f"{year}-{month}"] = run_month(path, year, month, stages, force=force, dry_run=dry_run)
+    else:
+        with Manager() as manager, ProcessPoolExecutor(max_workers=max_months) as executor:
+            cores, lock = manager.Semaphore(max_workers), manager.Lock()
+            futures = {}
+            for year, month in months:
+                path = config['path'].format(year=year, month=month)
+                log_filename = os.path.join(path, "pipeline", f"log_{date}.txt")
+                print(f"{year}-{month}: output in {log_filename}")
+                futures[f"{year}-{month}"] = executor.submit(run_month, path, year, month, stages, force=force, cores=cores,
+                                                             lock=lock, max_workers=max_workers, log_filename=log_filename)
+            for name, future in futures.items():
+                statuses[name] = future.result()
+
+    for name, month_statuses in statuses.items():
+        print(f"{name}: " + ", ".join(f"{stage} {status}" for stage, status in month_statuses))
+    return statuses
+
+
+if __name__ == "__main__":
+    """
+    Staged pipeline over several months, running only the stages whose parameters or inputs changed :
+        python pipeline.py CONFIG.json [--dry-run] [--force apply_rsr_arctic ...] [--max-workers 16]
+    """
+
+    parser = argparse.ArgumentParser(description="Run the stale stages of the RSR pipeline for several months")
+    parser.add_argument("config", help="JSON configuration file")
+    parser.add_argument("--dry-run", action="store_true", help="Only list the stale stages")
+    parser.add_argument("--force", nargs="+", default=[], choices=STAGES, help="Stages to run even if they are not stale")
+    parser.add_argument("--max-workers", type=int, help="Global worker budget (overrides the configuration)")
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+    run_pipeline(config, force=args.force, dry_run=args.dry_run, max_workers=args.max_workers)
@@ -4,7 +4,9 @@ from mpl_toolkits.basemap import Basemap
 import pandas as pd
 import json
 import os
-from utils import read_psep_from_csv, build_KDtree, find_closest_points
+from utils import read_psep_from_csv
+from spatial_index import SpatialIndex, latlon_to_xy, find_neighborhoods
+from fit_cache import FitCache, compute_psep_fingerprint, fit_key
 import rsr
 import matplotlib.patches as mpatches
 
@@ -196,7 +198,7 @@ def plot_rsr_results(path_to_data, year, month, latlon_target_list=None, blurry=
     print("Plots saved in ", path_to_data)
 
 
-def plot_distributions(path, latlon_target_list, year, month, nb_closest=1000, min_method='least_squares', **kwargs):
+def plot_distributions(path, latlon_target_list, year, month, nb_closest=1000, min_method='least_squares', use_fit_cache=False, fit_cache_max_entries=1000000, **kwargs):
     """Plot the power distributions for targets, as well as the HK model fits.
 
     Args:
@@ -205,29 +207,54 @@ def plot_distributions(path, latlon_target_list, year, month, nb_closest=1000, m
         year (str): Year of the data.
         month (str): Month of the data.
         nb_closest (int): Number of closest points to consider for each target. (e.g. if you indicate 1000, there will be 64000 psep values in input of the rsr, as each burst is composed of 64 echoes)
+            Other keyword arguments of find_neighborhoods select a radius-bounded neighborhood instead.
         min_method (str): Minimization method used in the lmfit HK-fitting. Defaults to 'least_squares'.
+        use_fit_cache (bool): Whether to read and store the HK fits in the fit cache of the data directory. Defaults to False.
+        fit_cache_max_entries (int): Maximum number of fits kept in the fit cache. Defaults to 1000000.
     """
     
     # Find the 1000 closest psep
     
-    latlon_array, powers_2D_array = read_psep_from_csv(os.path.join(path, "psep"))
+    latlon_array, powers_2D_array, xy_array = read_psep_from_csv(os.path.join(path, "psep"), return_xy=True)
     
-    KD_tree, dictionary = build_KDtree(latlon_array)
+    psep_index = SpatialIndex(xy_array)
+    indices_closest_array = find_neighborhoods(psep_index, latlon_to_xy(latlon_target_list), nb_closest=nb_closest, **kwargs)
+    
+    # Skip the under-sampled targets (empty neighborhoods)
+    for latlon_target, indices_closest in zip(latlon_target_list, indices_closest_array):
+        if len(indices_closest) == 0:
+            print(f"Not enough psep values around {latlon_target}, target skipped")
+    latlon_target_list = [latlon_target for latlon_target, indices_closest in zip(latlon_target_list, indices_closest_array) if len(indices_closest) > 0]
+    indices_closest_array = [indices_closest for indices_closest in indices_closest_array if len(indices_closest) > 0]
     
     powers_list = []
+    indices_closest_list = []
     
-    for latlon_target in latlon_target_list:
-        xyz_closest = find_closest_points(KD_tree, latlon_target, k=nb_closest)
-        xyz_closest = xyz_closest[0]  # If only one target, we get a single array instead of a list of arrays
-        indices_closest = [dictionary[tuple(point)] for point in xyz_closest]
+    for indices_closest in indices_closest_array:
         powers_for_rsr = powers_2D_array[indices_closest]
         powers_for_rsr = powers_for_rsr.flatten() 
         powers_list.append(powers_for_rsr)
+        indices_closest_list.append(indices_closest)
 
     
-    # Apply rsr
+    # Apply rsr, unless the fit is already in the fit cache
+
+    if use_fit_cache:
+        fit_cache = FitCache(os.path.join(path, 'fit_cache.sqlite'), max_entries=fit_cache_max_entries)
+        fingerprint = compute_psep_fingerprint(latlon_array, powers_2D_array)
+        keys = [fit_key(indices_closest, fingerprint, min_method) for indices_closest in indices_closest_list]
+        f_list = fit_cache.get_many(keys)
+    else:
+        f_list = [None] * len(powers_list)
+    targets_to_fit = [i for i, f in enumerate(f_list) if f is None]
+
+    for i in targets_to_fit:
+        f_list[i] = rsr.run.processor(powers_list[i], fit_model='hk', min_method=min_method)
+
+    if use_fit_cache:
+        fit_cache.put_many([keys[i] for i in targets_to_fit], [f_list[i] for i in targets_to_fit])
+        fit_cache.close()
 
-    f_list = [rsr.run.processor(powers, fit_model='hk', min_method=min_method) for powers in powers_list]
     pw_range_list = [(min(powers), max(powers)) for powers in powers_list]
     pdf_list = [rsr.pdf.hk(f.values, np.linspace(min_p, max_p, 1000)) for f, (min_p, max_p) in zip(f_list, pw_range_list)]
     
@@ -0,0 +1,215 @@
+import numpy as np
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+# Pure NumPy kernels
+
+def _power_waveforms_numpy(spectra):
+    return (spectra.real**2 + spectra.imag**2) / spectra.shape[1]
+
+
+def _leading_edges_numpy(waveforms, window_sizes):
+    nb_positions = waveforms.shape[1] - window_sizes.max()
+    positions = np.arange(nb_positions)
+    mean_slopes = np.zeros((waveforms.shape[0], nb_positions))
+    for window_size in window_sizes:
+        # Mean of np.gradient over waveform[i:i+window_size]
+        slope = (0.5*waveforms[:, positions + 1] - 1.5*waveforms[:, positions]
+                 + 1.5*waveforms[:, positions + window_size - 1] - 0.5*waveforms[:, positions + window_size - 2]) / window_size
+        mean_slopes = mean_slopes + slope
+    mean_slopes = mean_slopes / len(window_sizes)
+    return np.argmax(mean_slopes, axis=1)
+
+
+def _windowed_argmax_numpy(waveforms, starts, window_size):
+    nb_echoes, nb_samples = waveforms.shape
+    positions = starts[:, None] + np.arange(window_size)[None, :]
+    valid = positions < nb_samples
+    window = np.where(valid, waveforms[np.arange(nb_echoes)[:, None], np.minimum(positions, nb_samples - 1)], -np.inf)
+    return starts + np.argmax(window, axis=1)
+
+
+# Numba kernels, with the same arithmetic as the NumPy kernels
+
+if NUMBA_AVAILABLE:
+
+    @njit(cache=True)
+    def _power_waveforms_numba(spectra):
+        nb_echoes, nb_samples = spectra.shape
+        out = np.empty((nb_echoes, nb_samples))
+        for e in range(nb_echoes):
+            for i in range(nb_samples):
+                out[e, i] = (spectra[e, i].real**2 + spectra[e, i].imag**2) / nb_samples
+        return out
+
+    @njit(cache=True)
+    def _leading_edges_numba(waveforms, window_sizes):
+        nb_echoes, nb_samples = waveforms.shape
+        nb_positions = nb_samples - window_sizes.max()
+        out = np.zeros(nb_echoes, dtype=np.int64)
+        for e in range(nb_echoes):
+            x = waveforms[e]
+            best = -np.inf
+            for i in range(nb_positions):
+                mean_slope = 0.
+                for window_size in window_sizes:
+                    mean_slope = mean_slope + (0.5*x[i + 1] - 1.5*x[i]
+                                               + 1.5*x[i + window_size - 1] - 0.5*x[i + window_size - 2]) / window_size
+                mean_slope = mean_slope / len(window_sizes)
+                # Same tie and NaN handling as np.argmax
+                if np.isnan(mean_slope):
+                    out[e] = i
+                    break
+                if mean_slope > best:
+                    best = mean_slope
+                    out[e] = i
+        return out
+
+    @njit(cache=True)
+    def _windowed_argmax_numba(waveforms, starts, window_size):
+        nb_echoes, nb_samples = waveforms.shape
+        out = np.zeros(nb_echoes, dtype=np.int64)
+        for e in range(nb_echoes):
+            start = starts[e]
+            out[e] = start
+            best = -np.inf
+            for i in range(start, min(start + window_size, nb_samples)):
+                if np.isnan(waveforms[e, i]):
+                    out[e] = i
+                    break
+                if waveforms[e, i] > best:
+                    best = waveforms[e, i]
+                    out[e] = i
+        return out
+
+
+def power_waveforms(complex_echoes, use_numba=True):
+    """Compute the range-compressed power waveforms of complex echoes.
+
+    Args:
+        complex_echoes (np.ndarray): Array of shape (E, L) of complex echoes.
+        use_numba (bool, optional): Whether to use the Numba kernel if Numba is installed. Defaults to True.
+
+    Returns:
+        np.ndarray: Array of shape (E, L) of power waveforms.
+    """
+    spectra = np.fft.fftshift(np.fft.fft(np.asarray(complex_echoes, dtype=np.complex128), axis=1), axes=1)
+    if use_numba and NUMBA_AVAILABLE:
+        return _power_waveforms_numba(spectra)
+    return _power_waveforms_numpy(spectra)
+
+
+def leading_edges(waveforms, window_sizes, use_numba=True):
+    """Compute the leading edge index of each waveform.
+
+    The leading edge is the position maximizing the mean slope (mean of np.gradient)
+    over windows of the given sizes, averaged over the window sizes.
+
+    Args:
+        waveforms (np.ndarray): Array of shape (E, L) of power waveforms.
+        window_sizes (list): Sizes of the windows used to compute the slopes (>= 2).
+        use_numba (bool, optional): Whether to use the Numba kernel if Numba is installed. Defaults to True.
+
+    Returns:
+        np.ndarray: Array of shape (E,) of leading edge indices.
+    """
+    waveforms = np.ascontiguousarray(waveforms, dtype=np.float64)
+    window_sizes = np.asarray(window_sizes, dtype=np.int64)
+    if use_numba and NUMBA_AVAILABLE:
+        return _leading_edges_numba(waveforms, window_sizes)
+    return _leading_edges_numpy(waveforms, window_sizes)
+
+
+def windowed_argmax(waveforms, starts, window_size, use_numba=True):
+    """Compute the index of the maximum of each waveform in [start, start + window_size).
+
+    Args:
+        waveforms (np.ndarray): Array of shape (E, L) of power waveforms.
+        starts (np.ndarray): Array of shape (E,) of window starts.
+        window_size (int): The window size (>= 1).
+        use_numba (bool, optional): Whether to use the Numba kernel if Numba is installed. Defaults to True.
+
+    Returns:
+        np.ndarray: Array of shape (E,) of the indices of the maxima.
+    """
+    waveforms = np.ascontiguousarray(waveforms, dtype=np.float64)
+    starts = np.asarray(starts, dtype=np.int64)
+    if use_numba and NUMBA_AVAILABLE:
+        return _windowed_argmax_numba(waveforms, starts, window_size)
+    return _windowed_argmax_numpy(waveforms, starts, window_size)
+
+
+def psep_echoes(complex_echoes, gain, window_frac_psep=0.05, window_frac_leading_edge=[0.03,0.06,0.09], use_numba=True, **kwargs):
+    """Extracts the calibrated PSEP (Peak Surface Echo Power) of several complex echoes at once.
+
+    Args:
+        complex_echoes (np.ndarray): Array of shape (E, L) of complex echoes.
+        gain (float): The gain to apply for calibration.
+        window_frac_psep (float, optional): The fraction of the window size to use for max power extraction. Defaults to 0.05.
+        window_frac_leading_edge (list, optional): The fractions of the window sizes used to compute the slopes. Defaults to [0.03,0.06,0.09].
+        use_numba (bool, optional): Whether to use the Numba kernels if Numba is installed. Defaults to True.
+
+    Returns:
+        np.ndarray: Array of shape (E,) of the calibrated PSEP values (dB).
+    """
+    waveforms = power_waveforms(complex_echoes, use_numba=use_numba)
+    return psep_from_waveforms(waveforms, gain, window_frac_psep=window_frac_psep,
+                               window_frac_leading_edge=window_frac_leading_edge, use_numba=use_numba)
+
+
+def psep_from_waveforms(waveforms, gain, window_frac_psep=0.05, window_frac_leading_edge=[0.03,0.06,0.09], use_numba=True, **kwargs):
+    """Extracts the calibrated PSEP (Peak Surface Echo Power) of power waveforms.
+
+    Args:
+        waveforms (np.ndarray): Array of shape (E, L) of power waveforms.
+        gain (float or np.ndarray): The gain to apply for calibration, for all the echoes or for each one (shape (E,)).
+        window_frac_psep (float, optional): The fraction of the window size to use for max power extraction. Defaults to 0.05.
+        window_frac_leading_edge (list, optional): The fractions of the window sizes used to compute the slopes. Defaults to [0.03,0.06,0.09].
+        use_numba (bool, optional): Whether to use the Numba kernels if Numba is installed. Defaults to True.
+
+    Returns:
+        np.ndarray: Array of shape (E,) of the calibrated PSEP values (dB).
+    """
+    waveforms = np.ascontiguousarray(waveforms, dtype=np.float64)
+    nb_samples = waveforms.shape[1]
+
+    window_sizes = [int(wf * nb_samples) for wf in window_frac_leading_edge]
+    leading_edge_indices = leading_edges(waveforms, window_sizes, use_numba=use_numba)
+
+    window_size = max(int(window_frac_psep * nb_samples), 1)
+    psep_indices = windowed_argmax(waveforms, leading_edge_indices, window_size, use_numba=use_numba)
+    psep_count = waveforms[np.arange(len(waveforms)), psep_indices]
+
+    # Convert to dB and apply calibration
+    with np.errstate(divide='ignore'):
+        psep_db = 10 * np.log10(psep_count)
+    return psep_db + gain
+
+
+def encode_waveforms(waveforms, dtype='float32'):
+    """Convert power waveforms to the dtype of the waveform cache.
+
+    In float16, each echo is divided by its maximum (kept in float32), as the powers exceed the
+    float16 range. The leading edge and the PSEP position do not depend on the scale of the echo.
+
+    Args:
+        waveforms (np.ndarray): Power waveforms, shape (..., L).
+        dtype (str, optional): 'float32' or 'float16'. Defaults to 'float32'.
+
+    Returns:
+        waveforms (np.ndarray): Waveforms in dtype.
+        scales (np.ndarray): Maximum of each echo in float16 (float32, shape (...)), None in float32.
+    """
+    if dtype not in ('float32', 'float16'):
+        raise ValueError(f"Unknown waveform cache dtype: {dtype}. Expected 'float32' or 'float16'.")
+    waveforms = np.asarray(waveforms)
+    if dtype == 'float32':
+        return waveforms.astype(np.float32), None
+    scales = waveforms.max(axis=-1, keepdims=True) if waveforms.size else np.ones(waveforms.shape[:-1] + (1,))
+    scales[scales <= 0] = 1
+    return (waveforms / scales).astype(np.float16), scales[..., 0].astype(np.float32)
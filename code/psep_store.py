@@ -0,0 +1,182 @@
+from utils import read_psep_from_csv, psep_csv_files
+from run_stats import stage
+import json
+import os
+import shutil
+import numpy as np
+
+
+STORE_NAME = "psep_store"
+
+# Extent of the EPSG:3413 zone of the Arctic grid (in meters), cf arctic_grid
+X_MIN, Y_MIN, EXTENT = -2500000, -2500000, 5000000
+
+
+def morton_keys(xy_array, bits=16):
+    """Compute the Morton (Z-order) key of each point, from its EPSG:3413 coordinates.
+
+    The coordinates are quantized on a 2**bits x 2**bits grid over the Arctic zone (76 m cells
+    for 16 bits), and the bits of the cell indices are interleaved, so that close points have
+    close keys.
+
+    Args:
+        xy_array (np.ndarray): EPSG:3413 coordinates of the points (m), shape (N, 2).
+        bits (int, optional): Number of bits per coordinate (<= 32). Defaults to 16.
+
+    Returns:
+        np.ndarray: Array of shape (N,) of uint64 keys.
+    """
+    cells = ((np.asarray(xy_array, dtype=np.float64) - (X_MIN, Y_MIN)) / EXTENT * 2**bits)
+    cells = np.clip(np.nan_to_num(cells), 0, 2**bits - 1).astype(np.uint64)
+    keys = np.zeros(len(cells), dtype=np.uint64)
+    for bit in range(bits):
+        keys |= ((cells[:, 0] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2*bit)
+        keys |= ((cells[:, 1] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2*bit + 1)
+    return keys
+
+
+def _csv_files_state(psep_dir):
+    """Name, size and modification time of the PSEP csv files, to detect changes since the consolidation."""
+    csv_files = sorted(f for f in os.listdir(psep_dir) if f.endswith('.csv') and f.startswith('psep'))
+    return [[f, os.path.getsize(os.path.join(psep_dir, f)), os.path.getmtime(os.path.join(psep_dir, f))] for f in csv_files]
+
+
+def consolidate_psep(psep_dir, chunk_bursts=None):
+    """Consolidate the PSEP csv files in a compact spatially sorted store, in psep_dir/psep_store.
+
+    The bursts are sorted by Morton key, so that the neighbors of a target are in a few contiguous
+    blocks of the arrays. The store is made of .npy files, which can be memory-mapped:
+    powers.npy (float32, shape (N, 64)), latlon.npy and xy.npy (float64, shape (N, 2)), products.npy,
+    and order.npy, the row of each burst in the order of read_psep_from_csv
+    (i.e. powers_csv[order] == powers_store).
+
+    With chunk_bursts, the csv files are read one at a time and the store is written by chunks of
+    chunk_bursts bursts, so that only the Morton keys and the sort order (16 bytes per burst) are
+    held in memory for the whole month (cf rsr_blocks.py).
+
+    Args:
+        psep_dir (str): Path to the directory of the PSEP csv files.
+        chunk_bursts (int, optional): Number of bursts written at once. Defaults to None (all the bursts read in memory).
+
+    Returns:
+        str: Path to the store.
+    """
+    store_dir = os.path.join(psep_dir, STORE_NAME)
+    os.makedirs(store_dir, exist_ok=True)
+    if os.path.exists(os.path.join(store_dir, "meta.json")):
+        os.remove(os.path.join(store_dir, "meta.json"))
+    state = _csv_files_state(psep_dir)
+
+    if chunk_bursts is not None:
+        nb_bursts = _consolidate_psep_by_chunks(psep_dir, store_dir, chunk_bursts)
+    else:
+        latlon_array, powers_2D_array, xy_array, products = read_psep_from_csv(psep_dir, return_xy=True, return_products=True)
+        nb_bursts = len(latlon_array)
+        with stage('consolidate_psep', bursts=len(latlon_array)):
+            order = np.argsort(morton_keys(xy_array), kind='stable')
+            arrays = {'latlon': latlon_array[order], 'xy': xy_array[order], 'order': order,
+                      'products': products[order],
+                      'powers': powers_2D_array.reshape(len(latlon_array), -1)[order].astype(np.float32)}
+            del powers_2D_array
+            for name, array in arrays.items():
+                np.save(os.path.join(store_dir, name + ".npy"), array)
+
+    # Written last : a store without meta.json is incomplete
+    with open(os.path.join(store_dir, "meta.json"), 'w') as f:
+        json.dump({'nb_bursts': nb_bursts, 'csv_files': state}, f, indent=1)
+    print(f"{nb_bursts} bursts consolidated in {store_dir}")
+    return store_dir
+
+
+def _consolidate_psep_by_chunks(psep_dir, store_dir, chunk_bursts):
+    """Write the store of consolidate_psep by chunks : the csv files are first appended to unsorted
+    files (in the order of read_psep_from_csv), which are then copied to the store in Morton order."""
+    unsorted_dir = os.path.join(store_dir, "unsorted")
+    os.makedirs(unsorted_dir, exist_ok=True)
+    columns = {'latlon': (np.float64, 2), 'xy': (np.float64, 2), 'powers': (np.float32, 64), 'products': (np.int32, 1)}
+    product_names = {}
+    nb_bursts = 0
+    files = {name: open(os.path.join(unsorted_dir, name + ".bin"), 'wb') for name in columns}
+    try:
+        for csv_file in psep_csv_files(psep_dir):
+            latlon_array, powers_2D_array, xy_array, products = read_psep_from_csv(psep_dir, return_xy=True, return_products=True, csv_files=[csv_file])
+            product_indices = np.array([product_names.setdefault(product, len(product_names)) for product in products], dtype=np.int32)
+            for name, array in (('latlon', latlon_array), ('xy', xy_array), ('powers', powers_2D_array.reshape(len(latlon_array), -1)), ('products', product_indices)):
+                np.ascontiguousarray(array, dtype=columns[name][0]).tofile(files[name])
+            nb_bursts += len(latlon_array)
+            del latlon_array, powers_2D_array, xy_array, products
+    finally:
+        for f in files.values():
+            f.close()
+
+    def unsorted(name):
+        dtype, width = columns[name]
+        return np.memmap(os.path.join(unsorted_dir, name + ".bin"), dtype=dtype, mode='r', shape=(nb_bursts, width) if width > 1 else (nb_bursts,))
+
+    with stage('consolidate_psep', bursts=nb_bursts):
+        keys = np.empty(nb_bursts, dtype=np.uint64)
+        for start in range(0, nb_bursts, chunk_bursts):
+            xy_unsorted = unsorted('xy')
+            keys[start:start + chunk_bursts] = morton_keys(xy_unsorted[start:start + chunk_bursts])
+            del xy_unsorted
+        order = np.argsort(keys, kind='stable')
+        del keys
+        np.save(os.path.join(store_dir, "order.npy"), order)
+
+        names = np.array(list(product_names) or [''])
+        for name in columns:
+            dtype, width = columns[name]
+            if name == 'products':
+                dtype = names.dtype
+            output = np.lib.format.open_memmap(os.path.join(store_dir, name + ".npy"), mode='w+', dtype=dtype,
+                                               shape=(nb_bursts, width) if width > 1 else (nb_bursts,))
+            for start in range(0, nb_bursts, chunk_bursts):
+                # The files are mapped again for each chunk, so that the pages read are released
+                rows = unsorted(name)[order[start:start + chunk_bursts]]
+                output[start:start + chunk_bursts] = names[rows] if name == 'products' else rows
+                output.flush()
+            del output
+    shutil.rmtree(unsorted_dir)
+    return nb_bursts
+
+
+def store_up_to_date(psep_dir):
+    """Whether the consolidated store exists and the csv files did not change since the consolidation."""
+    meta_path = os.path.join(psep_dir, STORE_NAME, "meta.json")
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path, 'r') as f:
+        return json.load(f)['csv_files'] == _csv_files_state(psep_dir)
+
+
+def load_psep_store(psep_dir, xy_bounds=None, mmap=True):
+    """Load the consolidated PSEP store, consolidating the csv files first if they changed since the last consolidation.
+
+    Args:
+        psep_dir (str): Path to the directory of the PSEP csv files.
+        xy_bounds (tuple, optional): (x_min, x_max, y_min, y_max) EPSG:3413 bounds (m). If provided, only the
+            bursts within these bounds are kept (in memory). Defaults to None.
+        mmap (bool, optional): Whether to memory-map the powers instead of reading them. Defaults to True.
+
+    Returns:
+        latlon_array (np.ndarray): Array of latitudes and longitudes.
+        powers_2D_array (np.ndarray): 2D array of power values (float32).
+        xy_array (np.ndarray): Array of EPSG:3413 x and y (m).
+        order (np.ndarray): Row of each burst in the order of read_psep_from_csv.
+    """
+    store_dir = os.path.join(psep_dir, STORE_NAME)
+    if not store_up_to_date(psep_dir):
+        print("Consolidating the PSEP csv files...")
+        consolidate_psep(psep_dir)
+
+    with stage('load_psep_store'):
+        latlon_array = np.load(os.path.join(store_dir, "latlon.npy"))
+        xy_array = np.load(os.path.join(store_dir, "xy.npy"))
+        order = np.load(os.path.join(store_dir, "order.npy"))
+        powers_2D_array = np.load(os.path.join(store_dir, "powers.npy"), mmap_mode='r' if mmap else None)
+
+    if xy_bounds is not None:
+        x_min, x_max, y_min, y_max = xy_bounds
+        mask = (xy_array[:, 0] >= x_min) & (xy_array[:, 0] < x_max) & (xy_array[:, 1] >= y_min) & (xy_array[:, 1] < y_max)
+        return latlon_array[mask], np.asarray(powers_2D_array[mask]), xy_array[mask], order[mask]
+    return latlon_array, powers_2D_array, xy_array, order
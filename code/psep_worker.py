@@ -0,0 +1,119 @@
+from netCDF4 import Dataset
+from psep_kernels import psep_echoes, power_waveforms, psep_from_waveforms, encode_waveforms
+from run_stats import stage, run_instrumented
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+
+# Entry points of the PSEP extraction worker processes. This module only imports what the workers need
+# (numpy, netCDF4 and the PSEP kernels), so that the workers start quickly with the 'spawn' and
+# 'forkserver' start methods (cf startup_benchmark.py).
+
+
+def init_worker(use_numba=True):
+    """Initializer of the worker processes : compiles (or loads from the Numba cache) the PSEP kernels
+    once per worker, instead of in its first task."""
+    psep_echoes(np.ones((1, 128), dtype=np.complex128), 0., use_numba=use_numba)
+
+
+class WorkerPool:
+    """Pool of PSEP extraction worker processes, reused for the bursts of several products.
+
+    The worker processes are started at the first task, and the pool is started again after a
+    worker died (cf restart), the other products being extracted by the new workers.
+    """
+
+    def __init__(self, nb_workers=8, use_numba=True):
+        """
+        Args:
+            nb_workers (int, optional): Number of worker processes. Defaults to 8.
+            use_numba (bool, optional): Whether the workers use the Numba kernels if Numba is installed. Defaults to True.
+        """
+        self.nb_workers = nb_workers
+        self.use_numba = use_numba
+        self._executor = None
+
+    def submit(self, function, *args, **kwargs):
+        """Submit a task to the workers, with its statistics (cf run_stats.run_instrumented)."""
+        if self._executor is None:
+            # Workers started with 'fork' inherit the kernels compiled by the parent process
+            init_worker(self.use_numba)
+            self._executor = ProcessPoolExecutor(max_workers=self.nb_workers, initializer=init_worker, initargs=(self.use_numba,))
+        return self._executor.submit(run_instrumented, function, *args, **kwargs)
+
+    def restart(self):
+        """Shut the workers down without waiting for their tasks, new workers being started at the next task."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def shutdown(self):
+        """Wait for the tasks and stop the workers."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def resize(self, nb_workers):
+        """Change the number of workers, the workers being started again at the next task if it changed."""
+        if nb_workers != self.nb_workers:
+            self.shutdown()
+            self.nb_workers = nb_workers
+
+    def worker_pids(self):
+        """Pids of the running worker processes."""
+        if self._executor is None:
+            return []
+        return list((self._executor._processes or {}).keys())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+
+def extract_psep_burst(burst, nb_bursts, filename, return_waveforms=False, waveform_cache_dtype='float32', **kwargs):
+    """Extracts the PSEP (Peak Surface Echo Power) for a specific burst of 64 echoes.
+
+    Args:
+        burst (int): The index of the burst to process.
+        nb_bursts (int): The total number of bursts to process.
+        filename (str): The path to the NetCDF file containing the burst data.
+        return_waveforms (bool, optional): Whether to also return the power waveforms and the total gain of the burst. Defaults to False.
+        waveform_cache_dtype (str, optional): dtype of the returned waveforms, 'float32' or 'float16' (cf encode_waveforms). Defaults to 'float32'.
+
+    Returns:
+        tuple: A tuple containing the burst index and the array of the extracted PSEP values
+            (and the encoded power waveforms, their scales and the total gain if return_waveforms).
+    """
+
+    if burst%1000 == 0:
+        print(f"Processing burst {burst}/{nb_bursts}")
+
+    with stage('netcdf_read', bursts=1), Dataset(filename, 'r') as nc:
+        i_data = nc.variables['cplx_waveform_ch1_i_85_ku'][burst]
+        q_data = nc.variables['cplx_waveform_ch1_q_85_ku'][burst]
+        tot_gain_ch1_85_ku = nc.variables['tot_gain_ch1_85_ku'][burst]
+        agc_1_85_ku = nc.variables['agc_1_85_ku'][burst]
+        agc_2_85_ku = nc.variables['agc_2_85_ku'][burst]
+        instr_cor_gain_tx_rx_85_ku = nc.variables['instr_cor_gain_tx_rx_85_ku'][burst]
+
+    # Compute the total Gain
+    static_gain = tot_gain_ch1_85_ku
+    dynamic_gain = agc_1_85_ku + agc_2_85_ku + instr_cor_gain_tx_rx_85_ku
+    total_gain = static_gain + dynamic_gain
+
+    # Compute and store the PSEP for each one of the 64 echoes
+    cplx_signals = np.asarray(i_data) + 1j * np.asarray(q_data)
+    with stage('fft', echoes=len(cplx_signals)):
+        waveforms = power_waveforms(cplx_signals, use_numba=kwargs.get('use_numba', True))
+    with stage('psep_window', echoes=len(cplx_signals)):
+        psep_burst = psep_from_waveforms(waveforms, float(total_gain), **kwargs)
+    if not np.all(np.isfinite(psep_burst)):
+        psep_burst = np.zeros(64)  # Return an array of zeros if the PSEP extraction fails
+
+    if return_waveforms:
+        # Encoded in the worker, so that the main process only holds the waveforms of a product in the cache dtype
+        encoded, scales = encode_waveforms(waveforms, waveform_cache_dtype)
+        return burst, psep_burst, encoded, scales, float(total_gain)
+    return burst, psep_burst
@@ -0,0 +1,229 @@
+from utils import arctic_grid
+from psep_store import STORE_NAME, store_up_to_date, consolidate_psep
+from run_stats import stage, add_summary
+import math
+import os
+import resource
+import shutil
+import warnings
+import numpy as np
+
+
+# Corner and size of the EPSG:3413 zone of the Arctic grid (in meters), cf arctic_grid
+X_MIN, Y_MIN, EXTENT = -2500000, -2500000, 5000000
+
+# Resolution of the map of the number of bursts used to size the blocks (km)
+COUNT_KM = 25
+
+# Memory model of a block (bytes), measured with the 'full' fit mode : main process (interpreter, grid, store index),
+# worker process (rsr and lmfit imports, neighborhoods being fitted), and per burst of the block and its halo
+# in the main process (coordinates, row order, spatial index of is_ice) and in each worker (coordinates, spatial
+# index, pages of the memory-mapped powers)
+MAIN_MEMORY = 200e6
+WORKER_MEMORY = 250e6
+MAIN_BYTES_PER_BURST = 150
+WORKER_BYTES_PER_BURST = 350
+
+
+def block_memory(nb_bursts, nb_cores):
+    """Estimated peak memory of the RSR of a block (bytes), main process and workers together (cf memory model)."""
+    return MAIN_MEMORY + nb_cores * WORKER_MEMORY + nb_bursts * (MAIN_BYTES_PER_BURST + nb_cores * WORKER_BYTES_PER_BURST)
+
+
+def peak_rss():
+    """Peak resident set size of the main process and of the largest worker process so far (bytes)."""
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
+
+
+def burst_counts(xy_store, chunk_bursts=1000000):
+    """Number of bursts of each COUNT_KM cell of the EPSG:3413 zone, read by chunks from the store.
+
+    Returns:
+        np.ndarray: Counts of shape (nb_cells, nb_cells), indexed by column (x) and row (y).
+    """
+    nb_cells = math.ceil(EXTENT / (COUNT_KM * 1000))
+    counts = np.zeros((nb_cells, nb_cells), dtype=np.int64)
+    for start in range(0, len(xy_store), chunk_bursts):
+        ij = np.floor((np.asarray(xy_store[start:start + chunk_bursts]) - (X_MIN, Y_MIN)) / (COUNT_KM * 1000)).astype(np.int64)
+        ij = np.clip(ij, 0, nb_cells - 1)
+        np.add.at(counts, (ij[:, 0], ij[:, 1]), 1)
+    return counts
+
+
+def bursts_in_bounds(counts, bounds):
+    """Upper bound of the number of bursts within EPSG:3413 bounds (x_min, x_max, y_min, y_max), from the COUNT_KM counts."""
+    x_min, x_max, y_min, y_max = bounds
+    size = COUNT_KM * 1000
+    i_min, i_max = max(int((x_min - X_MIN) // size), 0), min(int(math.ceil((x_max - X_MIN) / size)), counts.shape[0])
+    j_min, j_max = max(int((y_min - Y_MIN) // size), 0), min(int(math.ceil((y_max - Y_MIN) / size)), counts.shape[1])
+    return int(counts[i_min:i_max, j_min:j_max].sum())
+
+
+def densest_square(counts, size_km):
+    """Upper bound of the number of bursts within any square of size_km, from the COUNT_KM counts."""
+    width = min(math.ceil(size_km / COUNT_KM) + 1, counts.shape[0])
+    cumulated = np.zeros((counts.shape[0] + 1, counts.shape[1] + 1), dtype=np.int64)
+    cumulated[1:, 1:] = counts.cumsum(axis=0).cumsum(axis=1)
+    sums = cumulated[width:, width:] - cumulated[:-width, width:] - cumulated[width:, :-width] + cumulated[:-width, :-width]
+    return int(sums.max())
+
+
+def split_blocks(xy_grid, counts, max_memory, nb_cores, halo_km=100, min_block_km=50):
+    """Split the grid into square blocks whose RSR fits within the memory budget.
+
+    The square around the grid is split in 4 recursively (quadtree), until the estimated memory of each block
+    (cf block_memory), with the bursts of the block and its halo, is within max_memory. The blocks are smaller
+    where the bursts are denser.
+
+    Args:
+        xy_grid (np.ndarray): EPSG:3413 coordinates of the grid points (m), shape (N, 2).
+        counts (np.ndarray): Number of bursts of each COUNT_KM cell (cf burst_counts).
+        max_memory (float): Memory budget (bytes).
+        nb_cores (int): Number of worker processes.
+        halo_km (float, optional): Width of the halo of bursts read around each block (km). Defaults to 100.
+        min_block_km (float, optional): Minimum size of the blocks (km). Defaults to 50.
+
+    Raises:
+        ValueError: If the processes alone, or a block of min_block_km, do not fit within the memory budget.
+
+    Returns:
+        list: (bounds, nb_bursts) of the blocks containing grid points, bounds being (x_min, x_max, y_min, y_max) (m).
+    """
+    if block_memory(0, nb_cores) > max_memory:
+        raise ValueError(f"The processes of the RSR need about {block_memory(0, nb_cores)/1e9:.2f} GB with {nb_cores} cores, "
+                         f"more than max_memory: increase max_memory or decrease nb_cores")
+    halo = halo_km * 1000
+    size = max(np.ptp(xy_grid[:, 0]), np.ptp(xy_grid[:, 1])) + 1
+    to_split = [(xy_grid[:, 0].min(), xy_grid[:, 1].min(), size)]
+    blocks = []
+    while to_split:
+        x_min, y_min, size = to_split.pop()
+        bounds = (x_min, x_min + size, y_min, y_min + size)
+        inside = ((xy_grid[:, 0] >= bounds[0]) & (xy_grid[:, 0] < bounds[1]) & (xy_grid[:, 1] >= bounds[2]) & (xy_grid[:, 1] < bounds[3]))
+        if not inside.any():
+            continue
+        nb_bursts = bursts_in_bounds(counts, (bounds[0] - halo, bounds[1] + halo, bounds[2] - halo, bounds[3] + halo))
+        if block_memory(nb_bursts, nb_cores) <= max_memory:
+            blocks.append((bounds, nb_bursts))
+        elif size / 2 < min_block_km * 1000:
+            raise ValueError(f"A block of {size/1000:.0f} km with {nb_bursts} bursts needs about {block_memory(nb_bursts, nb_cores)/1e9:.2f} GB "
+                             f"with {nb_cores} cores: increase max_memory or decrease nb_cores or halo_km")
+        else:
+            half = size / 2
+            to_split.extend([(x_min + half, y_min + half, half), (x_min, y_min + half, half), (x_min + half, y_min, half), (x_min, y_min, half)])
+    return blocks
+
+
+def block_rows(xy_store, bounds, chunk_bursts=1000000):
+    """Rows of the store within EPSG:3413 bounds (x_min, x_max, y_min, y_max), read by chunks."""
+    x_min, x_max, y_min, y_max = bounds
+    rows = []
+    for start in range(0, len(xy_store), chunk_bursts):
+        xy = np.asarray(xy_store[start:start + chunk_bursts])
+        mask = (xy[:, 0] >= x_min) & (xy[:, 0] < x_max) & (xy[:, 1] >= y_min) & (xy[:, 1] < y_max)
+        rows.append(start + np.flatnonzero(mask))
+    return np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+
+
+def apply_rsr_blocks(path, max_memory, nb_cores=8, halo_km=100, min_block_km=50, auto_tune=False, **kwargs):
+    """Apply RSR to the Arctic grid by spatial blocks, within a memory budget (cf apply_rsr_arctic(..., max_memory)).
+
+    The PSEP is read from the consolidated store (consolidated by chunks if the csv files changed, cf consolidate_psep).
+    The grid is split into blocks (cf split_blocks), and for each block only the bursts of the block and its halo are
+    read from the memory-mapped store, and copied to path/rsr_blocks/powers.npy, memory-mapped by the workers. The
+    peak memory is then bounded by the size of the blocks instead of the size of the month. The halo must be at least
+    the neighbor search radius for the results to be the same as a single run: in 'radius' mode, an error is raised if
+    halo_km is smaller than max_radius_km, and in 'knn' mode, a warning gives the number of targets whose nb_closest-th
+    closest burst is beyond the halo of their block (cf rsr_tiles.targets_beyond_halo).
+
+    The results of block b are saved in path/rsr_results_block_<b>_core_<i>.csv (the results of a previous run being
+    removed by apply_rsr_arctic, cf remove_rsr_results), and the blocks (bounds, number of bursts, estimated memory,
+    measured peak RSS and number of targets beyond the halo) are added to the run report.
+
+    Args:
+        path (str): Path to the data directory.
+        max_memory (float): Memory budget (GB).
+        nb_cores (int, optional): Number of CPU cores to use for processing. Defaults to 8.
+        halo_km (float, optional): Width of the halo of bursts read around each block (km). Defaults to 100.
+        min_block_km (float, optional): Minimum size of the blocks (km). Defaults to 50.
+        auto_tune (bool, optional): Whether to lower nb_cores to the available CPUs and memory, and to the largest number
+            of workers for which the densest block that cannot be split (up to twice min_block_km, with its halo) fits
+            within max_memory (cf apply_rsr.tune_nb_cores). Defaults to False.
+        **kwargs: Additional keyword arguments for apply_rsr and arctic_grid.
+    """
+    from apply_rsr import apply_rsr, tune_nb_cores
+    from rsr_tiles import targets_beyond_halo
+
+    if kwargs.get('neighborhood_mode', 'knn') == 'radius' and halo_km < kwargs.get('max_radius_km', 50.):
+        raise ValueError(f"halo_km ({halo_km} km) must be at least max_radius_km ({kwargs.get('max_radius_km', 50.)} km) in 'radius' mode")
+
+    max_memory = max_memory * 1e9
+    psep_dir = os.path.join(path, "psep")
+    store_dir = os.path.join(psep_dir, STORE_NAME)
+    # Chunks of the consolidation and of the reads : a tenth of the budget, at 512 bytes per burst (float64 powers of the csv)
+    chunk_bursts = max(int(max_memory / 10 / 512), 10000)
+    if not store_up_to_date(psep_dir):
+        print("Consolidating the PSEP csv files by chunks...")
+        consolidate_psep(psep_dir, chunk_bursts=chunk_bursts)
+
+    latlon_grid, xy_grid = arctic_grid(return_xy=True, **kwargs)
+    xy_store = np.load(os.path.join(store_dir, "xy.npy"), mmap_mode='r')
+    with stage('split_blocks', bursts=len(xy_store)):
+        counts = burst_counts(xy_store, chunk_bursts)
+        if auto_tune:
+            nb_bursts = densest_square(counts, 2 * min_block_km + 2 * halo_km)
+            tuned = {'nb_cores': nb_cores}
+            tune_nb_cores(path, tuned, WORKER_BYTES_PER_BURST * nb_bursts,
+                          memory_budget=max_memory - MAIN_MEMORY - MAIN_BYTES_PER_BURST * nb_bursts)
+            nb_cores = tuned['nb_cores']
+        blocks = split_blocks(xy_grid, counts, max_memory, nb_cores, halo_km, min_block_km)
+    del xy_store
+    print(f"Grid split into {len(blocks)} blocks within {max_memory/1e9:.2f} GB")
+
+    blocks_dir = os.path.join(path, "rsr_blocks")
+    os.makedirs(blocks_dir, exist_ok=True)
+
+    summary = []
+    for b, (bounds, nb_bursts_estimate) in enumerate(blocks):
+        x_min, x_max, y_min, y_max = bounds
+        in_block = (xy_grid[:, 0] >= x_min) & (xy_grid[:, 0] < x_max) & (xy_grid[:, 1] >= y_min) & (xy_grid[:, 1] < y_max)
+
+        halo = halo_km * 1000
+        halo_bounds = (x_min - halo, x_max + halo, y_min - halo, y_max + halo)
+        with stage('read_block', blocks=1) as counters:
+            # The store is mapped again for each block, so that the pages read are released
+            rows = block_rows(np.load(os.path.join(store_dir, "xy.npy"), mmap_mode='r'), halo_bounds, chunk_bursts)
+            counters['bursts'] = len(rows)
+            latlon_array = np.load(os.path.join(store_dir, "latlon.npy"), mmap_mode='r')[rows]
+            xy_array = np.load(os.path.join(store_dir, "xy.npy"), mmap_mode='r')[rows]
+            kwargs['row_order'] = np.load(os.path.join(store_dir, "order.npy"), mmap_mode='r')[rows]
+            powers_2D_array = np.lib.format.open_memmap(os.path.join(blocks_dir, "powers.npy"), mode='w+', dtype=np.float32, shape=(len(rows), 64))
+            for start in range(0, len(rows), chunk_bursts):
+                powers_2D_array[start:start + chunk_bursts] = np.load(os.path.join(store_dir, "powers.npy"), mmap_mode='r')[rows[start:start + chunk_bursts]]
+            powers_2D_array.flush()
+            del powers_2D_array
+            powers_2D_array = np.load(os.path.join(blocks_dir, "powers.npy"), mmap_mode='r')
+
+        print(f"Block {b+1}/{len(blocks)}: {in_block.sum()} grid points, {len(rows)} bursts with the halo")
+        nb_beyond_halo = targets_beyond_halo(xy_grid[in_block], xy_array, halo_bounds, **kwargs)
+        if nb_beyond_halo > 0:
+            warnings.warn(f"Block {b}: the neighborhoods of {nb_beyond_halo} targets reach beyond the halo of {halo_km} km, "
+                          f"their results may differ from a single run (increase halo_km)")
+        if len(rows) > 0:
+            apply_rsr(latlon_grid[in_block], latlon_array, powers_2D_array, path, nb_cores=nb_cores, xy_target_array=xy_grid[in_block],
+                      xy_array=xy_array, output_name=f"rsr_results_block_{b}", **kwargs)
+        del latlon_array, xy_array, powers_2D_array
+
+        rss_main, rss_worker = peak_rss()
+        summary.append({'block': b, 'bounds': [float(bound) for bound in bounds], 'nb_targets': int(in_block.sum()), 'nb_bursts': len(rows),
+                        'estimated_memory': block_memory(nb_bursts_estimate, nb_cores), 'peak_rss_main': rss_main, 'peak_rss_worker': rss_worker,
+                        'nb_targets_beyond_halo': nb_beyond_halo})
+
+    shutil.rmtree(blocks_dir)
+    rss_main, rss_worker = peak_rss()
+    add_summary('rsr_blocks', {'max_memory': max_memory, 'nb_cores': nb_cores, 'halo_km': halo_km, 'peak_rss_main': rss_main,
+                               'peak_rss_worker': rss_worker, 'nb_targets_beyond_halo': sum(block['nb_targets_beyond_halo'] for block in summary),
+                               'blocks': summary})
+    print(f"Peak RSS: {rss_main/1e9:.2f} GB (main process), {rss_worker/1e9:.2f} GB (largest worker), "
+          f"{(rss_main + nb_cores*rss_worker)/1e9:.2f} GB at most in total for a budget of {max_memory/1e9:.2f} GB")
@@ -0,0 +1,222 @@
+from utils import arctic_grid, read_psep_from_csv
+from apply_rsr import apply_rsr
+from spatial_index import latlon_to_xy
+from psep_store import load_psep_store
+from run_stats import stage, reset, write_report, report_filename
+import json
+import os
+import numpy as np
+import pandas as pd
+
+
+# Corner of the EPSG:3413 zone of the Arctic grid (in meters), cf arctic_grid
+X_MIN, Y_MIN = -2500000, -2500000
+
+
+def pyramid_steps(step_km=10, nb_levels=3):
+    """Grid steps of the levels of the pyramid, from the coarsest to the finest (step_km)."""
+    return [step_km * 2**(nb_levels - 1 - level) for level in range(nb_levels)]
+
+
+def grid_indices(xy_array, step_km):
+    """Column and row of each point in the Arctic grid of the given step, shape (N, 2)."""
+    return np.rint((np.asarray(xy_array) - (X_MIN, Y_MIN)) / (step_km * 1000)).astype(np.int64)
+
+
+def find_cells(ij_table, ij_query):
+    """Row of each queried cell in a table of grid indices, and whether it was found."""
+    if len(ij_table) == 0:
+        return np.zeros(len(ij_query), dtype=np.int64), np.zeros(len(ij_query), dtype=bool)
+    table_keys = ij_table[:, 0] * 2**32 + ij_table[:, 1]
+    query_keys = ij_query[:, 0] * 2**32 + ij_query[:, 1]
+    order = np.argsort(table_keys)
+    position = np.clip(np.searchsorted(table_keys[order], query_keys), 0, len(order) - 1)
+    return order[position], table_keys[order][position] == query_keys
+
+
+def cells_to_refine(ij_array, power_array, crl_array, flag_array, refine_db=1., refine_crl_min=0.9, refine_edges=True, coarser_levels=()):
+    """Select the cells of a level of the pyramid to refine.
+
+    A cell is refined if its fit failed, if its correlation coefficient is below refine_crl_min,
+    or if its pc or pn differs by more than refine_db from one of its 8 neighbors. With refine_edges,
+    the cells with a neighbor without result (ice edge, under-sampled neighborhoods) are refined too.
+
+    Above level 0, only the children of the refined cells are fitted : a neighbor which is not a cell of
+    the level takes the result of its closest ancestor in the coarser levels, and is only missing (edge)
+    if it has no ancestor with a result.
+
+    Args:
+        ij_array (np.ndarray): Grid indices of the cells (cf grid_indices), shape (N, 2).
+        power_array (np.ndarray): pc and pn of the cells (dB), shape (N, 2).
+        crl_array (np.ndarray): Correlation coefficients of the cells, shape (N,).
+        flag_array (np.ndarray): Flags of the cells (0 for failed fits), shape (N,).
+        refine_db (float, optional): Maximum difference of pc and pn between neighbors (dB). Defaults to 1.
+        refine_crl_min (float, optional): Minimum correlation coefficient. Defaults to 0.9.
+        refine_edges (bool, optional): Whether to refine the cells with missing neighbors. Defaults to True.
+        coarser_levels (list, optional): (ij_array, power_array, crl_array, flag_array) of the previous levels, from
+            the closest to level 0. Defaults to () (level 0).
+
+    Returns:
+        np.ndarray: Boolean mask of the cells to refine, shape (N,).
+    """
+    ij_array = np.asarray(ij_array, dtype=np.int64).reshape(-1, 2)
+    refine = (np.asarray(flag_array) == 0) | (np.asarray(crl_array) < refine_crl_min)
+    if len(ij_array) == 0:
+        return refine
+
+    # pc and pn of the cells of each level (NaN for failed fits), the grid indices of level l - k being those of level l divided by 2**k
+    levels = [(ij_array, np.where(refine[:, None], np.nan, np.asarray(power_array, dtype=np.float64)))]
+    for ij_level, power_level, crl_level, flag_level in coarser_levels:
+        usable = (np.asarray(flag_level) != 0) & (np.asarray(crl_level) >= refine_crl_min)
+        levels.append((np.asarray(ij_level, dtype=np.int64).reshape(-1, 2),
+                       np.where(usable[:, None], np.asarray(power_level, dtype=np.float64).reshape(-1, 2), np.nan)))
+    values = levels[0][1]
+
+    for di in (-1, 0, 1):
+        for dj in (-1, 0, 1):
+            if di == 0 and dj == 0:
+                continue
+            neighbors = np.full((len(ij_array), 2), np.nan)
+            missing = np.ones(len(ij_array), dtype=bool)
+            for k, (ij_level, power_level) in enumerate(levels):
+                rows, found = find_cells(ij_level, (ij_array[missing] + (di, dj)) // 2**k)
+                indices = np.flatnonzero(missing)[found]
+                neighbors[indices] = power_level[rows[found]]
+                missing[indices] = False
+                if not missing.any():
+                    break
+            with np.errstate(invalid='ignore'):
+                refine |= np.any(np.abs(neighbors - values) > refine_db, axis=1)
+            if refine_edges:
+                refine |= missing
+    return refine
+
+
+def read_level_results(level_dir, output_name):
+    """Read the results of the cores for a level, and remove their csv files."""
+    results = []
+    core_files = sorted(f for f in os.listdir(level_dir) if f.startswith(output_name + '_core_') and f.endswith('.csv'))
+    for csv_file in core_files:
+        results.append(pd.read_csv(os.path.join(level_dir, csv_file)))
+    results = pd.concat(results, ignore_index=True) if results else pd.DataFrame(columns=['lat', 'lon', 'value', 'power', 'crl', 'flag'])
+    for csv_file in core_files:
+        os.remove(os.path.join(level_dir, csv_file))
+    return results
+
+
+def apply_rsr_pyramid(path, step_km=10, nb_levels=3, lat_min=72., refine_db=1., refine_crl_min=0.9, refine_edges=True, warm_start=True, use_psep_store=False, run_report=True, **kwargs):
+    """Apply RSR to a multi-resolution pyramid of Arctic grids, refined from coarse to fine where the signal changes.
+
+    The level 0 is the Arctic grid with a step of step_km * 2**(nb_levels-1). At each level, the cells to
+    refine (cf cells_to_refine) are split into the 4 cells of the next level (step / 2) whose grid
+    indices divided by 2 are those of the parent. The child at the same position as its parent reuses its
+    result, and the lmfit HK-fitting of the 3 other children starts from the parameters of the parent.
+
+    The results of level l are saved in path/pyramid/rsr_results_level_<l>.csv, with the columns of the
+    rsr_results files, the grid indices (i, j) of the cells, their level and step, and whether they were
+    refined. The cells which were not refined (leaves) cover the grid with the finest resolution needed,
+    and are gathered in path/pyramid/rsr_results_pyramid.csv. The levels are described in path/pyramid/pyramid.json.
+
+    Args:
+        path (str): Path to the data directory.
+        step_km (float, optional): Step of the finest level (km). Defaults to 10.
+        nb_levels (int, optional): Number of levels of the pyramid. Defaults to 3.
+        lat_min (float, optional): The minimum latitude for the grid (deg). Defaults to 72.
+        refine_db (float, optional): Maximum difference of pc and pn between neighboring cells (dB). Defaults to 1.
+        refine_crl_min (float, optional): Minimum correlation coefficient of a cell which is not refined. Defaults to 0.9.
+        refine_edges (bool, optional): Whether to refine the cells with neighbors without result. Defaults to True.
+        warm_start (bool, optional): Whether to start the fits of the children from the fit of their parent. Defaults to True.
+        use_psep_store (bool, optional): Whether to read the PSEP from the consolidated store (cf psep_store.py). Defaults to False.
+        run_report (bool, optional): Whether to save the duration and throughput of each stage in path/pyramid/reports/apply_rsr_pyramid_<date>.json. Defaults to True.
+        **kwargs: Additional keyword arguments for apply_rsr.
+    """
+    reset('apply_rsr_pyramid')
+    pyramid_dir = os.path.join(path, "pyramid")
+    os.makedirs(pyramid_dir, exist_ok=True)
+    # Levels of a previous run with more levels
+    for csv_file in os.listdir(pyramid_dir):
+        if csv_file.startswith("rsr_results_level_") and csv_file.endswith(".csv"):
+            os.remove(os.path.join(pyramid_dir, csv_file))
+
+    if use_psep_store:
+        print("Reading PSEP data from the consolidated store...")
+        latlon_array, powers_2D_array, xy_array, kwargs['row_order'] = load_psep_store(os.path.join(path, "psep"))
+    else:
+        print("Reading PSEP data from CSV files...")
+        latlon_array, powers_2D_array, xy_array = read_psep_from_csv(os.path.join(path, "psep"), return_xy=True)
+
+    steps = pyramid_steps(step_km, nb_levels)
+    levels = []
+    # (ij, pc and pn, crl, flag) of the cells of the previous levels, from the closest one, for the neighbors of the cells to refine
+    coarser_levels = []
+    leaves = []
+    parents = None
+    for level, step in enumerate(steps):
+        latlon_grid, xy_grid = arctic_grid(step_km=step, lat_min=lat_min, return_xy=True)
+        ij_grid = grid_indices(xy_grid, step)
+
+        # Children of the refined cells of the previous level
+        p0_target_array = None
+        copied = pd.DataFrame()
+        if parents is not None:
+            parent_keys = parents['i'].values.astype(np.int64) * 2**32 + parents['j'].values.astype(np.int64)
+            child_keys = (ij_grid[:, 0] // 2) * 2**32 + ij_grid[:, 1] // 2
+            order = np.argsort(parent_keys)
+            position = np.clip(np.searchsorted(parent_keys[order], child_keys), 0, len(order) - 1)
+            parent_index = np.where(parent_keys[order][position] == child_keys, order[position], -1)
+            is_child = parent_index >= 0
+            latlon_grid, xy_grid, ij_grid, parent_index = latlon_grid[is_child], xy_grid[is_child], ij_grid[is_child], parent_index[is_child]
+
+            # Children at the position of their parent
+            same_position = np.all(ij_grid % 2 == 0, axis=1)
+            copied = parents.iloc[parent_index[same_position]].copy()
+            copied['i'], copied['j'] = ij_grid[same_position, 0], ij_grid[same_position, 1]
+            latlon_grid, xy_grid, ij_grid, parent_index = (latlon_grid[~same_position], xy_grid[~same_position],
+                                                           ij_grid[~same_position], parent_index[~same_position])
+            if warm_start:
+                values = [json.loads(value) for value in parents['value']]
+                p0_parents = np.array([[v['a'], v['s'], v['mu']] if flag == 1 else [np.nan]*3
+                                       for v, flag in zip(values, parents['flag'])]).reshape(-1, 3)
+                p0_target_array = p0_parents[parent_index]
+
+        print(f"Level {level} ({step} km): {len(latlon_grid)} new cells, {len(copied)} results of the parents reused")
+        output_name = f"rsr_results_level_{level}_fits"
+        if len(latlon_grid) > 0:
+            apply_rsr(latlon_grid, latlon_array, powers_2D_array, pyramid_dir, xy_target_array=xy_grid, xy_array=xy_array,
+                      p0_target_array=p0_target_array, output_name=output_name, **kwargs)
+        fitted = read_level_results(pyramid_dir, output_name)
+        fitted_ij = grid_indices(latlon_to_xy(fitted[['lat', 'lon']].values), step) if len(fitted) > 0 else np.empty((0, 2), dtype=np.int64)
+        fitted['i'], fitted['j'] = fitted_ij[:, 0], fitted_ij[:, 1]
+        results = pd.concat([fitted, copied], ignore_index=True) if len(copied) > 0 else fitted
+
+        with stage('pyramid_refine', cells=len(results)):
+            powers = [json.loads(power) for power in results['power']]
+            results['level'], results['step_km'] = level, step
+            results['refined'] = False
+            cells = (results[['i', 'j']].values.astype(np.int64), np.array([[p['pc'], p['pn']] for p in powers]).reshape(-1, 2),
+                     results['crl'].values.astype(np.float64), results['flag'].values)
+            if level < nb_levels - 1:
+                results['refined'] = cells_to_refine(*cells, refine_db=refine_db, refine_crl_min=refine_crl_min,
+                                                     refine_edges=refine_edges, coarser_levels=coarser_levels)
+            coarser_levels.insert(0, cells)
+
+        results.to_csv(os.path.join(pyramid_dir, f"rsr_results_level_{level}.csv"), index=False)
+        leaves.append(results[~results['refined']])
+        parents = results[results['refined']].reset_index(drop=True)
+        levels.append({'level': level, 'step_km': step, 'nb_fits': len(fitted), 'nb_reused': len(copied),
+                       'nb_cells': len(results), 'nb_refined': int(results['refined'].sum())})
+        print(f"Level {level} ({step} km): {levels[-1]['nb_refined']} / {len(results)} cells to refine")
+        if len(parents) == 0:
+            break
+
+    leaves = pd.concat(leaves, ignore_index=True)
+    leaves.to_csv(os.path.join(pyramid_dir, "rsr_results_pyramid.csv"), index=False)
+    nb_fits = sum(level['nb_fits'] for level in levels)
+    with open(os.path.join(pyramid_dir, "pyramid.json"), 'w') as f:
+        json.dump({'step_km': step_km, 'nb_levels': nb_levels, 'lat_min': lat_min, 'refine_db': refine_db,
+                   'refine_crl_min': refine_crl_min, 'refine_edges': refine_edges, 'warm_start': warm_start,
+                   'nb_fits': nb_fits, 'nb_leaves': len(leaves), 'levels': levels}, f, indent=1)
+    print(f"{len(leaves)} cells from {len(levels)} levels saved in {pyramid_dir} ({nb_fits} fits)")
+
+    if run_report:
+        write_report(report_filename(pyramid_dir, 'apply_rsr_pyramid'))
@@ -0,0 +1,557 @@
+from spatial_index import SpatialIndex, latlon_to_xy, xy_to_latlon
+from run_stats import stage, report_filename
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import argparse
+import json
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+
+# Directory of the query index of a month : path/rsr_query
+QUERY_INDEX_NAME = "rsr_query"
+
+# Corner of the EPSG:3413 zone of the Arctic grid (in meters), cf arctic_grid
+X_MIN, Y_MIN = -2500000, -2500000
+
+# Fields of the cells in the tiles of the query index
+CELL_DTYPE = np.dtype([('lat', 'f8'), ('lon', 'f8'), ('x', 'f8'), ('y', 'f8'), ('pt', 'f4'), ('pc', 'f4'), ('pn', 'f4'),
+                       ('pc-pn', 'f4'), ('crl', 'f4'), ('flag', 'i1')])
+
+# Values returned by the queries
+QUERY_FIELDS = ('pt', 'pc', 'pn', 'pc-pn', 'crl', 'flag')
+
+
+def results_files(path, output_name='rsr_results'):
+    """RSR results csv files of a month (path/<output_name>_*.csv, as read by plot_rsr_results)."""
+    return sorted(f for f in os.listdir(path) if f.startswith(output_name + '_') and f.endswith('.csv'))
+
+
+def _results_files_state(path, output_name):
+    """Name, size and modification time of the results files, to detect changes since the index was built."""
+    return [[f, os.path.getsize(os.path.join(path, f)), os.path.getmtime(os.path.join(path, f))] for f in results_files(path, output_name)]
+
+
+def tile_name(i, j):
+    return f"{i}_{j}"
+
+
+def query_index_up_to_date(path, output_name='rsr_results', tile_km=250):
+    """Whether the query index of a month exists and the results files did not change since it was built."""
+    meta_path = os.path.join(path, QUERY_INDEX_NAME, "index.json")
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    return meta['results_files'] == _results_files_state(path, output_name) and meta['tile_km'] == tile_km and meta['output_name'] == output_name
+
+
+def build_query_index(path, output_name='rsr_results', tile_km=250):
+    """Build the query index of the RSR results of a month, in path/rsr_query.
+
+    The results files are read once, their power and crl columns are decoded, and the cells are split into
+    square EPSG:3413 tiles of tile_km, saved in tile_<i>_<j>.npy (CELL_DTYPE) so that a query only reads the
+    tiles it overlaps. index.json describes the tiles (number of cells) and the state of the results files.
+    A cell found in several files (e.g. updated by update_month, or in the rsr_results_tiles.csv or rsr_results_cells.csv
+    merged by another run) is kept once, from the most recently modified file.
+
+    Args:
+        path (str): Path to the data directory of the month.
+        output_name (str, optional): Prefix of the results files. Defaults to 'rsr_results'.
+        tile_km (float, optional): Size of the tiles (km). Defaults to 250.
+
+    Returns:
+        dict: Description of the index (content of index.json).
+    """
+    index_dir = os.path.join(path, QUERY_INDEX_NAME)
+    os.makedirs(index_dir, exist_ok=True)
+    for f in os.listdir(index_dir):
+        if f.startswith("tile_") and f.endswith(".npy"):
+            os.remove(os.path.join(index_dir, f))
+
+    state = _results_files_state(path, output_name)
+    frames = []
+    # Oldest files first, so that the cells of the most recent runs are kept
+    for csv_file, _, _ in sorted(state, key=lambda file_state: (file_state[2], file_state[0])):
+        with stage('query_index_read', files=1) as counters:
+            data = pd.read_csv(os.path.join(path, csv_file), usecols=['lat', 'lon', 'power', 'crl', 'flag'])
+            counters['targets'] = len(data)
+        frames.append(data)
+    data = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['lat', 'lon', 'power', 'crl', 'flag'])
+    data = data.drop_duplicates(subset=['lat', 'lon'], keep='last')
+
+    cells = np.zeros(len(data), dtype=CELL_DTYPE)
+    cells['lat'], cells['lon'] = data['lat'].to_numpy(np.float64), data['lon'].to_numpy(np.float64)
+    if len(cells) > 0:
+        xy = latlon_to_xy(np.column_stack((cells['lat'], cells['lon'])))
+        cells['x'], cells['y'] = xy[:, 0], xy[:, 1]
+        powers = [json.loads(power) for power in data['power']]
+        for field in ('pt', 'pc', 'pn', 'pc-pn'):
+            cells[field] = [power[field] for power in powers]
+    cells['crl'] = pd.to_numeric(data['crl'], errors='coerce').to_numpy(np.float32)
+    cells['flag'] = pd.to_numeric(data['flag'], errors='coerce').fillna(0).to_numpy(np.int8)
+
+    tiles = {}
+    ij = np.floor((np.column_stack((cells['x'], cells['y'])) - (X_MIN, Y_MIN)) / (tile_km * 1000)).astype(np.int64)
+    order = np.lexsort((ij[:, 1], ij[:, 0]))
+    cells, ij = cells[order], ij[order]
+    boundaries = np.flatnonzero(np.any(np.diff(ij, axis=0) != 0, axis=1)) + 1
+    for start, end in zip(np.r_[0, boundaries], np.r_[boundaries, len(cells)]):
+        if end > start:
+            name = tile_name(*ij[start])
+            np.save(os.path.join(index_dir, f"tile_{name}.npy"), cells[start:end])
+            tiles[name] = int(end - start)
+
+    meta = {'output_name': output_name, 'tile_km': tile_km, 'nb_cells': len(cells), 'tiles': tiles, 'results_files': state}
+    with open(os.path.join(index_dir, "index.json"), 'w') as f:
+        json.dump(meta, f, indent=1)
+    print(f"Query index of {path}: {len(cells)} cells in {len(tiles)} tiles")
+    return meta
+
+
+def load_query_index(path, output_name='rsr_results', tile_km=250):
+    """Description of the query index of a month (cf build_query_index), built again if the results files changed."""
+    if not query_index_up_to_date(path, output_name, tile_km):
+        return build_query_index(path, output_name, tile_km)
+    with open(os.path.join(path, QUERY_INDEX_NAME, "index.json"), 'r') as f:
+        return json.load(f)
+
+
+class RSRQuery:
+    """Point, bounding box and transect queries of the RSR results (pt, pc, pn, pc-pn, crl) of several months.
+
+    The results of each month are read from its query index (cf build_query_index). The tiles are decoded
+    at their first use (cells filtered by flag and min_crl, and their KD-tree) and kept in an LRU cache of
+    cache_tiles tiles shared by the months, so that the queries of a dashboard do not read the results files
+    again. The queries can be run from several threads (cf serve).
+    """
+
+    def __init__(self, paths, output_name='rsr_results', tile_km=250, cache_tiles=256, min_crl=0., only_valid=True):
+        """
+        Args:
+            paths (dict or list): Data directories of the months, by name (e.g. "2017-11"), or a list of directories
+                (named by their basename).
+            output_name (str, optional): Prefix of the results files. Defaults to 'rsr_results'.
+            tile_km (float, optional): Size of the tiles of the query index (km). Defaults to 250.
+            cache_tiles (int, optional): Maximum number of decoded tiles kept in memory. Defaults to 256.
+            min_crl (float, optional): Minimum correlation coefficient of the cells returned. Defaults to 0.
+            only_valid (bool, optional): Whether to leave out the failed fits (flag 0), as plot_rsr_results. Defaults to True.
+        """
+        if not isinstance(paths, dict):
+            paths = {os.path.basename(os.path.normpath(path)): path for path in paths}
+        self.paths = dict(paths)
+        self.tile_m = tile_km * 1000
+        self.cache_tiles = cache_tiles
+        self.min_crl = min_crl
+        self.only_valid = only_valid
+        self.tiles = {month: set(load_query_index(path, output_name, tile_km)['tiles']) for month, path in self.paths.items()}
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits, self.misses = 0, 0
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        """Query the months of a pipeline configuration (cf pipeline.run_pipeline), named "YYYY-MM"."""
+        from pipeline import config_months
+        return cls({f"{year}-{month}": config['path'].format(year=year, month=month) for year, month in config_months(config)}, **kwargs)
+
+    @property
+    def months(self):
+        return list(self.paths)
+
+    def cache_stats(self):
+        """Number of decoded tiles in the cache, and the hits and misses of the cache."""
+        return {'tiles': len(self._cache), 'max_tiles': self.cache_tiles, 'hits': self.hits, 'misses': self.misses}
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits, self.misses = 0, 0
+
+    def tile(self, month, name):
+        """Decoded tile of a month : its cells and their spatial index (None if the tile has no cell)."""
+        key = (month, name)
+        with self._lock:
+            if key in self._cache:
+                self.hits += 1
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            self.misses += 1
+        if name not in self.tiles[month]:
+            decoded = None
+        else:
+            with stage('query_tile_load', tiles=1) as counters:
+                cells = np.load(os.path.join(self.paths[month], QUERY_INDEX_NAME, f"tile_{name}.npy"))
+                keep = cells['crl'] >= self.min_crl
+                if self.only_valid:
+                    keep &= cells['flag'] == 1
+                cells = cells[keep]
+                decoded = (cells, SpatialIndex(np.column_stack((cells['x'], cells['y'])))) if len(cells) > 0 else None
+                counters['cells'] = len(cells)
+        with self._lock:
+            self._cache[key] = decoded
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_tiles:
+                self._cache.popitem(last=False)
+        return decoded
+
+    def _tiles_in_bounds(self, month, x_min, x_max, y_min, y_max):
+        """Names of the tiles of a month overlapping EPSG:3413 bounds (m)."""
+        i_min, i_max = int(np.floor((x_min - X_MIN) / self.tile_m)), int(np.floor((x_max - X_MIN) / self.tile_m))
+        j_min, j_max = int(np.floor((y_min - Y_MIN) / self.tile_m)), int(np.floor((y_max - Y_MIN) / self.tile_m))
+        return [tile_name(i, j) for i in range(i_min, i_max + 1) for j in range(j_min, j_max + 1) if tile_name(i, j) in self.tiles[month]]
+
+    def _months(self, months):
+        if months is None:
+            return self.months
+        unknown = set(months) - set(self.paths)
+        if unknown:
+            raise ValueError(f"Unknown months: {sorted(unknown)}. Expected some of {self.months}.")
+        return list(months)
+
+    def nearest(self, xy_targets, month, max_distance_km=10.):
+        """Closest cell of a month to each target, within max_distance_km.
+
+        Args:
+            xy_targets (np.ndarray): EPSG:3413 coordinates of the targets (m), shape (M, 2).
+            month (str): Name of the month.
+            max_distance_km (float, optional): Maximum distance of the cell (km). Defaults to 10.
+
+        Returns:
+            dict: lat, lon, distance_km of the cells and the QUERY_FIELDS, arrays of shape (M,), NaN without cell.
+        """
+        xy_targets = np.asarray(xy_targets, dtype=np.float64).reshape(-1, 2)
+        max_distance = max_distance_km * 1000
+        best_distances = np.full(len(xy_targets), np.inf)
+        values = {field: np.full(len(xy_targets), np.nan) for field in ('lat', 'lon') + QUERY_FIELDS}
+        if len(xy_targets) == 0:
+            return {'distance_km': best_distances, **values}
+        # Tiles overlapping the square of half-width max_distance around each target
+        ij_min = np.floor((xy_targets - max_distance - (X_MIN, Y_MIN)) / self.tile_m).astype(np.int64)
+        ij_max = np.floor((xy_targets + max_distance - (X_MIN, Y_MIN)) / self.tile_m).astype(np.int64)
+        # Tiles of the EPSG:3413 zone only, for large distances
+        nb_tiles = int(np.ceil(-2 * X_MIN / self.tile_m))
+        ij_min, ij_max = np.clip(ij_min, 0, nb_tiles - 1), np.clip(ij_max, 0, nb_tiles - 1)
+        span = (ij_max - ij_min).max(axis=0)
+        candidates = {}
+        for di in range(span[0] + 1):
+            for dj in range(span[1] + 1):
+                ij = ij_min + (di, dj)
+                for target in np.flatnonzero(np.all(ij <= ij_max, axis=1)):
+                    candidates.setdefault(tile_name(*ij[target]), set()).add(target)
+        for name, targets in candidates.items():
+            if name not in self.tiles[month]:
+                continue
+            decoded = self.tile(month, name)
+            if decoded is None:
+                continue
+            cells, index = decoded
+            targets = np.array(sorted(targets))
+            distances, indices = index.query(xy_targets[targets], k=1, distance_upper_bound=max_distance)
+            closer = distances[:, 0] < best_distances[targets]
+            best_distances[targets[closer]] = distances[closer, 0]
+            for field in values:
+                values[field][targets[closer]] = cells[field][indices[closer, 0]]
+        best_distances[~np.isfinite(best_distances)] = np.nan
+        return {'distance_km': best_distances / 1000, **values}
+
+    def point(self, lat, lon, months=None, max_distance_km=10.):
+        """Values of the closest cell to a point in each month.
+
+        Args:
+            lat (float): Latitude of the point (deg).
+            lon (float): Longitude of the point (deg).
+            months (list, optional): Names of the months. Defaults to None (all the months).
+            max_distance_km (float, optional): Maximum distance of the cell (km). Defaults to 10.
+
+        Returns:
+            dict: For each month, lat, lon, distance_km of the cell and the QUERY_FIELDS (None without cell within max_distance_km).
+        """
+        xy = latlon_to_xy(np.array([[lat, lon]]))
+        results = {}
+        for month in self._months(months):
+            values = self.nearest(xy, month, max_distance_km)
+            if np.isfinite(values['distance_km'][0]):
+                results[month] = {field: float(array[0]) for field, array in values.items()}
+                results[month]['flag'] = int(results[month]['flag'])
+            else:
+                results[month] = None
+        return results
+
+    def bbox(self, lat_min, lat_max, lon_min, lon_max, months=None):
+        """Cells within a latitude/longitude box in each month.
+
+        Args:
+            lat_min (float): Minimum latitude (deg).
+            lat_max (float): Maximum latitude (deg).
+            lon_min (float): Minimum longitude (deg).
+            lon_max (float): Maximum longitude (deg). If lon_max < lon_min, the box crosses the 180th meridian.
+            months (list, optional): Names of the months. Defaults to None (all the months).
+
+        Returns:
+            dict: For each month, arrays of lat, lon and the QUERY_FIELDS of the cells in the box.
+        """
+        # The EPSG:3413 bounds of the box are those of its edges
+        lon_span = (lon_max - lon_min) % 360 if lon_max != lon_min else 360
+        edge_lats = np.linspace(lat_min, lat_max, 50)
+        edge_lons = lon_min + np.linspace(0, lon_span, 361)
+        edges = np.concatenate([np.column_stack((edge_lats, np.full(50, lon))) for lon in (lon_min, lon_min + lon_span)]
+                               + [np.column_stack((np.full(361, lat), edge_lons)) for lat in (lat_min, lat_max)])
+        xy_edges = latlon_to_xy(edges)
+        (x_min, y_min), (x_max, y_max) = xy_edges.min(axis=0), xy_edges.max(axis=0)
+
+        results = {}
+        for month in self._months(months):
+            selected = []
+            for name in self._tiles_in_bounds(month, x_min, x_max, y_min, y_max):
+                decoded = self.tile(month, name)
+                if decoded is None:
+                    continue
+                cells = decoded[0]
+                inside = (cells['lat'] >= lat_min) & (cells['lat'] <= lat_max) & ((cells['lon'] - lon_min) % 360 <= lon_span)
+                selected.append(cells[inside])
+            cells = np.concatenate(selected) if selected else np.zeros(0, dtype=CELL_DTYPE)
+            results[month] = {field: cells[field] for field in ('lat', 'lon') + QUERY_FIELDS}
+        return results
+
+    def transect(self, latlon_points, step_km=10., months=None, max_distance_km=10.):
+        """Values along a transect, sampled every step_km, from the closest cell to each sample in each month.
+
+        Args:
+            latlon_points (list): (latitude, longitude) of the vertices of the transect.
+            step_km (float, optional): Distance between the samples (km), along the EPSG:3413 segments. Defaults to 10.
+            months (list, optional): Names of the months. Defaults to None (all the months).
+            max_distance_km (float, optional): Maximum distance of the cell to a sample (km). Defaults to 10.
+
+        Returns:
+            dict: 'samples' (lat, lon and distance_km along the transect of the samples), and for each month the
+                arrays of lat, lon, distance_km of the cells and the QUERY_FIELDS (NaN without cell).
+        """
+        xy_vertices = latlon_to_xy(np.asarray(latlon_points, dtype=np.float64).reshape(-1, 2))
+        samples, distances, start = [xy_vertices[:1]], [np.zeros(1)], 0.
+        for a, b in zip(xy_vertices[:-1], xy_vertices[1:]):
+            length = np.linalg.norm(b - a)
+            nb_steps = max(1, int(np.ceil(length / (step_km * 1000))))
+            t = np.arange(1, nb_steps + 1) / nb_steps
+            samples.append(a + t[:, None] * (b - a))
+            distances.append(start + t * length)
+            start += length
+        xy_samples = np.concatenate(samples)
+        latlon_samples = xy_to_latlon(xy_samples)
+        results = {'samples': {'lat': latlon_samples[:, 0], 'lon': latlon_samples[:, 1], 'distance_km': np.concatenate(distances) / 1000}}
+        for month in self._months(months):
+            results[month] = self.nearest(xy_samples, month, max_distance_km)
+        return results
+
+
+def to_json(results):
+    """JSON-serializable copy of query results (arrays as lists, NaN as None)."""
+    if isinstance(results, dict):
+        return {key: to_json(value) for key, value in results.items()}
+    if isinstance(results, np.ndarray):
+        return [to_json(value) for value in results.tolist()]
+    if isinstance(results, (list, tuple)):
+        return [to_json(value) for value in results]
+    if isinstance(results, (float, np.floating)):
+        return float(results) if np.isfinite(results) else None
+    if isinstance(results, np.integer):
+        return int(results)
+    return results
+
+
+def run_query(query, kind, parameters):
+    """Run a query from string parameters (cf serve).
+
+    Args:
+        query (RSRQuery): Query of the months.
+        kind (str): 'point', 'bbox' or 'transect'.
+        parameters (dict): Parameters of the query, e.g. {'lat': '80', 'lon': '10'}, with 'months' as "2017-11,2018-01"
+            and the transect 'points' as "lat,lon;lat,lon".
+
+    Returns:
+        dict: Results of the query.
+    """
+    months = parameters['months'].split(',') if parameters.get('months') else None
+    if kind == 'point':
+        return query.point(float(parameters['lat']), float(parameters['lon']), months=months,
+                           max_distance_km=float(parameters.get('max_distance_km', 10.)))
+    if kind == 'bbox':
+        return query.bbox(float(parameters['lat_min']), float(parameters['lat_max']), float(parameters['lon_min']),
+                          float(parameters['lon_max']), months=months)
+    if kind == 'transect':
+        points = [[float(value) for value in point.split(',')] for point in parameters['points'].split(';')]
+        return query.transect(points, step_km=float(parameters.get('step_km', 10.)), months=months,
+                              max_distance_km=float(parameters.get('max_distance_km', 10.)))
+    raise ValueError(f"Unknown query '{kind}'. Expected 'point', 'bbox' or 'transect'.")
+
+
+def serve(query, host='127.0.0.1', port=8765):
+    """Serve the queries over HTTP, as JSON, until interrupted :
+        GET /point?lat=80&lon=10[&months=2017-11,2018-01][&max_distance_km=10]
+        GET /bbox?lat_min=80&lat_max=82&lon_min=-10&lon_max=10[&months=...]
+        GET /transect?points=80,0;82,20[&step_km=10][&max_distance_km=10][&months=...]
+        GET /stats (months and cache statistics)
+
+    Args:
+        query (RSRQuery): Query of the months.
+        host (str, optional): Address to listen on. Defaults to '127.0.0.1' (local only).
+        port (int, optional): Port to listen on. Defaults to 8765.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            kind = url.path.strip('/')
+            parameters = {name: values[-1] for name, values in parse_qs(url.query).items()}
+            try:
+                if kind == 'stats':
+                    results = {'months': query.months, 'cache': query.cache_stats()}
+                else:
+                    results = run_query(query, kind, parameters)
+                status, body = 200, to_json(results)
+            except (KeyError, ValueError) as e:
+                status, body = 400, {'error': repr(e)}
+            content = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f"Serving RSR queries of {', '.join(query.months)} on http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def random_queries(query, nb_queries=1000, seed=0, bbox_km=100., transect_km=300., step_km=10.):
+    """Random queries around the cells of the months, for the benchmark.
+
+    Returns:
+        list: (kind, parameters) of the queries, alternating points, boxes and transects.
+    """
+    rng = np.random.default_rng(seed)
+    names = [(month, name) for month in query.months for name in sorted(query.tiles[month])]
+    if not names:
+        raise ValueError("No RSR results to query.")
+    centers = []
+    for k in rng.choice(len(names), size=nb_queries):
+        month, name = names[k]
+        cells = np.load(os.path.join(query.paths[month], QUERY_INDEX_NAME, f"tile_{name}.npy"), mmap_mode='r')
+        cell = cells[rng.integers(len(cells))]
+        centers.append((float(cell['x']), float(cell['y'])))
+    centers = np.array(centers)
+
+    queries = []
+    for i, (x, y) in enumerate(centers):
+        kind = ('point', 'bbox', 'transect')[i % 3]
+        if kind == 'point':
+            (lat, lon), = xy_to_latlon(np.array([[x, y]]))
+            queries.append((kind, {'lat': lat, 'lon': lon}))
+        elif kind == 'bbox':
+            corners = xy_to_latlon(np.array([[x - bbox_km * 500, y - bbox_km * 500], [x + bbox_km * 500, y + bbox_km * 500],
+                                             [x - bbox_km * 500, y + bbox_km * 500], [x + bbox_km * 500, y - bbox_km * 500]]))
+            lat_min, lat_max = corners[:, 0].min(), min(corners[:, 0].max(), 90.)
+            # Longitudes of the box around its center, within 180 degrees
+            (_, lon_center), = xy_to_latlon(np.array([[x, y]]))
+            lon_offsets = (corners[:, 1] - lon_center + 180) % 360 - 180
+            lon_min, lon_max = lon_center + lon_offsets.min(), lon_center + lon_offsets.max()
+            queries.append((kind, {'lat_min': lat_min, 'lat_max': lat_max, 'lon_min': (lon_min + 180) % 360 - 180, 'lon_max': (lon_max + 180) % 360 - 180}))
+        else:
+            angle = rng.uniform(0, np.pi)
+            offset = transect_km * 500 * np.array([np.cos(angle), np.sin(angle)])
+            points = xy_to_latlon(np.array([[x, y] - offset, [x, y] + offset]))
+            queries.append((kind, {'points': points.tolist(), 'step_km': step_km}))
+    return queries
+
+
+def benchmark(query, nb_queries=1000, seed=0, **kwargs):
+    """Measure the throughput (queries/s) and the latency percentiles of random queries (cf random_queries),
+    run one after the other from an empty cache.
+
+    Args:
+        query (RSRQuery): Query of the months.
+        nb_queries (int, optional): Number of queries. Defaults to 1000.
+        seed (int, optional): Seed of the random queries. Defaults to 0.
+
+    Returns:
+        dict: qps, p50_ms, p99_ms and max_ms of each kind of query and of all of them, and the cache statistics.
+    """
+    queries = random_queries(query, nb_queries, seed, **kwargs)
+    query.clear_cache()
+    latencies = {'point': [], 'bbox': [], 'transect': []}
+    for kind, parameters in queries:
+        start = time.perf_counter()
+        if kind == 'point':
+            query.point(parameters['lat'], parameters['lon'])
+        elif kind == 'bbox':
+            query.bbox(parameters['lat_min'], parameters['lat_max'], parameters['lon_min'], parameters['lon_max'])
+        else:
+            query.transect(parameters['points'], step_km=parameters['step_km'])
+        latencies[kind].append(time.perf_counter() - start)
+    latencies['all'] = [latency for kind in ('point', 'bbox', 'transect') for latency in latencies[kind]]
+
+    results = {'months': query.months, 'nb_queries': nb_queries, 'cache_tiles': query.cache_tiles, 'stages': {}}
+    for kind, times in latencies.items():
+        if times:
+            times = np.array(times)
+            results['stages'][kind] = {'nb_queries': len(times), 'qps': len(times) / times.sum(), 'p50_ms': 1000 * np.percentile(times, 50),
+                                       'p99_ms': 1000 * np.percentile(times, 99), 'max_ms': 1000 * times.max()}
+            print(f"{kind}: {len(times)} queries, {results['stages'][kind]['qps']:.0f} queries/s, p50 {results['stages'][kind]['p50_ms']:.2f} ms, "
+                  f"p99 {results['stages'][kind]['p99_ms']:.2f} ms, max {results['stages'][kind]['max_ms']:.2f} ms")
+    results['cache'] = query.cache_stats()
+    print(f"Tile cache: {results['cache']['hits']} hits, {results['cache']['misses']} misses")
+    return results
+
+
+if __name__ == "__main__":
+    """
+    Query service of the RSR results of several months :
+        python rsr_query.py build PATH [PATH ...]
+        python rsr_query.py serve PATH [PATH ...] [--port 8765] [--cache-tiles 256]
+        python rsr_query.py benchmark PATH [PATH ...] [--nb-queries 1000] [--output PATH]
+    The months can also be given by a pipeline configuration (--config CONFIG.json) instead of their directories.
+    """
+
+    parser = argparse.ArgumentParser(description="Query the RSR results of several months")
+    parser.add_argument("command", choices=['build', 'serve', 'benchmark'])
+    parser.add_argument("paths", nargs="*", help="Data directories of the months")
+    parser.add_argument("--config", help="Pipeline configuration giving the months")
+    parser.add_argument("--tile-km", type=float, default=250)
+    parser.add_argument("--cache-tiles", type=int, default=256)
+    parser.add_argument("--min-crl", type=float, default=0.)
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--nb-queries", type=int, default=1000)
+    parser.add_argument("--output", help="Directory of the benchmark report (saved in <output>/reports/rsr_query_benchmark_<date>.json)")
+    args = parser.parse_args()
+
+    options = dict(tile_km=args.tile_km, cache_tiles=args.cache_tiles, min_crl=args.min_crl)
+    if args.config:
+        with open(args.config, 'r') as f:
+            query = RSRQuery.from_config(json.load(f), **options)
+    else:
+        query = RSRQuery(args.paths, **options)
+
+    if args.command == 'serve':
+        serve(query, args.host, args.port)
+    elif args.command == 'benchmark':
+        results = benchmark(query, args.nb_queries)
+        if args.output:
+            filename = report_filename(args.output, 'rsr_query_benchmark')
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, 'w') as f:
+                json.dump(results, f, indent=1)
+            print(f"Benchmark saved in {filename}")
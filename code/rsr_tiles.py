@@ -0,0 +1,250 @@
+from utils import arctic_grid, read_psep_from_csv
+from apply_rsr import apply_rsr
+from psep_store import load_psep_store
+from run_stats import reset, write_report, report_filename
+from spatial_index import SpatialIndex
+import argparse
+import json
+import os
+import warnings
+import numpy as np
+import pandas as pd
+
+
+# Extent of the EPSG:3413 zone of the Arctic grid (in meters)
+X_MIN, Y_MIN = -2500000, -2500000
+
+
+def tile_ids(xy_array, tile_km=500):
+    """Compute the id of the tile of each point.
+
+    Tiles are squares of tile_km in the EPSG:3413 plane, starting at the corner of the Arctic grid,
+    so that the same point always falls in the same tile.
+
+    Args:
+        xy_array (np.ndarray): EPSG:3413 coordinates of the points (m), shape (N, 2).
+        tile_km (float, optional): Size of the tiles (km). Defaults to 500.
+
+    Returns:
+        np.ndarray: Array of shape (N,) of tile ids ("<ix>_<iy>").
+    """
+    ix = np.floor((xy_array[:, 0] - X_MIN) / (tile_km * 1000)).astype(np.int64)
+    iy = np.floor((xy_array[:, 1] - Y_MIN) / (tile_km * 1000)).astype(np.int64)
+    return np.array([f"{i}_{j}" for i, j in zip(ix, iy)])
+
+
+def tile_bounds(tile_id, tile_km=500, halo_km=0):
+    """EPSG:3413 bounds (x_min, x_max, y_min, y_max) of a tile, extended by a halo (m)."""
+    ix, iy = (int(i) for i in tile_id.split('_'))
+    size, halo = tile_km * 1000, halo_km * 1000
+    return (X_MIN + ix*size - halo, X_MIN + (ix + 1)*size + halo,
+            Y_MIN + iy*size - halo, Y_MIN + (iy + 1)*size + halo)
+
+
+def grid_tiles(step_km=10, lat_min=72, tile_km=500, **kwargs):
+    """Split the Arctic grid into tiles.
+
+    Args:
+        step_km (int, optional): The distance between grid points in kilometers. Defaults to 10.
+        lat_min (float, optional): The minimum latitude for the grid (deg). Defaults to 72.
+        tile_km (float, optional): Size of the tiles (km). Defaults to 500.
+
+    Returns:
+        dict: Sorted dictionary mapping each non-empty tile id to the indices of its grid points.
+    """
+    _, xy_grid = arctic_grid(step_km=step_km, lat_min=lat_min, return_xy=True)
+    ids = tile_ids(xy_grid, tile_km)
+    tiles = {}
+    for tile_id in sorted(set(ids), key=lambda t: tuple(int(i) for i in t.split('_'))):
+        tiles[tile_id] = np.flatnonzero(ids == tile_id)
+    return tiles
+
+
+def targets_beyond_halo(xy_targets, xy_array, xy_bounds, nb_closest=1000, neighborhood_mode='knn', **kwargs):
+    """Number of targets whose 'knn' neighborhood reaches beyond the halo of their tile.
+
+    The nb_closest-th closest burst read for such a target is farther than the edge of the halo, so bursts
+    outside the halo could be closer, and its result may differ from a single run. The targets which are not
+    over ice (cf is_ice) are not counted, as they are skipped.
+
+    Args:
+        xy_targets (np.ndarray): EPSG:3413 coordinates of the targets of the tile (m), shape (M, 2).
+        xy_array (np.ndarray): EPSG:3413 coordinates of the bursts read for the tile (m), shape (N, 2).
+        xy_bounds (tuple): EPSG:3413 bounds of the tile and its halo (m), cf tile_bounds.
+        nb_closest (int, optional): Number of closest bursts in 'knn' mode. Defaults to 1000.
+        neighborhood_mode (str, optional): 'knn' or 'radius' (always 0, the halo being checked by run_tiles). Defaults to 'knn'.
+
+    Returns:
+        int: Number of targets.
+    """
+    if neighborhood_mode != 'knn' or len(xy_targets) == 0 or len(xy_array) == 0:
+        return 0
+    distances, _ = SpatialIndex(xy_array).query(xy_targets, k=nb_closest)
+    x_min, x_max, y_min, y_max = xy_bounds
+    margin = np.min([xy_targets[:, 0] - x_min, x_max - xy_targets[:, 0], xy_targets[:, 1] - y_min, y_max - xy_targets[:, 1]], axis=0)
+    # Fewer than nb_closest bursts in the tile and its halo : the neighborhood is all of them (inf distance)
+    over_ice = distances[:, 0] < 10 * 1000     # Closest burst within the max_distance_km of is_ice
+    return int(np.sum((distances[:, -1] > margin) & over_ice))
+
+
+def run_tiles(path, tiles_to_run, step_km=10, lat_min=72, tile_km=500, halo_km=100, use_psep_store=False, run_report=True, **kwargs):
+    """Apply RSR to a subset of tiles of the Arctic grid, independently from the other tiles.
+
+    Only the PSEP bursts within the tile and its halo are read. The halo must be at least the
+    neighbor search radius (max_radius_km in 'radius' mode, the distance of the nb_closest-th
+    closest burst in 'knn' mode) for the results to be the same as a single run : a ValueError is
+    raised in 'radius' mode if it is smaller than max_radius_km, and in 'knn' mode a warning gives
+    the number of targets whose neighborhood reaches beyond the halo (cf targets_beyond_halo).
+
+    The results of a tile are saved in path/tiles/rsr_results_tile_<id>_core_<i>.csv, and a
+    tile_<id>.done file is written when the tile is complete.
+
+    Args:
+        path (str): Path to the data directory.
+        tiles_to_run (list): Ids of the tiles to process.
+        step_km (int, optional): The distance between grid points in kilometers. Defaults to 10.
+        lat_min (float, optional): The minimum latitude for the grid (deg). Defaults to 72.
+        tile_km (float, optional): Size of the tiles (km). Defaults to 500.
+        halo_km (float, optional): Width of the halo of PSEP bursts read around each tile (km). Defaults to 100.
+        use_psep_store (bool, optional): Whether to read the PSEP from the consolidated store (cf psep_store.py). Defaults to False.
+        run_report (bool, optional): Whether to save the duration and throughput of each stage in path/tiles/reports/run_tiles_<date>.json. Defaults to True.
+        **kwargs: Additional keyword arguments for apply_rsr.
+    """
+    if kwargs.get('neighborhood_mode', 'knn') == 'radius' and halo_km < kwargs.get('max_radius_km', 50.):
+        raise ValueError(f"halo_km ({halo_km} km) must be at least max_radius_km ({kwargs.get('max_radius_km', 50.)} km) in 'radius' mode")
+
+    reset('run_tiles')
+    tiles_dir = os.path.join(path, "tiles")
+    os.makedirs(tiles_dir, exist_ok=True)
+
+    latlon_grid, xy_grid = arctic_grid(step_km=step_km, lat_min=lat_min, return_xy=True)
+    tiles = grid_tiles(step_km=step_km, lat_min=lat_min, tile_km=tile_km)
+    with open(os.path.join(tiles_dir, "tiles.json"), 'w') as f:
+        json.dump({'step_km': step_km, 'lat_min': lat_min, 'tile_km': tile_km, 'halo_km': halo_km,
+                   'tiles': {tile_id: len(indices) for tile_id, indices in tiles.items()}}, f, indent=1)
+
+    for tile_id in tiles_to_run:
+        if tile_id not in tiles:
+            raise ValueError(f"Tile {tile_id} does not contain any grid point")
+        print(f"Processing tile {tile_id} ({len(tiles[tile_id])} grid points)")
+
+        xy_bounds = tile_bounds(tile_id, tile_km, halo_km)
+        if use_psep_store:
+            latlon_array, powers_2D_array, xy_array, kwargs['row_order'] = load_psep_store(os.path.join(path, "psep"), xy_bounds=xy_bounds)
+        else:
+            latlon_array, powers_2D_array, xy_array = read_psep_from_csv(os.path.join(path, "psep"), return_xy=True, xy_bounds=xy_bounds)
+        nb_targets, nb_beyond_halo = 0, 0
+        if len(latlon_array) > 0:
+            indices = tiles[tile_id]
+            nb_beyond_halo = targets_beyond_halo(xy_grid[indices], xy_array, xy_bounds, **kwargs)
+            if nb_beyond_halo > 0:
+                warnings.warn(f"Tile {tile_id}: the neighborhoods of {nb_beyond_halo} targets reach beyond the halo of {halo_km} km, "
+                              f"their results may differ from a single run (increase halo_km)")
+            apply_rsr(latlon_grid[indices], latlon_array, powers_2D_array, tiles_dir,
+                      xy_target_array=xy_grid[indices], xy_array=xy_array, lat_min=lat_min,
+                      output_name=f"rsr_results_tile_{tile_id}", **kwargs)
+            nb_targets = len(indices)
+        else:
+            print(f"No PSEP data in tile {tile_id}")
+
+        with open(os.path.join(tiles_dir, f"tile_{tile_id}.done"), 'w') as f:
+            json.dump({'nb_grid_points': nb_targets, 'nb_psep_bursts': len(latlon_array), 'nb_targets_beyond_halo': nb_beyond_halo}, f)
+
+    if run_report:
+        write_report(report_filename(tiles_dir, 'run_tiles'))
+
+
+def merge_tiles(path, allow_missing=False):
+    """Merge the results of all the tiles in path/rsr_results_tiles.csv.
+
+    Args:
+        path (str): Path to the data directory.
+        allow_missing (bool, optional): Whether to merge even if some tiles are not complete. Defaults to False.
+
+    Raises:
+        ValueError: If some tiles are missing (unless allow_missing), or if a target appears twice.
+    """
+    tiles_dir = os.path.join(path, "tiles")
+    with open(os.path.join(tiles_dir, "tiles.json"), 'r') as f:
+        tiles = json.load(f)['tiles']
+
+    missing_tiles = [tile_id for tile_id in tiles if not os.path.exists(os.path.join(tiles_dir, f"tile_{tile_id}.done"))]
+    if missing_tiles:
+        message = f"{len(missing_tiles)}/{len(tiles)} tiles are not complete: {' '.join(missing_tiles)}"
+        if not allow_missing:
+            raise ValueError(message)
+        print(message)
+
+    results = []
+    for tile_id in tiles:
+        if tile_id in missing_tiles:
+            continue
+        prefix = f"rsr_results_tile_{tile_id}_core_"
+        for csv_file in sorted(f for f in os.listdir(tiles_dir) if f.startswith(prefix) and f.endswith('.csv')):
+            results.append(pd.read_csv(os.path.join(tiles_dir, csv_file)))
+    results = pd.concat(results, ignore_index=True) if results else pd.DataFrame(columns=['lat', 'lon', 'value', 'power', 'crl', 'flag'])
+
+    duplicated = results.duplicated(subset=['lat', 'lon'], keep=False)
+    if duplicated.any():
+        raise ValueError(f"{duplicated.sum()} results with duplicated targets, e.g.\n{results[duplicated].head()}")
+
+    output_filename = os.path.join(path, "rsr_results_tiles.csv")
+    results.to_csv(output_filename, index=False)
+    print(f"{len(results)} results from {len(tiles) - len(missing_tiles)} tiles merged in {output_filename}")
+
+
+if __name__ == "__main__":
+    """
+    Tile-sharded RSR, to spread a month over several nodes sharing a filesystem :
+    1. On each node, run a subset of the tiles :
+        python rsr_tiles.py run PATH --node-index i --nb-nodes n
+       (or python rsr_tiles.py run PATH --tiles 3_4 3_5 ...)
+    2. When all the tiles are complete, merge the results :
+        python rsr_tiles.py merge PATH
+    """
+
+    parser = argparse.ArgumentParser(description="Tile-sharded RSR over the Arctic grid")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_list = subparsers.add_parser("list", help="List the tiles of the grid")
+    parser_run = subparsers.add_parser("run", help="Apply RSR to a subset of tiles")
+    parser_merge = subparsers.add_parser("merge", help="Merge the results of the tiles")
+
+    for p in (parser_list, parser_run):
+        p.add_argument("--step-km", type=float, default=10)
+        p.add_argument("--lat-min", type=float, default=72.)
+        p.add_argument("--tile-km", type=float, default=500)
+
+    parser_run.add_argument("path")
+    parser_run.add_argument("--tiles", nargs="+", help="Ids of the tiles to process")
+    parser_run.add_argument("--node-index", type=int, help="Process the tiles i, i+n, i+2n, ...")
+    parser_run.add_argument("--nb-nodes", type=int, default=1)
+    parser_run.add_argument("--halo-km", type=float, default=100)
+    parser_run.add_argument("--nb-cores", type=int, default=8)
+    parser_run.add_argument("--nb-closest", type=int, default=1000)
+    parser_run.add_argument("--min-method", default='least_squares')
+    parser_run.add_argument("--fit-mode", default='full', choices=['full', 'moments', 'tiered'])
+    parser_run.add_argument("--use-psep-store", action="store_true", help="Read the PSEP from the consolidated store")
+
+    parser_merge.add_argument("path")
+    parser_merge.add_argument("--allow-missing", action="store_true")
+
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for tile_id, indices in grid_tiles(step_km=args.step_km, lat_min=args.lat_min, tile_km=args.tile_km).items():
+            print(tile_id, len(indices))
+
+    elif args.command == "run":
+        if args.tiles:
+            tiles_to_run = args.tiles
+        else:
+            all_tiles = list(grid_tiles(step_km=args.step_km, lat_min=args.lat_min, tile_km=args.tile_km))
+            node_index = args.node_index if args.node_index is not None else 0
+            tiles_to_run = all_tiles[node_index::args.nb_nodes]
+        run_tiles(args.path, tiles_to_run, step_km=args.step_km, lat_min=args.lat_min, tile_km=args.tile_km,
+                  halo_km=args.halo_km, nb_cores=args.nb_cores, nb_closest=args.nb_closest,
+                  min_method=args.min_method, fit_mode=args.fit_mode, use_psep_store=args.use_psep_store)
+
+    elif args.command == "merge":
+        merge_tiles(args.path, allow_missing=args.allow_missing)
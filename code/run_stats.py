@@ -0,0 +1,176 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import cProfile
+import json
+import os
+import socket
+import threading
+import time
+
+
+# Name of the environment variable enabling the per-worker profiles (inherited by the worker processes)
+PROFILE_DIR_VARIABLE = "RSR_PROFILE_DIR"
+# Minimum time between two dumps of the profile of a worker (s), the profile being also dumped when the worker exits
+PROFILE_DUMP_INTERVAL = 60.
+
+# Statistics of the current process : {stage name: {'time': s, 'calls': n, <counter>: total}}
+_stages = {}
+# Pids of the worker processes whose statistics were merged
+_workers = set()
+# Summaries added to the report (e.g. fit telemetry), by name
+_summaries = {}
+_run = {}
+_profiler = None
+_profile_dumped = 0.
+# Stages can be recorded by several threads (e.g. parallel downloads)
+_lock = threading.Lock()
+
+
+def reset(name=None):
+    """Clear the statistics of the current process, and start a new run."""
+    global _run
+    _stages.clear()
+    _workers.clear()
+    _summaries.clear()
+    _run = {'name': name, 'start': datetime.now(timezone.utc).isoformat(), 'start_time': time.perf_counter()}
+
+
+def record(name, elapsed=0., calls=1, **counters):
+    """Add a duration and counters (e.g. bytes, bursts, fits) to a stage."""
+    with _lock:
+        stats = _stages.setdefault(name, {'time': 0., 'calls': 0})
+        stats['time'] += elapsed
+        stats['calls'] += calls
+        for counter, value in counters.items():
+            stats[counter] = stats.get(counter, 0) + value
+
+
+@contextmanager
+def stage(name, **counters):
+    """Time a stage of the processing.
+
+    The counters known in advance are given as keyword arguments, the other ones can be added
+    to the yielded dictionary:
+
+        with stage('download') as counters:
+            ...
+            counters['bytes'] = size
+    """
+    counters = dict(counters)
+    start = time.perf_counter()
+    try:
+        yield counters
+    finally:
+        record(name, time.perf_counter() - start, **counters)
+
+
+def add_summary(name, summary):
+    """Add a JSON-serializable summary to the run report (cf report)."""
+    _summaries[name] = summary
+
+
+def snapshot():
+    """Statistics of the current process."""
+    with _lock:
+        return {'pid': os.getpid(), 'stages': {name: dict(stats) for name, stats in _stages.items()}}
+
+
+def merge(stats):
+    """Add the statistics of a worker process (cf run_instrumented) to the statistics of the current process."""
+    _workers.add(stats['pid'])
+    for name, stage_stats in stats['stages'].items():
+        counters = {counter: value for counter, value in stage_stats.items() if counter not in ('time', 'calls')}
+        record(name, stage_stats['time'], stage_stats['calls'], **counters)
+
+
+def run_instrumented(function, *args, **kwargs):
+    """Run a task in a worker process, and return its result with the statistics of the task.
+
+    To be submitted to a ProcessPoolExecutor instead of the task itself, the result being read with collect
+    (the statistics of the worker are cleared at the beginning of each task).
+    If the RSR_PROFILE_DIR environment variable is set (cf enable_profiling), the tasks of each worker
+    are profiled with cProfile, in <RSR_PROFILE_DIR>/worker_<pid>.prof, dumped when the worker exits and
+    at most every PROFILE_DUMP_INTERVAL seconds.
+    """
+    global _profiler, _profile_dumped
+    _stages.clear()
+    profile_dir = os.environ.get(PROFILE_DIR_VARIABLE)
+    if profile_dir:
+        if _profiler is None:
+            _profiler = cProfile.Profile()
+            _profile_dumped = time.monotonic()
+            # Run when the worker exits normally (atexit handlers are not run by the forked workers)
+            from multiprocessing.util import Finalize
+            Finalize(None, _dump_profile, args=(profile_dir,), exitpriority=10)
+        _profiler.enable()
+    try:
+        result = function(*args, **kwargs)
+    finally:
+        if profile_dir:
+            _profiler.disable()
+            # Also dumped from time to time, in case the worker is killed
+            if time.monotonic() - _profile_dumped > PROFILE_DUMP_INTERVAL:
+                _dump_profile(profile_dir)
+    return result, snapshot()
+
+
+def _dump_profile(profile_dir):
+    global _profile_dumped
+    if _profiler is not None:
+        _profiler.dump_stats(os.path.join(profile_dir, f"worker_{os.getpid()}.prof"))
+        _profile_dumped = time.monotonic()
+
+
+def collect(future):
+    """Result of a task submitted with run_instrumented, its statistics being merged with the ones of the current process."""
+    result, stats = future.result()
+    merge(stats)
+    return result
+
+
+def enable_profiling(profile_dir):
+    """Profile the tasks of the worker processes started from now on with cProfile.
+
+    The profiles can be read with pstats or snakeviz. To sample a running worker with py-spy instead,
+    use its pid from the run report: py-spy dump --pid <pid>.
+    """
+    os.makedirs(profile_dir, exist_ok=True)
+    os.environ[PROFILE_DIR_VARIABLE] = os.path.abspath(profile_dir)
+
+
+def report():
+    """Run report : duration and counters of each stage, and their throughput.
+
+    The time of a stage is summed over the processes, so the throughputs (<counter>_per_s) are per process.
+    The aggregate throughputs (<counter>_per_s_wall) use the wall time of the run.
+    """
+    wall_time = time.perf_counter() - _run.get('start_time', time.perf_counter())
+    stages = {}
+    for name, stats in _stages.items():
+        stages[name] = dict(stats)
+        for counter, value in stats.items():
+            if counter in ('time', 'calls'):
+                continue
+            if stats['time'] > 0:
+                stages[name][counter + '_per_s'] = value / stats['time']
+            if wall_time > 0:
+                stages[name][counter + '_per_s_wall'] = value / wall_time
+    return {'name': _run.get('name'), 'start': _run.get('start'), 'wall_time': wall_time,
+            'host': socket.gethostname(), 'pid': os.getpid(), 'workers': sorted(_workers), 'stages': stages,
+            'summaries': dict(_summaries)}
+
+
+def write_report(filename):
+    """Write the run report in a JSON file."""
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    with open(filename, 'w') as f:
+        json.dump(report(), f, indent=1)
+    print(f"Run report saved in {filename}")
+
+
+def report_filename(path, name):
+    """Default path of the report of a run : path/reports/<name>_<date>.json"""
+    return os.path.join(path, "reports", f"{name}_{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')}.json")
+
+
+reset()
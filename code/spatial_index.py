@@ -0,0 +1,149 @@
+from functools import lru_cache
+import numpy as np
+from pyproj import Transformer
+from scipy.spatial import cKDTree
+from run_stats import stage
+
+
+@lru_cache(maxsize=None)
+def get_transformer(crs_from, crs_to):
+    """Return a cached pyproj Transformer (with always_xy=True)."""
+    return Transformer.from_crs(crs_from, crs_to, always_xy=True)
+
+
+def latlon_to_xy(latlon_array):
+    """Project lat/lon points to the EPSG:3413 polar stereographic plane.
+
+    Args:
+        latlon_array (np.ndarray): An array of shape (N, 2) of (latitude, longitude) in degrees.
+
+    Returns:
+        np.ndarray: An array of shape (N, 2) of (x, y) coordinates in meters.
+    """
+    latlon_array = np.asarray(latlon_array, dtype=np.float64).reshape(-1, 2)
+    x, y = get_transformer("EPSG:4326", "EPSG:3413").transform(latlon_array[:, 1], latlon_array[:, 0])
+    return np.column_stack((x, y))
+
+
+def xy_to_latlon(xy_array):
+    """Inverse of latlon_to_xy.
+
+    Args:
+        xy_array (np.ndarray): An array of shape (N, 2) of EPSG:3413 (x, y) coordinates in meters.
+
+    Returns:
+        np.ndarray: An array of shape (N, 2) of (latitude, longitude) in degrees.
+    """
+    xy_array = np.asarray(xy_array, dtype=np.float64).reshape(-1, 2)
+    lons, lats = get_transformer("EPSG:3413", "EPSG:4326").transform(xy_array[:, 0], xy_array[:, 1])
+    return np.column_stack((lats, lons))
+
+
+class SpatialIndex:
+    """2D KD-tree over points projected in EPSG:3413, serving k-NN and radius queries.
+
+    Queries return the row indices of the points in the array the index was built from,
+    even if some points had non-finite coordinates and were left out of the tree.
+    Distances are planar distances in the EPSG:3413 plane (true scale at 70N, within a few
+    percent north of 60N).
+    """
+
+    def __init__(self, xy_array):
+        """
+        Args:
+            xy_array (np.ndarray): An array of shape (N, 2) of EPSG:3413 (x, y) coordinates in meters.
+        """
+        xy_array = np.asarray(xy_array, dtype=np.float64).reshape(-1, 2)
+        finite = np.isfinite(xy_array).all(axis=1)
+        self.row_indices = np.flatnonzero(finite)
+        with stage('kdtree_build', points=len(self.row_indices)):
+            self.tree = cKDTree(xy_array[finite])
+        self.nb_points = len(xy_array)
+
+    @classmethod
+    def from_latlon(cls, latlon_array):
+        """Build the index from (latitude, longitude) points."""
+        return cls(latlon_to_xy(latlon_array))
+
+    def query(self, xy_targets, k=1000, distance_upper_bound=np.inf):
+        """Find the k closest points of each target.
+
+        Args:
+            xy_targets (np.ndarray): An array of shape (M, 2) of EPSG:3413 (x, y) target coordinates in meters.
+            k (int, optional): The number of closest neighbors to find. Defaults to 1000.
+            distance_upper_bound (float, optional): Maximum distance of the neighbors (m). Defaults to inf.
+
+        Returns:
+            distances (np.ndarray): An array of shape (M, k) of distances (m), inf for missing neighbors.
+            indices (np.ndarray): An array of shape (M, k) of row indices, -1 for missing neighbors.
+        """
+        xy_targets = np.asarray(xy_targets, dtype=np.float64).reshape(-1, 2)
+        distances, tree_indices = self.tree.query(xy_targets, k=k, distance_upper_bound=distance_upper_bound)
+        distances = distances.reshape(len(xy_targets), k)
+        tree_indices = tree_indices.reshape(len(xy_targets), k)
+        found = tree_indices < self.tree.n
+        indices = np.full(tree_indices.shape, -1, dtype=np.int64)
+        indices[found] = self.row_indices[tree_indices[found]]
+        return distances, indices
+
+    def query_radius(self, xy_targets, radius):
+        """Find all the points within a radius of each target.
+
+        Args:
+            xy_targets (np.ndarray): An array of shape (M, 2) of EPSG:3413 (x, y) target coordinates in meters.
+            radius (float): Search radius (m).
+
+        Returns:
+            list: M arrays of sorted row indices.
+        """
+        xy_targets = np.asarray(xy_targets, dtype=np.float64).reshape(-1, 2)
+        tree_indices = self.tree.query_ball_point(xy_targets, r=radius)
+        return [np.sort(self.row_indices[np.asarray(idx, dtype=np.int64)]) for idx in tree_indices]
+
+    def distance_to_nearest(self, xy_targets):
+        """Distance (m) from each target to its closest point."""
+        distances, _ = self.query(xy_targets, k=1)
+        return distances[:, 0]
+
+
+def find_neighborhoods(psep_index, xy_targets, nb_closest=1000, neighborhood_mode='knn', max_radius_km=50., min_bursts=200, max_bursts=1000, row_order=None, **kwargs):
+    """Find the psep bursts used for the RSR of each target.
+
+    In 'knn' mode, the nb_closest closest bursts are used (all the bursts if there are fewer). In 'radius' mode, the bursts within
+    max_radius_km are used: targets with less than min_bursts bursts get an empty neighborhood
+    (to be skipped), and neighborhoods with more than max_bursts bursts are subsampled
+    deterministically (evenly spaced in row order, i.e. along the tracks) down to max_bursts.
+    If the rows were reordered (e.g. spatially sorted store), row_order gives the original order of the rows.
+
+    Args:
+        psep_index (SpatialIndex): Spatial index of the psep bursts.
+        xy_targets (np.ndarray): EPSG:3413 coordinates of the targets (m), shape (M, 2).
+        nb_closest (int, optional): Number of closest bursts in 'knn' mode. Defaults to 1000.
+        neighborhood_mode (str, optional): 'knn' or 'radius'. Defaults to 'knn'.
+        max_radius_km (float, optional): Search radius in 'radius' mode (km). Defaults to 50.
+        min_bursts (int, optional): Minimum number of bursts in 'radius' mode. Defaults to 200.
+        max_bursts (int, optional): Maximum number of bursts in 'radius' mode. Defaults to 1000.
+        row_order (np.ndarray, optional): Original order of each row, used for the subsampling. Defaults to None (row order).
+
+    Returns:
+        list: M arrays of burst row indices.
+    """
+    if neighborhood_mode == 'knn':
+        _, indices = psep_index.query(xy_targets, k=nb_closest)
+        # Missing neighbors (fewer than nb_closest bursts) are -1
+        return [row[row >= 0] for row in indices]
+    if neighborhood_mode != 'radius':
+        raise ValueError(f"Unknown neighborhood_mode: {neighborhood_mode}. Expected 'knn' or 'radius'.")
+
+    neighborhoods = []
+    for indices in psep_index.query_radius(xy_targets, max_radius_km * 1000):
+        if len(indices) < min_bursts:
+            indices = indices[:0]
+        elif len(indices) > max_bursts:
+            if row_order is not None:
+                indices = indices[np.argsort(row_order[indices], kind='stable')]
+            indices = indices[np.linspace(0, len(indices) - 1, max_bursts).round().astype(np.int64)]
+            if row_order is not None:
+                indices = np.sort(indices)
+        neighborhoods.append(indices)
+    return neighborhoods
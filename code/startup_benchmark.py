@@ -0,0 +1,107 @@
+from concurrent.futures import ProcessPoolExecutor
+from run_stats import report_filename
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+# Modules imported by the worker processes of each stage
+WORKER_MODULES = {"extract_psep": "psep_worker", "apply_rsr": "apply_rsr"}
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def import_time(module, repeat=5):
+    """Time to import a module in a new interpreter (s), median of repeat runs."""
+    code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", code], cwd=CODE_DIR, capture_output=True, text=True, check=True).stdout
+        times.append(float(output))
+    return statistics.median(times)
+
+
+def _import_worker_module(module):
+    importlib.import_module(module)
+    if module == "psep_worker":
+        from psep_worker import init_worker
+        init_worker()
+
+
+def _worker_pid(_):
+    # Keeps the worker busy long enough for the other tasks to start the other workers
+    time.sleep(0.05)
+    return os.getpid()
+
+
+def pool_startup_time(module, nb_workers=8, start_method='spawn', repeat=3):
+    """Time to start a pool of worker processes importing a module, until all of them ran a task (s), median of repeat runs.
+
+    As in the stages, the module is imported by the parent process first (inherited by the workers with 'fork').
+    The time of the tasks themselves (50 ms each, 1 per worker) is subtracted.
+    """
+    _import_worker_module(module)
+    context = multiprocessing.get_context(start_method)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=nb_workers, mp_context=context, initializer=_import_worker_module, initargs=(module,)) as executor:
+            pids = set(executor.map(_worker_pid, range(nb_workers)))
+        times.append(time.perf_counter() - start - 0.05 * nb_workers / len(pids))
+    return statistics.median(times)
+
+
+def run_benchmark(nb_workers=8, start_methods=('spawn', 'fork'), repeat=3):
+    """Measure the startup time of the worker processes of each stage.
+
+    Args:
+        nb_workers (int, optional): Number of worker processes of the pools. Defaults to 8.
+        start_methods (tuple, optional): Start methods of the pools to measure. Defaults to ('spawn', 'fork').
+        repeat (int, optional): Number of runs of each measure (median). Defaults to 3.
+
+    Returns:
+        dict: Import time of the module of each stage, and startup time of its pools by start method (s).
+    """
+    results = {}
+    for stage_name, module in WORKER_MODULES.items():
+        results[stage_name] = {'module': module, 'import_s': import_time(module, repeat)}
+        for start_method in start_methods:
+            results[stage_name][f'pool_{start_method}_s'] = pool_startup_time(module, nb_workers, start_method, repeat)
+        print(f"{stage_name} ({module}): " + ", ".join(f"{name} {value*1000:.0f} ms" for name, value in results[stage_name].items() if name != 'module'))
+    return {'nb_workers': nb_workers, 'python': sys.version.split()[0], 'stages': results}
+
+
+if __name__ == "__main__":
+    """
+    Startup time of the worker processes of the extraction and RSR stages :
+        python startup_benchmark.py [--nb-workers 8] [--max-import-ms 1500] [--output PATH]
+    Exits with an error if a worker module takes more than --max-import-ms to import.
+    """
+
+    parser = argparse.ArgumentParser(description="Measure the startup time of the worker processes")
+    parser.add_argument("--nb-workers", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--start-methods", nargs="+", default=['spawn', 'fork'], choices=multiprocessing.get_all_start_methods())
+    parser.add_argument("--max-import-ms", type=float, help="Maximum import time of a worker module (ms)")
+    parser.add_argument("--output", help="Directory of the report (saved in <output>/reports/startup_benchmark_<date>.json)")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.nb_workers, args.start_methods, args.repeat)
+    if args.output:
+        filename = report_filename(args.output, 'startup_benchmark')
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w') as f:
+            json.dump(results, f, indent=1)
+        print(f"Benchmark saved in {filename}")
+
+    if args.max_import_ms is not None:
+        too_slow = [f"{stage_name} ({stage['import_s']*1000:.0f} ms)" for stage_name, stage in results['stages'].items()
+                    if stage['import_s']*1000 > args.max_import_ms]
+        if too_slow:
+            sys.exit(f"Worker modules slower to import than {args.max_import_ms} ms: {', '.join(too_slow)}")
@@ -1,18 +1,9 @@
 import numpy as np
-from pyproj import Transformer
+from functools import lru_cache
 import os
 import pandas as pd
-from scipy.spatial import cKDTree
-
-
-def latlon_to_cartesian(lat, lon, radius=6371):
-    # lat, lon in degrees
-    lat = np.radians(lat)
-    lon = np.radians(lon)
-    x = radius * np.cos(lat) * np.cos(lon)
-    y = radius * np.cos(lat) * np.sin(lon)
-    z = radius * np.sin(lat)
-    return np.stack((x, y, z), axis=-1)
+from spatial_index import xy_to_latlon, latlon_to_xy
+from run_stats import stage
 
 
 def clean_csv(input_file):
@@ -29,16 +20,40 @@ def clean_csv(input_file):
         f.write(content)
 
 
-def arctic_grid(step_km=10, lat_min=72, **kwargs):
+def format_psep_rows(lat_data, lon_data, xy_data, product, power_max_2D_vector):
+    """Format the csv rows of the bursts of a product with a PSEP (all zeros for the bursts filtered out).
+
+    Returns:
+        tuple: The rows (bytes) and their number.
+    """
+    rows = [f'{lat_data[burst]},{lon_data[burst]},{xy_data[burst, 0]},{xy_data[burst, 1]},{product},'
+            f'{np.array2string(power_max_2D_vector[burst, :], max_line_width=np.inf)}\n'
+            for burst in range(power_max_2D_vector.shape[0]) if power_max_2D_vector[burst, 0] != 0]
+    return ''.join(rows).encode(), len(rows)
+
+
+def arctic_grid(step_km=10, lat_min=72, return_xy=False, **kwargs):
     """Create a grid of points in the Arctic region.
 
+    The grids are cached, so that the same grid is not computed again in the same process.
+
     Args:
         step_km (int, optional): The distance between grid points in kilometers. Defaults to 10.
         lat_min (float, optional): The minimum latitude for the grid (deg). Defaults to 72.
+        return_xy (bool, optional): Whether to also return the EPSG:3413 coordinates of the grid points. Defaults to False.
 
     Returns:
         np.ndarray: An array of shape (N, 2) containing the latitude and longitude of each grid point.
+        np.ndarray: If return_xy, an array of shape (N, 2) containing the EPSG:3413 x and y of each grid point (m).
     """
+    latlon_grid, xy_grid = _arctic_grid(step_km, lat_min)
+    if return_xy:
+        return latlon_grid.copy(), xy_grid.copy()
+    return latlon_grid.copy()  # shape (N, 2), columns: [lat, lon]
+
+
+@lru_cache(maxsize=8)
+def _arctic_grid(step_km, lat_min):
 
     # Define the EPSG:3413 zone (in meters)
     x_min, x_max = -2500000, 2500000
@@ -48,115 +63,91 @@ def arctic_grid(step_km=10, lat_min=72, **kwargs):
     x_vals = np.arange(x_min, x_max + step, step)
     y_vals = np.arange(y_min, y_max + step, step)
     xx, yy = np.meshgrid(x_vals, y_vals)
-    xy_grid = np.column_stack([xx.ravel(), yy.ravel()])
+    xy_grid = np.column_stack([xx.ravel(), yy.ravel()]).astype(np.float64)
 
     # Inverse transformation to get lat/lon
-    transformer = Transformer.from_crs("EPSG:3413", "EPSG:4326", always_xy=True)
-    lons, lats = transformer.transform(xy_grid[:, 0], xy_grid[:, 1])
-    latlon_grid = np.column_stack((lats, lons))
+    latlon_grid = xy_to_latlon(xy_grid)
 
     # Filter to keep only points north of lat_min
     mask = latlon_grid[:, 0] >= lat_min
-    latlon_grid = latlon_grid[mask]
 
-    return latlon_grid  # shape (N, 2), columns: [lat, lon]
+    return latlon_grid[mask], xy_grid[mask]
 
 
-def read_psep_from_csv(path):
+def psep_csv_files(path):
+    """Names of the PSEP csv files of a directory, in the order they are read by read_psep_from_csv."""
+    return [f for f in os.listdir(path) if f.endswith('.csv') and f.startswith('psep')]
+
+
+def read_psep_from_csv(path, return_xy=False, xy_bounds=None, return_products=False, csv_files=None):
     """Read psep values from the CSV files generated during the extraction
 
     Args:
         path (str): Path to the CSV files.
+        return_xy (bool, optional): Whether to also return the EPSG:3413 coordinates of the bursts,
+            read from the CSV files if stored there, projected otherwise. Defaults to False.
+        xy_bounds (tuple, optional): (x_min, x_max, y_min, y_max) EPSG:3413 bounds (m). If provided, only the
+            bursts within these bounds are kept. Defaults to None.
+        return_products (bool, optional): Whether to also return the product of each burst
+            ('' for files extracted before the products were recorded). Defaults to False.
+        csv_files (list, optional): Names of the CSV files to read. Defaults to None (all the PSEP files of the directory).
 
     Returns:
         latlon_array (np.ndarray): Array of latitudes and longitudes.
         powers_2D_array (np.ndarray): 2D array of power values.
+        xy_array (np.ndarray): If return_xy, array of EPSG:3413 x and y (m).
+        products (np.ndarray): If return_products, array of product filenames.
     """
     latlon_array = []
     powers_2D_array = []
+    xy_array = []
+    products = []
 
-    csv_files = [f for f in os.listdir(path) if f.endswith('.csv') and f.startswith('psep')]
+    if csv_files is None:
+        csv_files = psep_csv_files(path)
     
     for i,csv_file in enumerate(csv_files):
         print(f"Reading data from {csv_file}, file {i+1}/{len(csv_files)}")
-        data = pd.read_csv(os.path.join(path, csv_file))
+        with stage('read_psep_csv', files=1, bytes=os.path.getsize(os.path.join(path, csv_file))):
+            data = pd.read_csv(os.path.join(path, csv_file))
+        if return_xy or xy_bounds is not None:
+            if 'x' in data.columns and 'y' in data.columns:
+                xy_file = data[['x', 'y']].values.astype(np.float64)
+            else:
+                xy_file = latlon_to_xy(data[['lat', 'lon']].values)
+            if xy_bounds is not None:
+                x_min, x_max, y_min, y_max = xy_bounds
+                mask = (xy_file[:, 0] >= x_min) & (xy_file[:, 0] < x_max) & (xy_file[:, 1] >= y_min) & (xy_file[:, 1] < y_max)
+                data = data[mask]
+                xy_file = xy_file[mask]
+            xy_array.append(xy_file)
+        if return_products:
+            products.append(data['product'].to_numpy(dtype=str) if 'product' in data.columns else np.full(len(data), ''))
         data_array = data[['lat', 'lon', 'psep']].values
         
-        for (lat, lon, power_array) in data_array:
-            latlon_array.append((float(lat), float(lon)))
-            powers_2D_array.append(np.fromstring(power_array.strip('[]'), sep=' '))
-
-    return np.array(latlon_array), np.array(powers_2D_array)
+        with stage('parse_psep', bursts=len(data_array)):
+            for (lat, lon, power_array) in data_array:
+                latlon_array.append((float(lat), float(lon)))
+                powers_2D_array.append(np.fromstring(power_array.strip('[]'), sep=' '))
 
+    outputs = [np.array(latlon_array).reshape(-1, 2), np.array(powers_2D_array)]
+    if return_xy:
+        outputs.append(np.concatenate(xy_array) if xy_array else np.empty((0, 2)))
+    if return_products:
+        outputs.append(np.concatenate(products) if products else np.empty(0, dtype=str))
+    return tuple(outputs)
 
-def create_dictionary_from_xyz(lst):
-    """
-    Create a dictionary from a list of tuples.
-    Each tuple should contain three elements: (x, y, z).
-    """
-    return {(x, y, z): i for i, (x, y, z) in enumerate(lst)}
 
-
-def is_ice(latlon_target, KD_tree):
-    """Check if the target point is over ice, ie we have data, ie the closest point in KD tree is close enough (<10km)
+def is_ice(xy_targets, psep_index, max_distance_km=10):
+    """Check if the target points are over ice, ie we have data, ie the closest point in the index is close enough (<10km)
 
     Args:
-        latlon_target (tuple): Latitude and longitude of the target point.
-        KD_tree (cKDTree): KD-tree containing ice coordinates.
+        xy_targets (np.ndarray): EPSG:3413 coordinates of the target points (m), shape (M, 2).
+        psep_index (SpatialIndex): Spatial index of the psep measures.
+        max_distance_km (float, optional): Maximum distance to the closest measure (km). Defaults to 10.
 
     Returns:
-        bool: True if the target point is over ice, False otherwise.
+        np.ndarray: Boolean array of shape (M,), True if the target point is over ice, False otherwise.
     """
-    xyz_closest = find_closest_points(KD_tree, [latlon_target], k=1)
-    xyz_closest = xyz_closest[0]
-    xyz_target = latlon_to_cartesian(latlon_target[0], latlon_target[1])
-    distance = np.linalg.norm(xyz_closest - xyz_target) # in km
-
-    return distance < 10
-
-
-def build_KDtree(points_latlon):
-    """
-    Build a KD-tree from the given points (in lat/lon format).
-    
-    Args:
-        points_latlon (np.ndarray): An array of shape (N, 2) where N is the number of points in (latitude, longitude) format.
-
-    Returns:
-        cKDTree: A KD-tree constructed from the points.
-        dict: A dictionary mapping (x, y, z) coordinates to their original indices.
-    """
-    
-    print("Transforming lat/lon to Cartesian coordinates for KD-tree construction...")
-    points_cartesian = latlon_to_cartesian(points_latlon[:, 0], points_latlon[:, 1])
-    
-    # Filter out inf or nan values
-    print(f"Number of points before nan/inf filtering: {len(points_cartesian)}")
-    points_cartesian = points_cartesian[~np.isnan(points_cartesian).any(axis=1)]
-    points_cartesian = points_cartesian[~np.isinf(points_cartesian).any(axis=1)]
-    print(f"Number of points after nan/inf filtering: {len(points_cartesian)}")
-    
-    print("Building KD-tree...")
-    return cKDTree(points_cartesian), create_dictionary_from_xyz(points_cartesian)
-
-
-def find_closest_points(tree, latlon_target_list, k=1000, **kwargs):
-    """Find the closest points in the KD-tree for multiple target points.
-
-    Args:
-        tree (cKDTree): The KD-tree to search.
-        latlon_target_list (list): A list of target points in (latitude, longitude) format.
-        k (int, optional): The number of closest neighbors to find. Defaults to 1000.
-
-    Returns:
-        np.ndarray: An array of shape (M, k) with the indices of the k closest points for each target.
-    """
-    latlon_target_array = np.array(latlon_target_list)
-    if latlon_target_array.ndim == 1:
-        latlon_target_array = latlon_target_array.reshape(1, 2)
-    points_cartesian = latlon_to_cartesian(latlon_target_array[:, 0], latlon_target_array[:, 1])
-    _, indices = tree.query(points_cartesian, k=k)
-    
-    # tree.data[indices[i,j]] is the j-th closest point to the i-th target
-    return tree.data[indices]
-
+    with stage('is_ice', targets=len(xy_targets)):
+        return psep_index.distance_to_nearest(xy_targets) < max_distance_km * 1000
@@ -0,0 +1,128 @@
+from extraction_manifest import ExtractionManifest, checksum
+from psep_kernels import psep_from_waveforms, encode_waveforms
+from spatial_index import latlon_to_xy
+from utils import format_psep_rows
+import os
+import numpy as np
+
+
+def waveform_cache_path(path, year, month, product):
+    """Path of the cached power waveforms of a product : path/waveforms/<year>_<month>/<product>.npz"""
+    return os.path.join(path, "waveforms", f"{year}_{month}", product + ".npz")
+
+
+def save_waveforms(filename, lat, lon, bursts, waveforms, gains, dtype='float32', scales=None):
+    """Save the power waveforms of the filtered bursts of a product in a compressed npz file.
+
+    The waveforms are saved in dtype (cf encode_waveforms : in float16, each echo is divided by its maximum).
+
+    Args:
+        filename (str): Path to the npz file.
+        lat (np.ndarray): Latitudes of the bursts, shape (B,).
+        lon (np.ndarray): Longitudes of the bursts, shape (B,).
+        bursts (np.ndarray): Indices of the bursts in the product, shape (B,).
+        waveforms (np.ndarray): Power waveforms, shape (B, 64, L).
+        gains (np.ndarray): Total gain of each burst, shape (B,).
+        dtype (str, optional): 'float32' or 'float16'. Defaults to 'float32'.
+        scales (np.ndarray, optional): If provided, the waveforms are already encoded in float16 and these are the
+            maxima of their echoes, shape (B, 64) (cf encode_waveforms). Defaults to None.
+    """
+    arrays = {'lat': np.asarray(lat, dtype=np.float64), 'lon': np.asarray(lon, dtype=np.float64),
+              'bursts': np.asarray(bursts, dtype=np.int64), 'gains': np.asarray(gains, dtype=np.float64)}
+    if scales is None and not (dtype == 'float32' and np.asarray(waveforms).dtype == np.float32):
+        waveforms, scales = encode_waveforms(waveforms, dtype)
+    arrays['waveforms'] = waveforms
+    if scales is not None:
+        arrays['scales'] = np.asarray(scales, dtype=np.float32)
+
+    # Written under a temporary name, so that an interrupted write does not leave a corrupted file
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp_filename = filename + ".tmp.npz"
+    np.savez_compressed(tmp_filename, **arrays)
+    os.replace(tmp_filename, filename)
+
+
+def load_waveforms(filename):
+    """Load the cached power waveforms of a product.
+
+    Returns:
+        lat (np.ndarray): Latitudes of the bursts, shape (B,).
+        lon (np.ndarray): Longitudes of the bursts, shape (B,).
+        bursts (np.ndarray): Indices of the bursts in the product, shape (B,).
+        waveforms (np.ndarray): Power waveforms (float64), shape (B, 64, L).
+        gains (np.ndarray): Total gain of each burst, shape (B,).
+    """
+    with np.load(filename) as data:
+        waveforms = data['waveforms'].astype(np.float64)
+        if 'scales' in data:
+            waveforms *= data['scales'][:, :, None]
+        return data['lat'], data['lon'], data['bursts'], waveforms, data['gains']
+
+
+def sweep_psep(path, year, month, parameter_sets, use_numba=True, **kwargs):
+    """Compute the PSEP of the cached waveforms with several sets of parameters, in one pass over the cache.
+
+    The waveforms must have been cached during the extraction (extract_psep with waveform_cache=True).
+    Each set of parameters produces its own PSEP store in path/sweep/<name>/psep, with its own
+    manifest, on which apply_rsr_arctic(path/sweep/<name>) can be run. Products already in a store are skipped.
+
+    Args:
+        path (str): The path to the work directory.
+        year (str): The year of the products. (e.g. "2018")
+        month (str): The month of the products. (e.g. "01")
+        parameter_sets (dict): Dictionary mapping the name of each set of parameters to the keyword
+            arguments of the PSEP extraction (window_frac_psep, window_frac_leading_edge).
+            (e.g. {'psep_0.03': {'window_frac_psep': 0.03}, 'psep_0.08': {'window_frac_psep': 0.08}})
+        use_numba (bool, optional): Whether to use the Numba kernels if Numba is installed. Defaults to True.
+
+    Returns:
+        dict: The path of the PSEP store of each set of parameters.
+    """
+    cache_dir = os.path.dirname(waveform_cache_path(path, year, month, ""))
+    products = sorted(f[:-len(".npz")] for f in os.listdir(cache_dir) if f.endswith(".npz") and not f.endswith(".tmp.npz"))
+    print(f"Number of cached products: {len(products)}")
+
+    stores, manifests, csvfiles = {}, {}, {}
+    output_name = f"psep_{year}_{month}_sweep.csv"
+    for name in parameter_sets:
+        stores[name] = os.path.join(path, "sweep", name)
+        psep_dir = os.path.join(stores[name], "psep")
+        os.makedirs(psep_dir, exist_ok=True)
+        manifests[name] = ExtractionManifest(psep_dir)
+        manifests[name].validate()
+        csvfiles[name] = open(os.path.join(psep_dir, output_name), 'ab' if output_name in manifests[name].output_files() else 'wb')
+        if csvfiles[name].tell() == 0:
+            csvfiles[name].write(b'lat,lon,x,y,product,psep\n')
+
+    done_products = {name: manifests[name].done_products() for name in parameter_sets}
+    try:
+        for i, product in enumerate(products):
+            names = [name for name in parameter_sets if product not in done_products[name]]
+            if not names:
+                continue
+            print(f'Processing product {i+1}/{len(products)} : {product}')
+            lat, lon, bursts, waveforms, gains = load_waveforms(waveform_cache_path(path, year, month, product))
+            xy = latlon_to_xy(np.column_stack((lat, lon)))
+            nb_bursts, nb_echoes = waveforms.shape[:2]
+
+            for name in names:
+                if nb_bursts > 0:
+                    psep = psep_from_waveforms(waveforms.reshape(nb_bursts * nb_echoes, -1), np.repeat(gains, nb_echoes), use_numba=use_numba,
+                                               **parameter_sets[name]).reshape(nb_bursts, nb_echoes)
+                    psep[~np.all(np.isfinite(psep), axis=1)] = 0    # Same as the extraction : the bursts with a failed PSEP are left out
+                else:
+                    psep = np.zeros((0, nb_echoes))
+                content, nb_rows = format_psep_rows(lat, lon, xy, product, psep)
+                csvfile = csvfiles[name]
+                offset = csvfile.tell()
+                csvfile.write(content)
+                csvfile.flush()
+                os.fsync(csvfile.fileno())
+                manifests[name].record(product, 'done', nb_bursts=nb_rows, output=output_name,
+                                       offset=offset, length=len(content), checksum=checksum(content))
+    finally:
+        for csvfile in csvfiles.values():
+            csvfile.close()
+
+    return stores
+
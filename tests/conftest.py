@@ -0,0 +1,66 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# The modules of the package are imported with flat imports from the code directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "code"))
+
+from extraction_manifest import ExtractionManifest, checksum
+from spatial_index import latlon_to_xy
+from utils import format_psep_rows
+
+
+def write_psep_tracks(path, products, csv_name="psep_2017_11_0.csv", nb_bursts=300, lat_range=(78., 84.), lon_range=(0., 40.),
+                      lon_sweep=0., filtered_fraction=0., failed=(), cell_buffers=None, seed=1):
+    """Append synthetic PSEP tracks, one per product, to a csv file of path/psep, as extract_psep_batch does.
+
+    Each product is recorded in the manifest (as failed if in failed) and added to cell_buffers if given.
+
+    Args:
+        path (str): The path to the work directory.
+        products (list): Names of the products.
+        csv_name (str, optional): Name of the csv file. Defaults to "psep_2017_11_0.csv".
+        nb_bursts (int, optional): Number of bursts per track. Defaults to 300.
+        lat_range (tuple, optional): Latitudes of the first and last bursts of the tracks. Defaults to (78, 84).
+        lon_range (tuple, optional): Range of the longitude of the first burst of the tracks. Defaults to (0, 40).
+        lon_sweep (float, optional): Change of longitude along the tracks (deg). Defaults to 0 (along a meridian).
+        filtered_fraction (float, optional): Fraction of the bursts filtered out (PSEP of zeros). Defaults to 0.
+        failed (tuple, optional): Products recorded as failed. Defaults to ().
+        cell_buffers (CellBuffers, optional): Buffers of the grid cells to fill with the bursts. Defaults to None.
+        seed (int, optional): Seed of the random generator. Defaults to 1.
+
+    Returns:
+        str: The path to the PSEP directory.
+    """
+    psep_dir = os.path.join(path, "psep")
+    os.makedirs(psep_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    manifest = ExtractionManifest(psep_dir)
+    with open(os.path.join(psep_dir, csv_name), 'ab') as f:
+        if f.tell() == 0:
+            f.write(b'lat,lon,x,y,product,psep\n')
+        for product in products:
+            lat = np.linspace(*lat_range, nb_bursts) + rng.normal(0, .01)
+            lon = rng.uniform(*lon_range) + np.linspace(0, lon_sweep, nb_bursts)
+            xy = latlon_to_xy(np.column_stack((lat, lon)))
+            psep = 10*np.log10(rng.rayleigh(1, (nb_bursts, 64))**2*0.01 + 0.001) + 50
+            psep[rng.random(nb_bursts) < filtered_fraction] = 0
+            content, nb_rows = format_psep_rows(lat, lon, xy, product, psep)
+            offset = f.tell()
+            f.write(content)
+            if cell_buffers is not None:
+                cell_buffers.add(product, xy, psep)
+            if product in failed:
+                manifest.record(product, 'failed', error="test")
+            else:
+                manifest.record(product, 'done', nb_bursts=nb_rows, output=csv_name, offset=offset, length=len(content),
+                                checksum=checksum(content))
+    return psep_dir
+
+
+@pytest.fixture
+def write_month():
+    """Writer of the synthetic PSEP of a month (cf write_psep_tracks)."""
+    return write_psep_tracks
@@ -0,0 +1,18 @@
+import autotune
+from autotune import rsr_nb_cores
+
+
+def test_rsr_nb_cores_only_lowers(monkeypatch):
+    monkeypatch.setattr(autotune, 'available_cpus', lambda: 32)
+    monkeypatch.setattr(autotune, 'memory_info', lambda: (64e9, 60e9))
+    assert rsr_nb_cores(4) == (4, None)
+    nb_cores, reason = rsr_nb_cores(64)
+    assert nb_cores == 32 and "CPUs" in reason
+
+
+def test_rsr_nb_cores_memory_budget(monkeypatch):
+    monkeypatch.setattr(autotune, 'available_cpus', lambda: 32)
+    monkeypatch.setattr(autotune, 'memory_info', lambda: (64e9, 60e9))
+    # 4 GB budget in block mode, 200 MB for the main process : 15 workers of 250 MB
+    nb_cores, reason = rsr_nb_cores(18, memory_budget=3.8e9)
+    assert nb_cores == 15 and "budget" in reason
@@ -0,0 +1,70 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from apply_rsr import apply_rsr
+from cell_buffers import CellBuffers, fit_cell_buffers, read_products
+from extraction_manifest import ExtractionManifest, checksum
+from spatial_index import latlon_to_xy
+
+
+CSV_NAME = "psep_2017_11_0_12.csv"
+
+
+def write_buffered_month(write_month, path, buffered=True):
+    """12 tracks along the meridians, in the cell buffers if buffered. The extraction of the last product fails."""
+    cell_buffers = CellBuffers(os.path.join(path, "psep"), step_km=25, radius_km=50.) if buffered else None
+    return write_month(path, [f"product_{k}.nc" for k in range(12)], csv_name=CSV_NAME, filtered_fraction=0.2,
+                       failed=["product_11.nc"], cell_buffers=cell_buffers)
+
+
+def powers(results):
+    return np.array([[json.loads(power)['pc'], json.loads(power)['pn']] for power in results['power']])
+
+
+@pytest.mark.parametrize("backfill", [False, True])
+def test_fit_cell_buffers_matches_radius_mode(tmp_path, write_month, backfill):
+    path = str(tmp_path)
+    psep_dir = write_buffered_month(write_month, path, buffered=not backfill)
+    if backfill:
+        assert CellBuffers(psep_dir, step_km=25, radius_km=50.).backfill() == 11
+    fit_cell_buffers(path, nb_cores=1, fit_mode='moments', min_bursts=50, max_bursts=300, run_report=False)
+    cells = pd.read_csv(os.path.join(path, "rsr_results_cells.csv"))
+    assert len(cells) > 0
+
+    # Reference : apply_rsr in 'radius' mode on the products recorded as extracted
+    data = pd.read_csv(os.path.join(psep_dir, CSV_NAME))
+    data = data[data['product'] != "product_11.nc"]
+    powers_2D_array = np.array([np.fromstring(psep.strip('[]'), sep=' ') for psep in data['psep']])
+    latlon_cells = cells[['lat', 'lon']].values
+    apply_rsr(latlon_cells, data[['lat', 'lon']].values, powers_2D_array, path, nb_cores=1, xy_target_array=latlon_to_xy(latlon_cells),
+              xy_array=data[['x', 'y']].values, neighborhood_mode='radius', max_radius_km=50., min_bursts=50, max_bursts=300,
+              fit_mode='moments')
+    reference = pd.read_csv(os.path.join(path, "rsr_results_core_0.csv"))
+
+    assert len(reference) == len(cells)
+    np.testing.assert_allclose(reference[['lat', 'lon']].values, cells[['lat', 'lon']].values)
+    np.testing.assert_allclose(powers(reference), powers(cells), atol=1e-4)
+
+
+def test_fit_cell_buffers_unknown_tile(tmp_path, write_month):
+    write_buffered_month(write_month, str(tmp_path))
+    with pytest.raises(ValueError, match="No cell buffers"):
+        fit_cell_buffers(str(tmp_path), nb_cores=1, tiles=["99_99"], fit_mode='moments', run_report=False)
+
+
+def test_product_without_cells_recorded(tmp_path):
+    psep_dir = str(tmp_path / "psep")
+    os.makedirs(psep_dir)
+    # All the bursts filtered out : no row in the csv file, no burst in the buffers
+    with open(os.path.join(psep_dir, CSV_NAME), 'wb') as f:
+        f.write(b'lat,lon,x,y,product,psep\n')
+    ExtractionManifest(psep_dir).record("filtered.nc", 'done', nb_bursts=0, output=CSV_NAME, offset=len(b'lat,lon,x,y,product,psep\n'),
+                                        length=0, checksum=checksum(b''))
+    buffers = CellBuffers(psep_dir, step_km=25, radius_km=50.)
+    assert buffers.add("filtered.nc", latlon_to_xy(np.full((3, 2), (80., 10.))), np.zeros((3, 64))) == 0
+    assert "filtered.nc" in read_products(buffers.directory)
+    assert CellBuffers(psep_dir, step_km=25, radius_km=50.).backfill() == 0
@@ -0,0 +1,121 @@
+import json
+import os
+
+import numpy as np
+
+from extraction_manifest import ExtractionManifest, checksum, extracted_products
+from spatial_index import latlon_to_xy
+from utils import format_psep_rows
+
+HEADER = b'lat,lon,x,y,product,psep\n'
+
+
+def product_rows(product, nb_bursts=3, seed=0):
+    rng = np.random.default_rng(seed)
+    latlon = np.column_stack((rng.uniform(80, 81, nb_bursts), rng.uniform(0, 10, nb_bursts)))
+    return format_psep_rows(latlon[:, 0], latlon[:, 1], latlon_to_xy(latlon), product, rng.uniform(40, 60, (nb_bursts, 64)))
+
+
+def extract(psep_dir, output, products, recorded=None):
+    """Append the rows of products to an output file, recording the first ones as extract_psep_batch does."""
+    manifest = ExtractionManifest(psep_dir)
+    filename = os.path.join(psep_dir, output)
+    with open(filename, 'ab') as f:
+        if f.tell() == 0:
+            f.write(HEADER)
+        for i, product in enumerate(products):
+            offset = f.tell()
+            content, nb_rows = product_rows(product, seed=i)
+            f.write(content)
+            if recorded is None or i < recorded:
+                manifest.record(product, 'done', nb_bursts=nb_rows, output=output, offset=offset, length=len(content), checksum=checksum(content))
+    return filename
+
+
+def test_interrupted_product_removed(tmp_path):
+    psep_dir = str(tmp_path)
+    # Interrupted after writing the rows of p2.nc, before recording it
+    filename = extract(psep_dir, "psep_2017_11_b.csv", ["p0.nc", "p1.nc", "p2.nc"], recorded=2)
+    expected_size = len(HEADER) + sum(len(product_rows(product, seed=i)[0]) for i, product in enumerate(["p0.nc", "p1.nc"]))
+
+    manifest = ExtractionManifest(psep_dir)
+    assert manifest.validate() == {"p0.nc", "p1.nc"}
+    assert os.path.getsize(filename) == expected_size
+
+    # The next extraction appends after the valid products
+    extract(psep_dir, "psep_2017_11_b.csv", ["p2.nc"])
+    assert ExtractionManifest(psep_dir).validate() == {"p0.nc", "p1.nc", "p2.nc"}
+
+
+def test_truncated_manifest_line(tmp_path):
+    psep_dir = str(tmp_path)
+    extract(psep_dir, "psep_2017_11_b.csv", ["p0.nc", "p1.nc"])
+    # Crash while writing the record of p1.nc
+    with open(os.path.join(psep_dir, "manifest.jsonl"), 'r+') as f:
+        lines = f.readlines()
+        f.seek(0)
+        f.write(lines[0] + lines[1][:20])
+        f.truncate()
+
+    manifest = ExtractionManifest(psep_dir)
+    assert manifest.done_products() == {"p0.nc"}
+    assert manifest.validate() == {"p0.nc"}
+    manifest.record("p1.nc", 'failed', error="test")
+    assert ExtractionManifest(psep_dir).records["p1.nc"]['status'] == 'failed'
+
+
+def test_checksum_mismatch(tmp_path):
+    psep_dir = str(tmp_path)
+    filename = extract(psep_dir, "psep_2017_11_b.csv", ["p0.nc", "p1.nc", "p2.nc"])
+    records = ExtractionManifest(psep_dir).records
+    with open(filename, 'r+b') as f:
+        f.seek(records["p1.nc"]['offset'] + 5)
+        digit = f.read(1)
+        f.seek(records["p1.nc"]['offset'] + 5)
+        f.write(b'1' if digit != b'1' else b'2')
+
+    manifest = ExtractionManifest(psep_dir)
+    # The products from the first invalid one are extracted again
+    assert manifest.validate() == {"p0.nc"}
+    assert manifest.records["p1.nc"]['status'] == 'failed' and manifest.records["p2.nc"]['status'] == 'failed'
+    assert os.path.getsize(filename) == records["p1.nc"]['offset']
+    # The failures are recorded in the manifest
+    assert ExtractionManifest(psep_dir).done_products() == {"p0.nc"}
+
+
+def test_untracked_file_truncated(tmp_path):
+    psep_dir = os.path.join(str(tmp_path), "psep")
+    os.makedirs(psep_dir)
+    extract(psep_dir, "psep_2017_11_0_2.csv", ["p0.nc", "p1.nc"])
+    # Interrupted before its first product was recorded
+    untracked = extract(psep_dir, "psep_2017_11_2_4.csv", ["p2.nc", "p3.nc"], recorded=0)
+
+    assert extracted_products(str(tmp_path), "2017", "11") == {"p0.nc", "p1.nc"}
+    with open(untracked, 'rb') as f:
+        assert f.read() == HEADER
+
+
+def test_legacy_file_complete(tmp_path):
+    path = str(tmp_path)
+    psep_dir = os.path.join(path, "psep")
+    os.makedirs(psep_dir)
+    # File extracted before the product column and the manifest existed
+    legacy = os.path.join(psep_dir, "psep_2017_11_0_2.csv")
+    with open(legacy, 'w') as f:
+        f.write("lat,lon,psep\n80.1,1.0,[50. 51.]\n80.2,2.0,[52. 53.]\n")
+    with open(legacy, 'rb') as f:
+        content = f.read()
+    extract(psep_dir, "psep_2017_11_update.csv", ["p2.nc"])
+    with open(os.path.join(path, "nc_files_to_read.txt"), 'w') as f:
+        f.write("p0.nc\np1.nc\np2.nc\n")
+
+    assert extracted_products(path, "2017", "11") == {"p0.nc", "p1.nc", "p2.nc"}
+    with open(legacy, 'rb') as f:
+        assert f.read() == content
+    with open(os.path.join(psep_dir, "legacy_products.json")) as f:
+        assert json.load(f) == {"psep_2017_11_0_2.csv": ["p0.nc", "p1.nc"]}
+
+    # The refreshed list does not change the products of the legacy file
+    with open(os.path.join(path, "nc_files_to_read.txt"), 'w') as f:
+        f.write("p5.nc\np0.nc\np1.nc\np2.nc\n")
+    assert extracted_products(path, "2017", "11") == {"p0.nc", "p1.nc", "p2.nc"}
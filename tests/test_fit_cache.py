@@ -0,0 +1,109 @@
+import itertools
+
+import numpy as np
+import pytest
+
+import fit_cache
+from apply_rsr import apply_rsr_batch
+from fit_cache import CachedFit, FitCache, compute_psep_fingerprint, fit_key
+from spatial_index import SpatialIndex
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Access times one second apart, so that the LRU order does not depend on the clock resolution."""
+    ticks = itertools.count()
+    monkeypatch.setattr(fit_cache.time, 'time', lambda: float(next(ticks)))
+
+
+def cached_fit(pc):
+    return CachedFit(values={'a': pc, 's': 1., 'mu': 2., 'pt': 3., 'ID': -1}, power={'pc': pc, 'pn': -10.}, crl=0.95, flag=1)
+
+
+def test_put_and_get(tmp_path):
+    filename = str(tmp_path / "fit_cache.sqlite")
+    cache = FitCache(filename)
+    cache.put_many(['a', 'b'], [cached_fit(1.), cached_fit(2.)])
+    cache.close()
+
+    # Read by another process, e.g. the next run
+    cache = FitCache(filename)
+    fits = cache.get_many(['b', 'c', 'a'])
+    assert fits[1] is None
+    assert fits[0].power() == {'pc': 2., 'pn': -10.} and fits[2].values['a'] == 1.
+    assert fits[0].crl() == 0.95 and fits[0].flag() == 1
+    cache.close()
+
+
+def test_lru_eviction(tmp_path, clock):
+    cache = FitCache(str(tmp_path / "fit_cache.sqlite"), max_entries=3)
+    cache.put_many(['a', 'b', 'c'], [cached_fit(1.), cached_fit(2.), cached_fit(3.)])
+    # 'a' is read again : 'b' is now the least recently used
+    cache.get_many(['a'])
+    cache.put_many(['d'], [cached_fit(4.)])
+    assert [f is not None for f in cache.get_many(['a', 'b', 'c', 'd'])] == [True, False, True, True]
+
+    # 'a', 'c' and 'd' were read together, then 'd' again : 'a' and 'c' are evicted
+    cache.get_many(['d'])
+    cache.put_many(['e', 'f'], [cached_fit(5.), cached_fit(6.)])
+    assert [f is not None for f in cache.get_many(['a', 'b', 'c', 'd', 'e', 'f'])] == [False, False, False, True, True, True]
+    cache.close()
+
+
+def test_fit_key():
+    indices = [5, 1, 3]
+    key = fit_key(indices, 'fingerprint', 'least_squares')
+    # The order of the bursts does not matter
+    assert fit_key([3, 5, 1], 'fingerprint', 'least_squares') == key
+
+    assert fit_key(indices, 'other fingerprint', 'least_squares') != key
+    assert fit_key([5, 1, 4], 'fingerprint', 'least_squares') != key
+    assert fit_key(indices, 'fingerprint', 'leastsq') != key
+    assert fit_key(indices, 'fingerprint', 'least_squares', fit_mode='moments') != key
+
+    # crl_min only changes the fits of the 'tiered' mode
+    assert fit_key(indices, 'fingerprint', 'least_squares', crl_min=0.5) == key
+    tiered = fit_key(indices, 'fingerprint', 'least_squares', fit_mode='tiered', crl_min=0.9)
+    assert fit_key(indices, 'fingerprint', 'least_squares', fit_mode='tiered', crl_min=0.5) != tiered
+
+
+def test_fit_key_p0():
+    indices = [5, 1, 3]
+    key = fit_key(indices, 'fingerprint', 'least_squares')
+    warm = fit_key(indices, 'fingerprint', 'least_squares', p0=np.array([0.1, 0.05, 5.]))
+    assert warm != key
+    assert fit_key(indices, 'fingerprint', 'least_squares', p0=np.array([0.1, 0.05, 6.])) != warm
+    # p0 not usable by fit_hk : cold fit
+    assert fit_key(indices, 'fingerprint', 'least_squares', p0=np.array([np.nan, np.nan, np.nan])) == key
+    assert fit_key(indices, 'fingerprint', 'least_squares', p0=np.array([0., 0.05, 5.])) == key
+    # The method-of-moments estimation has no initial values
+    moments = fit_key(indices, 'fingerprint', 'least_squares', fit_mode='moments')
+    assert fit_key(indices, 'fingerprint', 'least_squares', fit_mode='moments', p0=np.array([0.1, 0.05, 5.])) == moments
+
+
+def test_batch_hits_and_invalidation(tmp_path):
+    rng = np.random.default_rng(0)
+    xy_array = rng.uniform(0, 100000, (2000, 2))
+    powers_2D_array = rng.rayleigh(0.1, (2000, 64))
+    xy_targets = rng.uniform(20000, 80000, (20, 2))
+    latlon_targets = np.zeros((20, 2))
+    psep_index = SpatialIndex(xy_array)
+    cache = FitCache(str(tmp_path / "fit_cache.sqlite"))
+
+    def run(powers, nb_closest=50):
+        fingerprint = compute_psep_fingerprint(np.zeros((2000, 2)), powers)
+        return apply_rsr_batch(latlon_targets, xy_targets, psep_index, powers, 0, 0, 20, nb_closest=nb_closest, fit_mode='moments',
+                               fit_cache=cache, psep_fingerprint=fingerprint)
+
+    first = run(powers_2D_array)
+    assert all(info['method'] == 'moments' for _, _, _, info in first)
+    second = run(powers_2D_array)
+    assert all(info['method'] == 'cache' for _, _, _, info in second)
+    for (_, f, _, _), (_, cached, _, _) in zip(first, second):
+        assert cached.power() == pytest.approx(f.power())
+        assert cached.flag() == f.flag()
+
+    # New PSEP values or other neighborhoods : fitted again
+    assert all(info['method'] == 'moments' for _, _, _, info in run(powers_2D_array * 2))
+    assert all(info['method'] == 'moments' for _, _, _, info in run(powers_2D_array, nb_closest=60))
+    cache.close()
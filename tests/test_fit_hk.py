@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+from apply_rsr import fit_hk
+
+
+@pytest.fixture
+def amplitudes():
+    rng = np.random.default_rng(0)
+    return np.abs(0.2 + 0.1*(rng.normal(size=2000) + 1j*rng.normal(size=2000)))
+
+
+@pytest.mark.parametrize("min_method", ['least_squares', 'leastsq', 'nelder', 'lbfgsb', 'powell'])
+def test_fit_hk_budget_spent(amplitudes, min_method):
+    f, telemetry = fit_hk(amplitudes, min_method, budget_s=1e-6)
+    assert not f.success
+    assert f.flag() == 0
+    assert telemetry['timed_out']
+    assert telemetry['nfev'] >= 0
+    assert np.isfinite([f.values['a'], f.values['s'], f.values['mu']]).all()
+
+
+def test_fit_hk_without_budget(amplitudes):
+    f, telemetry = fit_hk(amplitudes, 'least_squares')
+    assert f.success
+    assert not telemetry['timed_out']
@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from apply_rsr import apply_rsr_batch
+from hk_moments import bootstrap_hk_moments, fit_hk_moments, hk_moments
+
+
+def hk_samples(rng, a, s, mu, size):
+    """HK amplitudes : Rice amplitudes of coherent amplitude a, whose diffuse power 2*s**2*w is Gamma distributed (w ~ Gamma(mu))."""
+    sigma = s * np.sqrt(rng.gamma(mu, 1, size))
+    return np.abs(a + sigma * (rng.normal(size=size) + 1j * rng.normal(size=size)))
+
+
+@pytest.mark.parametrize("a, s, mu", [(1., 0.3, 2.), (0.5, 0.2, 5.), (1., 0.5, 1.)])
+def test_moments_recover_hk_parameters(a, s, mu):
+    rng = np.random.default_rng(0)
+    samples = hk_samples(rng, a, s, mu, 200000)[None, :]
+    a_fit, s_fit, mu_fit, stable = hk_moments(samples)
+    assert stable[0]
+    np.testing.assert_allclose([a_fit[0], s_fit[0], mu_fit[0]], [a, s, mu], rtol=0.1)
+
+    f = fit_hk_moments(samples)[0]
+    assert f.flag() == 1 and f.crl() > 0.99
+    assert abs(f.power()['pc'] - 10*np.log10(a**2)) < 0.25
+    assert abs(f.power()['pn'] - 10*np.log10(2*s**2*mu)) < 0.25
+
+
+def test_moments_without_solution_are_unstable():
+    rng = np.random.default_rng(0)
+    bimodal = np.concatenate([rng.normal(1, 0.02, 2000), rng.normal(2, 0.02, 2000)])
+    samples = np.stack([np.full(4000, 2.), np.full(4000, np.nan), bimodal])
+    with pytest.warns(RuntimeWarning):
+        _, _, _, stable = hk_moments(samples)
+    assert not stable.any()
+    fits = fit_hk_moments(samples[[0, 2]])
+    assert all(not f.success and f.flag() == 0 for f in fits)
+
+
+def test_non_positive_amplitudes_are_left_out():
+    rng = np.random.default_rng(1)
+    samples = hk_samples(rng, 1., 0.3, 2., 5000)
+    padded = np.concatenate([samples, np.zeros(500), -samples[:500]])
+    f, f_padded = fit_hk_moments(np.stack([np.pad(samples, (0, 1000), constant_values=np.nan), padded]))
+    assert f.power() == f_padded.power()
+
+
+def test_bootstrap_standard_errors():
+    rng = np.random.default_rng(2)
+    samples = np.stack([hk_samples(rng, 1., 0.3, 2., 1000), hk_samples(rng, 1., 0.3, 2., 1000)])
+    errors = bootstrap_hk_moments(samples, nb_resamples=50, rng=np.random.default_rng(0))
+    assert errors['nb_resamples'] == 50
+    assert np.all((errors['pc'] > 0) & (errors['pc'] < 0.5))
+    assert np.all(errors['stable_fraction'] > 0.9)
+
+
+def test_bootstrap_seeded_by_target():
+    rng = np.random.default_rng(3)
+    powers_2D_array = hk_samples(rng, 1., 0.3, 2., 30*64).reshape(30, 64)
+    latlon_targets = np.array([[80., 10.], [81., -20.], [82., 150.]])
+    neighborhoods = [np.arange(0, 10), np.arange(10, 20), np.arange(20, 30)]
+
+    def uncertainties(targets, core_id, index):
+        results = apply_rsr_batch(latlon_targets[targets], np.zeros((len(targets), 2)), None, powers_2D_array, core_id, index, 3,
+                                  fit_mode='moments', bootstrap_resamples=20, neighborhoods=[neighborhoods[t] for t in targets])
+        return [uncertainty for _, _, uncertainty, _ in results]
+
+    # Same resamples whatever the split of the targets among the cores and batches (up to the rounding of the vectorized sums)
+    together = uncertainties([0, 1, 2], 0, 0)
+    for uncertainty, expected in zip(uncertainties([0], 0, 0) + uncertainties([1, 2], 1, 0) + uncertainties([2], 1, 3), together + together[2:]):
+        assert uncertainty == pytest.approx(expected, rel=1e-12)
+    assert together[0]['pc'] != together[1]['pc']
+
+
+def test_tiered_mode_falls_back_to_lmfit():
+    rng = np.random.default_rng(0)
+    good = hk_samples(rng, 1., 0.3, 2., 50*64).reshape(50, 64)
+    # Uniform amplitudes, without moment solution
+    uniform = rng.uniform(1, 2, (50, 64))
+    powers_2D_array = np.vstack([good, uniform])
+    neighborhoods = [np.arange(50), np.arange(50, 100)]
+
+    def methods(crl_min):
+        results = apply_rsr_batch(np.zeros((2, 2)), np.zeros((2, 2)), None, powers_2D_array, 0, 0, 2, fit_mode='tiered',
+                                  crl_min=crl_min, neighborhoods=neighborhoods)
+        return [fit_info['method'] for _, _, _, fit_info in results]
+
+    # The unstable moments are always fitted again, the stable ones when their crl is below crl_min
+    assert methods(0.9) == ['moments', 'least_squares']
+    assert methods(0.999) == ['least_squares', 'least_squares']
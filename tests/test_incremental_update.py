@@ -0,0 +1,42 @@
+import glob
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from apply_rsr import apply_rsr_arctic
+from incremental_update import apply_rsr_update
+from run_stats import report, reset
+
+
+def read_results(path):
+    results = pd.concat([pd.read_csv(f) for f in glob.glob(os.path.join(path, "rsr_results_*.csv"))])
+    results = results.sort_values(['lat', 'lon'], ignore_index=True)
+    powers = np.array([[json.loads(power)['pc'], json.loads(power)['pn']] for power in results['power']])
+    return results[['lat', 'lon']].values, powers
+
+
+@pytest.mark.parametrize("neighborhood", [dict(nb_closest=50), dict(neighborhood_mode='radius', max_radius_km=50., min_bursts=20, max_bursts=40)])
+def test_update_matches_full_run(tmp_path, write_month, neighborhood):
+    path = str(tmp_path)
+    tracks = dict(nb_bursts=500, lat_range=(76., 86.), lon_range=(-180., 180.), lon_sweep=30.)
+    options = dict(nb_cores=1, step_km=50, fit_mode='moments', run_report=False, **neighborhood)
+
+    write_month(path, [f"product_{k}.nc" for k in range(8)], seed=4, **tracks)
+    apply_rsr_arctic(path, use_psep_store=True, **options)
+
+    new_products = ["product_8.nc", "product_9.nc"]
+    write_month(path, new_products, csv_name="psep_2017_11_update.csv", seed=5, **tracks)
+    reset('test_update')
+    apply_rsr_update(path, new_products, **options)
+    # Only the bursts around the affected targets are read
+    assert 0 < report()['stages']['read_neighbors']['bursts'] < 10 * 500
+    latlon_update, powers_update = read_results(path)
+
+    apply_rsr_arctic(path, use_psep_store=True, **options)
+    latlon_full, powers_full = read_results(path)
+
+    np.testing.assert_allclose(latlon_update, latlon_full)
+    np.testing.assert_allclose(powers_update, powers_full)
@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+
+from psep_kernels import NUMBA_AVAILABLE, leading_edges, power_waveforms, psep_echoes, windowed_argmax
+
+WINDOW_FRAC_LEADING_EDGE = [0.03, 0.06, 0.09]
+
+numba_only = pytest.mark.skipif(not NUMBA_AVAILABLE, reason="Numba is not installed")
+
+
+# Per-echo PSEP extraction of the original extract_psep.py, kept as the reference of the kernels
+
+def baseline_leading_edge(waveform, window_frac_leading_edge=WINDOW_FRAC_LEADING_EDGE):
+    window_sizes = [int(wf * len(waveform)) for wf in window_frac_leading_edge]
+
+    slopes = []
+    for i in range(len(waveform) - max(window_sizes)):
+        slope = []
+        for window_size in window_sizes:
+            segment = waveform[i:i+window_size]
+            slope.append(np.mean(np.gradient(segment)))
+        slopes.append(slope)
+
+    mean_slopes = np.mean(slopes, axis=1)
+    return np.argmax(mean_slopes)
+
+
+def baseline_psep_echo(complex_echo, gain, window_frac_psep=0.05):
+    waveform = np.fft.fft(complex_echo)
+    waveform = np.fft.fftshift(waveform)
+    waveform = (np.abs(waveform)**2)/len(complex_echo)
+
+    leading_edge_index = baseline_leading_edge(waveform)
+
+    window_size = int(window_frac_psep * len(waveform))
+    psep_index = np.argmax(waveform[leading_edge_index:leading_edge_index+window_size]) + leading_edge_index
+    psep_count = waveform[psep_index]
+
+    return 10 * np.log10(psep_count) + gain
+
+
+def random_echoes(nb_echoes=200, nb_samples=128, seed=0):
+    rng = np.random.default_rng(seed)
+    complex_echoes = rng.standard_normal((nb_echoes, nb_samples)) + 1j * rng.standard_normal((nb_echoes, nb_samples))
+    complex_echoes[:, nb_samples//2:] *= 10     # Add a leading edge
+    return complex_echoes, rng.uniform(-50, 50)
+
+
+def window_sizes(nb_samples):
+    return [int(wf * nb_samples) for wf in WINDOW_FRAC_LEADING_EDGE]
+
+
+@pytest.mark.parametrize("use_numba", [False, True])
+def test_kernels_match_baseline(use_numba):
+    complex_echoes, gain = random_echoes()
+    psep = psep_echoes(complex_echoes, gain, use_numba=use_numba)
+    expected = np.array([baseline_psep_echo(echo, gain) for echo in complex_echoes])
+    np.testing.assert_allclose(psep, expected, rtol=0, atol=1e-9)
+
+    waveforms = power_waveforms(complex_echoes, use_numba=use_numba)
+    expected = np.array([baseline_leading_edge(waveform) for waveform in waveforms])
+    np.testing.assert_array_equal(leading_edges(waveforms, window_sizes(waveforms.shape[1]), use_numba=use_numba), expected)
+
+
+@numba_only
+def test_numba_identical_to_numpy():
+    complex_echoes, gain = random_echoes(nb_echoes=1000)
+    np.testing.assert_array_equal(power_waveforms(complex_echoes, use_numba=True), power_waveforms(complex_echoes, use_numba=False))
+    np.testing.assert_array_equal(psep_echoes(complex_echoes, gain, use_numba=True), psep_echoes(complex_echoes, gain, use_numba=False))
+
+
+@pytest.mark.parametrize("use_numba", [False, pytest.param(True, marks=numba_only)])
+def test_leading_edges_ties(use_numba):
+    # Small integer powers : the slopes are exact, with many ties, resolved to the first position as np.argmax
+    rng = np.random.default_rng(1)
+    waveforms = rng.integers(0, 3, size=(200, 128)).astype(np.float64)
+    waveforms[0] = 1    # All the slopes are equal
+    expected = np.array([baseline_leading_edge(waveform) for waveform in waveforms])
+    np.testing.assert_array_equal(leading_edges(waveforms, window_sizes(128), use_numba=use_numba), expected)
+    assert expected[0] == 0
+
+
+@pytest.mark.parametrize("use_numba", [False, pytest.param(True, marks=numba_only)])
+def test_leading_edges_nan(use_numba):
+    rng = np.random.default_rng(2)
+    waveforms = rng.uniform(0, 1, size=(200, 128))
+    waveforms[0] = np.nan   # NaN in the complex echo : NaN everywhere after the FFT
+    positions = rng.integers(0, 128, size=199)
+    waveforms[np.arange(1, 200), positions] = np.nan
+    sizes = np.array(window_sizes(128))
+
+    # Same as np.argmax : the first NaN slope is the maximum
+    nb_positions = 128 - sizes.max()
+    i = np.arange(nb_positions)
+    mean_slopes = np.mean([(0.5*waveforms[:, i + 1] - 1.5*waveforms[:, i] + 1.5*waveforms[:, i + ws - 1] - 0.5*waveforms[:, i + ws - 2]) / ws
+                           for ws in sizes], axis=0)
+    expected = np.argmax(mean_slopes, axis=1)
+    np.testing.assert_array_equal(leading_edges(waveforms, sizes, use_numba=use_numba), expected)
+    assert leading_edges(waveforms[:1], sizes, use_numba=use_numba)[0] == baseline_leading_edge(waveforms[0]) == 0
+
+
+@pytest.mark.parametrize("use_numba", [False, pytest.param(True, marks=numba_only)])
+def test_windowed_argmax_ties_and_nan(use_numba):
+    rng = np.random.default_rng(3)
+    waveforms = rng.integers(0, 3, size=(300, 128)).astype(np.float64)
+    waveforms[100:200, :][rng.uniform(size=(100, 128)) < 0.05] = np.nan
+    waveforms[200] = np.nan
+    starts = rng.integers(0, 128, size=300)
+    starts[-10:] = 125    # Windows clipped at the end of the waveform
+    window_size = 6
+
+    expected = np.array([start + np.argmax(waveform[start:start + window_size]) for waveform, start in zip(waveforms, starts)])
+    np.testing.assert_array_equal(windowed_argmax(waveforms, starts, window_size, use_numba=use_numba), expected)
@@ -0,0 +1,80 @@
+import os
+
+import numpy as np
+
+from psep_store import STORE_NAME, consolidate_psep, load_psep_store, morton_keys, store_up_to_date
+from spatial_index import latlon_to_xy
+from utils import format_psep_rows, read_psep_from_csv
+
+
+def write_psep(psep_dir, nb_files=3, nb_bursts=200, seed=0):
+    """PSEP csv files of random bursts over the Arctic, two products per file."""
+    os.makedirs(psep_dir)
+    rng = np.random.default_rng(seed)
+    for i in range(nb_files):
+        with open(os.path.join(psep_dir, f"psep_2017_11_{i}.csv"), 'wb') as f:
+            f.write(b'lat,lon,x,y,product,psep\n')
+            for k in range(2):
+                latlon = np.column_stack((rng.uniform(72, 89, nb_bursts), rng.uniform(-180, 180, nb_bursts)))
+                psep = rng.uniform(40, 60, (nb_bursts, 64))
+                f.write(format_psep_rows(latlon[:, 0], latlon[:, 1], latlon_to_xy(latlon), f"product_{i}_{k}.nc", psep)[0])
+
+
+def read_store(psep_dir):
+    return {name: np.load(os.path.join(psep_dir, STORE_NAME, name + ".npy"))
+            for name in ('latlon', 'xy', 'powers', 'products', 'order')}
+
+
+def test_store_round_trip(tmp_path):
+    psep_dir = str(tmp_path / "psep")
+    write_psep(psep_dir)
+    latlon_csv, powers_csv, xy_csv, products_csv = read_psep_from_csv(psep_dir, return_xy=True, return_products=True)
+
+    consolidate_psep(psep_dir)
+    store = read_store(psep_dir)
+    order = store['order']
+
+    # Sorted by Morton key
+    assert np.all(np.diff(morton_keys(store['xy']).astype(np.float64)) >= 0)
+    # order maps the rows of the store to the rows of the csv files
+    np.testing.assert_array_equal(np.sort(order), np.arange(len(latlon_csv)))
+    np.testing.assert_array_equal(store['latlon'], latlon_csv[order])
+    np.testing.assert_array_equal(store['xy'], xy_csv[order])
+    np.testing.assert_array_equal(store['products'], products_csv[order])
+    np.testing.assert_array_equal(store['powers'], powers_csv[order].astype(np.float32))
+    # And back to the csv order
+    restored = np.empty_like(store['latlon'])
+    restored[order] = store['latlon']
+    np.testing.assert_array_equal(restored, latlon_csv)
+
+    latlon_array, powers_2D_array, xy_array, row_order = load_psep_store(psep_dir)
+    assert isinstance(powers_2D_array, np.memmap)
+    np.testing.assert_array_equal(row_order, order)
+    np.testing.assert_array_equal(np.asarray(powers_2D_array), store['powers'])
+
+
+def test_chunked_consolidation(tmp_path):
+    psep_dir = str(tmp_path / "psep")
+    write_psep(psep_dir)
+    consolidate_psep(psep_dir)
+    in_memory = read_store(psep_dir)
+
+    # Chunks smaller than a csv file, and not dividing the number of bursts
+    consolidate_psep(psep_dir, chunk_bursts=170)
+    chunked = read_store(psep_dir)
+    assert not os.path.exists(os.path.join(psep_dir, STORE_NAME, "unsorted"))
+    for name in in_memory:
+        np.testing.assert_array_equal(chunked[name], in_memory[name])
+        assert chunked[name].dtype == in_memory[name].dtype
+
+
+def test_store_up_to_date(tmp_path):
+    psep_dir = str(tmp_path / "psep")
+    write_psep(psep_dir, nb_files=1)
+    assert not store_up_to_date(psep_dir)
+    consolidate_psep(psep_dir)
+    assert store_up_to_date(psep_dir)
+
+    with open(os.path.join(psep_dir, "psep_2017_11_0.csv"), 'ab') as f:
+        f.write(b'80.0,0.0,0.0,-1100000.0,product_0_2.nc,[50. 51.]\n')
+    assert not store_up_to_date(psep_dir)
@@ -0,0 +1,64 @@
+import glob
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from apply_rsr import apply_rsr_arctic
+from run_stats import report
+
+
+def write_tracks(write_month, path):
+    """2 csv files of 6 tracks crossing the pole region."""
+    for i in range(2):
+        write_month(path, [f"product_{i}_{k}.nc" for k in range(6)], csv_name=f"psep_2017_11_{i}.csv", nb_bursts=500,
+                    lat_range=(74., 88.), lon_range=(-180., 180.), lon_sweep=30., seed=2 + i)
+
+
+def read_results(path):
+    results = pd.concat([pd.read_csv(f) for f in glob.glob(os.path.join(path, "rsr_results_*.csv"))])
+    results = results.sort_values(['lat', 'lon'], ignore_index=True)
+    powers = np.array([[json.loads(power)['pc'], json.loads(power)['pn']] for power in results['power']])
+    return results[['lat', 'lon']].values, powers
+
+
+def test_blocks_match_psep_store(tmp_path, write_month):
+    path = str(tmp_path)
+    write_tracks(write_month, path)
+    options = dict(nb_cores=1, step_km=50, nb_closest=50, fit_mode='moments', run_report=False)
+
+    apply_rsr_arctic(path, use_psep_store=True, **options)
+    latlon_store, powers_store = read_results(path)
+
+    # Budget of a few thousand bursts per block, the results of the previous run being replaced
+    apply_rsr_arctic(path, max_memory=0.4515, halo_km=150, **options)
+    assert not os.path.exists(os.path.join(path, "rsr_results_core_0.csv"))
+    assert len(glob.glob(os.path.join(path, "rsr_results_block_*_core_0.csv"))) > 1
+    assert report()['summaries']['rsr_blocks']['nb_targets_beyond_halo'] == 0
+    latlon_blocks, powers_blocks = read_results(path)
+
+    assert len(latlon_store) > 0
+    np.testing.assert_allclose(latlon_blocks, latlon_store)
+    np.testing.assert_allclose(powers_blocks, powers_store)
+
+    # And the other way around
+    apply_rsr_arctic(path, use_psep_store=True, **options)
+    assert not glob.glob(os.path.join(path, "rsr_results_block_*.csv"))
+
+
+def test_blocks_halo_checks(tmp_path, write_month):
+    path = str(tmp_path)
+    write_tracks(write_month, path)
+    options = dict(nb_cores=1, step_km=50, fit_mode='moments', run_report=False, max_memory=0.4515)
+
+    with pytest.raises(ValueError, match="max_radius_km"):
+        apply_rsr_arctic(path, halo_km=20, neighborhood_mode='radius', max_radius_km=50., **options)
+
+    # The 50 closest bursts of a track span about 75 km on each side of a target
+    with pytest.warns(UserWarning, match="beyond the halo"):
+        apply_rsr_arctic(path, halo_km=10, nb_closest=50, **options)
+    summary = report()['summaries']['rsr_blocks']
+    assert summary['nb_targets_beyond_halo'] > 0
+    assert summary['nb_targets_beyond_halo'] == sum(block['nb_targets_beyond_halo'] for block in summary['blocks'])
@@ -0,0 +1,45 @@
+import numpy as np
+
+from rsr_pyramid import cells_to_refine
+
+
+def block(i_min, i_max, j_min, j_max, pc=-20., pn=-30.):
+    """Cells of a block of the grid with the same pc and pn, and their crl and flag."""
+    ij = np.array([(i, j) for i in range(i_min, i_max) for j in range(j_min, j_max)], dtype=np.int64)
+    power = np.tile([pc, pn], (len(ij), 1))
+    return ij, power, np.ones(len(ij)), np.ones(len(ij), dtype=np.int64)
+
+
+def test_level_0_edges_and_differences():
+    ij, power, crl, flag = block(10, 18, 10, 18)
+    power[ij[:, 0] * 100 + ij[:, 1] == 1414] += 5
+    refine = cells_to_refine(ij, power, crl, flag)
+    on_edge = (ij.min(axis=1) == 10) | (ij.max(axis=1) == 17)
+    around_anomaly = np.abs(ij - 14).max(axis=1) <= 1
+    np.testing.assert_array_equal(refine, on_edge | around_anomaly)
+    np.testing.assert_array_equal(cells_to_refine(ij, power, crl, flag, refine_edges=False), around_anomaly)
+
+
+def test_uniform_children_are_not_refined():
+    level_0 = block(10, 18, 10, 18)
+    # Children of the 3x3 refined cells around the anomaly, all with the value of the field
+    children = block(26, 32, 26, 32)
+    assert not cells_to_refine(*children, coarser_levels=[level_0]).any()
+    # Without the coarser levels, the neighbors of the border of the children are missing
+    assert cells_to_refine(*children).sum() == 20
+
+
+def test_children_at_the_ice_edge_are_refined():
+    level_0 = block(10, 18, 10, 18)
+    children = block(20, 24, 26, 32)
+    refine = cells_to_refine(*children, coarser_levels=[level_0])
+    np.testing.assert_array_equal(refine, children[0][:, 0] == 20)
+
+
+def test_children_next_to_a_different_coarse_cell():
+    ij, power, crl, flag = block(10, 18, 10, 18)
+    power[ij[:, 0] * 100 + ij[:, 1] == 1216] += 5
+    children = block(26, 32, 26, 32)
+    refine = cells_to_refine(*children, coarser_levels=[(ij, power, crl, flag)])
+    # Children whose neighbors are in the coarse cell (12, 16), i.e. the fine cells (24..25, 32..33)
+    np.testing.assert_array_equal(refine, (children[0][:, 0] <= 26) & (children[0][:, 1] == 31))
@@ -0,0 +1,39 @@
+import csv
+import json
+import os
+
+import numpy as np
+
+from rsr_query import RSRQuery
+from spatial_index import xy_to_latlon
+
+
+def write_results(filename, xy_cells, pc, mtime):
+    latlon_cells = xy_to_latlon(xy_cells)
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['lat', 'lon', 'value', 'power', 'crl', 'flag', 'fit_info'])
+        for lat, lon in latlon_cells:
+            writer.writerow([lat, lon, json.dumps({}), json.dumps({'pt': pc + 1, 'pc': pc, 'pn': -30., 'pc-pn': pc + 30}), 0.9, 1, '{}'])
+    os.utime(filename, (mtime, mtime))
+
+
+def test_point_beyond_a_tile(tmp_path):
+    write_results(os.path.join(tmp_path, "rsr_results_core_0.csv"), np.array([[0., -1000000.]]), -20., 1e9)
+    query = RSRQuery({"2017-11": str(tmp_path)}, tile_km=50)
+    # Target 180 km away from the only cell, several tiles of 50 km in between
+    lat, lon = xy_to_latlon(np.array([[0., -1180000.]]))[0]
+    assert query.point(lat, lon, max_distance_km=100)["2017-11"] is None
+    result = query.point(lat, lon, max_distance_km=200)["2017-11"]
+    assert result is not None
+    np.testing.assert_allclose(result['distance_km'], 180, rtol=1e-6)
+
+
+def test_most_recent_file_wins(tmp_path):
+    xy_cells = np.array([[0., -1000000.], [10000., -1000000.]])
+    # Older results whose name sorts last, and newer results of the same cells
+    write_results(os.path.join(tmp_path, "rsr_results_update_20171201_core_0.csv"), xy_cells, -20., 1e9)
+    write_results(os.path.join(tmp_path, "rsr_results_core_0.csv"), xy_cells, -10., 2e9)
+    query = RSRQuery({"2017-11": str(tmp_path)})
+    lat, lon = xy_to_latlon(xy_cells[:1])[0]
+    assert query.point(lat, lon)["2017-11"]['pc'] == -10.
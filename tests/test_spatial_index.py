@@ -0,0 +1,84 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+from spatial_index import SpatialIndex, find_neighborhoods, latlon_to_xy
+
+
+def latlon_to_cartesian(lat, lon, radius=6371):
+    """3D coordinates of the original KD-tree of the bursts (km)."""
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    return np.stack((radius*np.cos(lat)*np.cos(lon), radius*np.cos(lat)*np.sin(lon), radius*np.sin(lat)), axis=-1)
+
+
+def baseline_neighbors(latlon_array, latlon_targets, k):
+    """Rows of the k closest bursts with the original KD-tree (3D chord distance), and their distances.
+
+    The original tree left out the non-finite points and mapped the points back through a dictionary
+    of their coordinates : the rows are mapped here to the rows of latlon_array.
+    """
+    points = latlon_to_cartesian(latlon_array[:, 0], latlon_array[:, 1])
+    finite = np.isfinite(points).all(axis=1)
+    tree = cKDTree(points[finite])
+    dictionary = {tuple(point): i for i, point in enumerate(tree.data)}
+    distances, indices = tree.query(latlon_to_cartesian(latlon_targets[:, 0], latlon_targets[:, 1]), k=k)
+    rows = np.array([[dictionary[tuple(point)] for point in tree.data[row]] for row in indices])
+    return np.flatnonzero(finite)[rows], distances
+
+
+def test_knn_matches_kdtree():
+    rng = np.random.default_rng(0)
+    latlon_array = np.column_stack((rng.uniform(80, 81, 5000), rng.uniform(0, 10, 5000)))
+    latlon_array[rng.choice(5000, 50, replace=False)] = np.nan    # Bursts without coordinates
+    latlon_targets = np.column_stack((rng.uniform(80.2, 80.8, 300), rng.uniform(1, 9, 300)))
+    nb_closest = 50
+
+    expected, distances = baseline_neighbors(latlon_array, latlon_targets, nb_closest)
+    neighborhoods = find_neighborhoods(SpatialIndex(latlon_to_xy(latlon_array)), latlon_to_xy(latlon_targets), nb_closest=nb_closest)
+
+    points = latlon_to_cartesian(latlon_array[:, 0], latlon_array[:, 1])
+    targets = latlon_to_cartesian(latlon_targets[:, 0], latlon_targets[:, 1])
+    nb_identical = 0
+    for target, rows, expected_rows, kth_distance in zip(targets, neighborhoods, expected, distances[:, -1]):
+        assert len(rows) == nb_closest
+        assert np.all(np.isfinite(latlon_array[rows]))
+        different = np.setxor1d(rows, expected_rows)
+        nb_identical += len(different) == 0
+        # The planar distances only swap the bursts at the edge of the neighborhood (scale factor of EPSG:3413)
+        np.testing.assert_allclose(np.linalg.norm(points[different] - target, axis=1), kth_distance, rtol=1e-3)
+    assert nb_identical >= 0.95 * len(targets)
+
+
+def test_radius_min_and_max_bursts():
+    # A track crossing the target, one burst every 300 m
+    xy_array = np.column_stack((np.arange(-300, 301) * 300., np.zeros(601)))
+    psep_index = SpatialIndex(xy_array)
+    xy_targets = np.array([[0., 0.], [0., 20000.]])
+    within = np.flatnonzero(np.abs(xy_array[:, 0]) <= 10000)   # 67 bursts within 10 km of the first target
+
+    neighborhoods = find_neighborhoods(psep_index, xy_targets, neighborhood_mode='radius', max_radius_km=10., min_bursts=10, max_bursts=100)
+    np.testing.assert_array_equal(neighborhoods[0], within)
+    # No burst within 10 km : skipped
+    assert len(neighborhoods[1]) == 0
+
+    # Fewer than min_bursts : skipped
+    neighborhoods = find_neighborhoods(psep_index, xy_targets[:1], neighborhood_mode='radius', max_radius_km=10., min_bursts=68, max_bursts=100)
+    assert len(neighborhoods[0]) == 0
+
+    # More than max_bursts : evenly spaced along the track, both ends included
+    neighborhoods = find_neighborhoods(psep_index, xy_targets[:1], neighborhood_mode='radius', max_radius_km=10., min_bursts=10, max_bursts=23)
+    np.testing.assert_array_equal(neighborhoods[0], within[::3])
+
+
+def test_radius_subsampling_in_original_order():
+    # Two tracks, reordered as in the spatially sorted store : order[i] is the original row of row i
+    rng = np.random.default_rng(1)
+    xy_tracks = np.concatenate([np.column_stack((np.arange(-100, 101) * 300., np.zeros(201))),
+                                np.column_stack((np.zeros(201), np.arange(-100, 101) * 300. + 150))])
+    order = rng.permutation(len(xy_tracks))
+    options = dict(neighborhood_mode='radius', max_radius_km=20., min_bursts=10, max_bursts=50)
+
+    expected = find_neighborhoods(SpatialIndex(xy_tracks), np.zeros((1, 2)), **options)[0]
+    neighborhood = find_neighborhoods(SpatialIndex(xy_tracks[order]), np.zeros((1, 2)), row_order=order, **options)[0]
+    assert len(expected) == 50
+    np.testing.assert_array_equal(np.sort(order[neighborhood]), expected)
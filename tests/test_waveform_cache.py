@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+import download_ftp
+from extract_psep import extract_psep_batch
+from lead_filter import create_lead_KDtree
+from psep_kernels import psep_from_waveforms
+from psep_worker import WorkerPool
+from utils import read_psep_from_csv
+from waveform_cache import load_waveforms, sweep_psep, waveform_cache_path
+
+PRODUCTS = ["p0.nc", "p1.nc"]
+GAIN_VARIABLES = ['tot_gain_ch1_85_ku', 'agc_1_85_ku', 'agc_2_85_ku', 'instr_cor_gain_tx_rx_85_ku']
+
+
+def write_products(nc_dir, nb_bursts=20, nb_samples=128, seed=0):
+    """Small synthetic products, with the variables read by the extraction."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(nc_dir)
+    for product in PRODUCTS:
+        with Dataset(os.path.join(nc_dir, product), 'w') as nc:
+            nc.createDimension('burst', nb_bursts)
+            nc.createDimension('echo', 64)
+            nc.createDimension('sample', nb_samples)
+            nc.createVariable('lat_85_ku', 'f8', ('burst',))[:] = rng.uniform(80, 81, nb_bursts)
+            nc.createVariable('lon_85_ku', 'f8', ('burst',))[:] = rng.uniform(0, 10, nb_bursts)
+            for variable in ['cplx_waveform_ch1_i_85_ku', 'cplx_waveform_ch1_q_85_ku']:
+                nc.createVariable(variable, 'f8', ('burst', 'echo', 'sample'))[:] = 1e3 * rng.normal(size=(nb_bursts, 64, nb_samples))
+            for variable in GAIN_VARIABLES:
+                nc.createVariable(variable, 'f8', ('burst',))[:] = rng.uniform(0, 1, nb_bursts)
+
+
+@pytest.fixture
+def extract(tmp_path, monkeypatch):
+    """Extract the synthetic products of a month with the waveform cache, in a work directory per dtype."""
+    monkeypatch.setattr(download_ftp, 'download_nc_files', lambda *args, **kwargs: None)
+    lead_file = tmp_path / "lead.csv"
+    lead_file.write_text("Time, Latitude, Longitude, Lead_Class, Sea_Ice_Class\n0, 80.5, 5.0, 0, 1\n")
+    lead_SeaIce_KDtree, lead_SeaIce_dictionary = create_lead_KDtree(str(lead_file))
+
+    def run(dtype):
+        path = str(tmp_path / dtype)
+        os.makedirs(os.path.join(path, "psep"))
+        write_products(os.path.join(path, "batch"))
+        with WorkerPool(1) as pool:
+            extract_psep_batch('2017', '11', path, PRODUCTS, lead_SeaIce_KDtree, lead_SeaIce_dictionary, 0, batch_name="batch",
+                               waveform_cache=True, waveform_cache_dtype=dtype, worker_pool=pool)
+        return path
+    return run
+
+
+def test_float16_cache_scales(extract):
+    path_float32, path_float16 = extract('float32'), extract('float16')
+    for product in PRODUCTS:
+        lat32, lon32, bursts32, waveforms32, gains32 = load_waveforms(waveform_cache_path(path_float32, '2017', '11', product))
+        lat16, lon16, bursts16, waveforms16, gains16 = load_waveforms(waveform_cache_path(path_float16, '2017', '11', product))
+        assert len(bursts32) > 0
+        np.testing.assert_array_equal(bursts16, bursts32)
+        np.testing.assert_array_equal(gains16, gains32)
+        with np.load(waveform_cache_path(path_float16, '2017', '11', product)) as data:
+            assert data['waveforms'].dtype == np.float16
+            # Each echo is stored divided by its maximum
+            np.testing.assert_allclose(data['scales'], waveforms32.max(axis=-1), rtol=1e-6)
+            assert np.all(data['waveforms'].max(axis=-1) == 1)
+        # float16 keeps about three significant digits relative to the maximum of the echo
+        assert np.all(np.abs(waveforms16 - waveforms32) <= 1e-3 * waveforms32.max(axis=-1, keepdims=True))
+
+
+@pytest.mark.parametrize("dtype", ['float32', 'float16'])
+def test_sweep_matches_extraction(extract, dtype):
+    path = extract(dtype)
+    latlon, psep = read_psep_from_csv(os.path.join(path, "psep"))
+    stores = sweep_psep(path, '2017', '11', {'default': {}, 'narrow': {'window_frac_psep': 0.02}})
+
+    latlon_sweep, psep_sweep = read_psep_from_csv(os.path.join(stores['default'], "psep"))
+    np.testing.assert_array_equal(latlon_sweep, latlon)
+    if dtype == 'float32':
+        np.testing.assert_allclose(psep_sweep, psep, rtol=0, atol=1e-4)
+    else:
+        # Rounding to float16 can move the leading edge of a few echoes
+        assert np.mean(np.abs(psep_sweep - psep) < 1e-2) > 0.95
+
+    # Each set of parameters is computed from the decoded cached waveforms
+    expected = []
+    for product in PRODUCTS:
+        _, _, _, waveforms, gains = load_waveforms(waveform_cache_path(path, '2017', '11', product))
+        expected.append(psep_from_waveforms(waveforms.reshape(-1, waveforms.shape[-1]), np.repeat(gains, 64),
+                                            window_frac_psep=0.02).reshape(len(gains), 64))
+    _, psep_narrow = read_psep_from_csv(os.path.join(stores['narrow'], "psep"))
+    np.testing.assert_allclose(psep_narrow, np.concatenate(expected), rtol=0, atol=1e-4)